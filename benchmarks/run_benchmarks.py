@@ -0,0 +1,565 @@
+"""
+End-to-end benchmarks of PyBHJet.run(): wall time, peak memory and heap allocations of the
+physically distinct code paths, and accuracy of the spectra against the reference outputs in
+Testing/OG_BHJet_Output.
+
+Every case runs in its own process, so that the peak RSS belongs to that case only. The results
+can be saved as a JSON baseline, and a later run compared to it flags performance and accuracy
+regressions (the exit status is 1 if there are any):
+
+    python benchmarks/run_benchmarks.py --save benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+
+With --interp-check, the spectra computed with the log-grid interpolation kernels
+(set_log_interpolation) are checked against those of the Akima splines, within the tolerances
+documented in cpp_code/loginterp.hpp, and against the reference outputs.
+
+Heap allocations are only counted with the allocation hook of the native benchmarks
+(cmake -DBHJET_BENCHMARKS=ON), passed with --alloc-hook path/to/libbhjet_alloc_hook.so.
+"""
+import argparse
+import ctypes
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+REPO = Path(__file__).resolve().parent.parent
+DEFAULT_PARAM_FILE = REPO / "Testing" / "OG_BHJet_Output" / "Input" / "ip.dat"
+DEFAULT_REFERENCE_DIR = REPO / "Testing" / "OG_BHJet_Output" / "Output"
+
+# parameter changes, with respect to the parameter file, that select each code path
+VELOCITY_PROFILES = {
+    "velsw0": {"velsw": 0, "t_e": 1e4},    # the adiabatic profile needs a hot jet base
+    "velsw1": {"velsw": 1},
+    "velsw5": {"velsw": 5},
+}
+EXTERNAL_FIELDS = {
+    "compsw0": {"compsw": 0},
+    "compsw1": {"compsw": 1, "compar1": 2736.151, "compar2": 1.693794e37, "compar3": 3e-10},
+    "compsw2": {"compsw": 2, "compar1": 0.1, "compar2": 0.1},
+}
+
+# the case that runs the parameter file unchanged, checked against the reference outputs
+REFERENCE_CASE = "infosw3"
+REFERENCE_FILES = {
+    "total": "Total.dat",
+    "presyn": "Presyn.dat",
+    "postsyn": "Postsyn.dat",
+    "precom": "Precom.dat",
+    "postcom": "Postcom.dat",
+    "disk": "Disk.dat",
+}
+# tolerances of the log-grid kernels (set_log_interpolation) with respect to the Akima splines,
+# documented in cpp_code/loginterp.hpp: relative difference where the grid resolves the spectrum,
+# at the turnovers, and of the luminosity integrated over each decade of frequency
+INTERP_RESOLVED_TOL = 0.01
+INTERP_TURNOVER_TOL = 0.05
+INTERP_BAND_TOL = 0.003
+# bins where log10(nu*F_nu) bends by less than this between neighbours count as resolved, and bins
+# where it falls by more than this per bin as an exponential cutoff, in which neither is accurate
+INTERP_RESOLVED_BEND = 0.02
+INTERP_CUTOFF_STEP = 0.5
+
+SPECTRAL_PROPERTIES = ("disk_lum", "IC_lum", "xray_lum", "radio_lum", "xray_index", "radio_index",
+                       "jetbase_compactness")
+
+
+def benchmark_cases():
+    """
+    Return the benchmark cases: every velocity profile with every external photon field, every
+    infosw, and the EBL attenuation, as dictionaries of parameter changes.
+    """
+    cases = {}
+    for (vname, vpars), (cname, cpars) in itertools.product(VELOCITY_PROFILES.items(),
+                                                            EXTERNAL_FIELDS.items()):
+        cases[f"{vname}_{cname}"] = dict(vpars, **cpars, infosw=1, EBLsw=0)
+    for infosw in range(1, 6):
+        cases[f"infosw{infosw}"] = {"infosw": infosw}
+    cases["EBL"] = {"redsh": 0.1, "EBLsw": 1, "infosw": 1}
+    return cases
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _log_deviation(energy, flux, ref_energy, ref_flux, floor):
+    """
+    Largest difference (dex) between two spectra, interpolated in log-log onto the reference
+    energies, where nu*F_nu of the reference is above floor times its peak.
+    """
+    energy, flux = np.asarray(energy, dtype=float), np.asarray(flux, dtype=float)
+    ref_energy, ref_flux = np.asarray(ref_energy, dtype=float), np.asarray(ref_flux, dtype=float)
+    nufnu = ref_energy * ref_flux
+    mask = (nufnu > floor * np.max(nufnu)) & (ref_energy >= energy.min()) & (ref_energy <= energy.max())
+    if not np.any(mask) or np.any(flux <= 0):
+        return None
+    log_flux = np.interp(np.log10(ref_energy[mask]), np.log10(energy), np.log10(flux))
+    return float(np.max(np.abs(log_flux - np.log10(ref_flux[mask]))))
+
+
+def check_reference(output, reference_dir, floor=1e-6):
+    """
+    Compare the spectral components and spectral properties of a run (infosw >= 3) with the
+    reference output files.
+
+    Returns:
+        Dictionary with the largest deviation (dex) of each component and the relative difference
+        of each spectral property.
+    """
+    reference_dir = Path(reference_dir)
+    result = {"spectra_dex": {}, "properties": {}}
+    for name, filename in REFERENCE_FILES.items():
+        path = reference_dir / filename
+        if not path.exists():
+            continue
+        reference = np.loadtxt(path, comments="#", ndmin=2)
+        spectrum = np.asarray(getattr(output, f"{name}_array"))
+        result["spectra_dex"][name] = _log_deviation(spectrum[:, 0], spectrum[:, 1],
+                                                     reference[:, 0], reference[:, 1], floor)
+
+    path = reference_dir / "Spectral_properties.dat"
+    if path.exists():
+        reference = np.loadtxt(path, ndmin=1)
+        for name, value in zip(SPECTRAL_PROPERTIES, reference):
+            computed = getattr(output.spectral_properties, name)
+            if computed and value != 0:
+                result["properties"][name] = float(abs(computed[-1] - value) / abs(value))
+    return result
+
+
+def run_case(params, param_file, repeats=5, reference_dir=None, alloc_hook=None, floor=1e-6):
+    """
+    Run one benchmark case in the current process.
+
+    The first run of the instance is reported separately, as it sets up the workspace; every
+    following run changes the jet power by a negligible amount, so that the jet is computed
+    again instead of only the observer frame step.
+
+    Args:
+        params (dict): Parameter changes with respect to the parameter file.
+        param_file (str): Parameter file.
+        repeats (int): Number of runs.
+        reference_dir (str): Directory of reference outputs to compare with, or None.
+        alloc_hook (str): Path of the preloaded allocation hook library, or None.
+        floor (float): Fraction of the peak nu*F_nu below which spectra are not compared.
+
+    Returns:
+        Dictionary with the wall times (s), peak RSS (MB), allocations, total spectrum and, with
+        reference_dir, the comparison with the reference outputs.
+    """
+    from pybhjet import PyBHJet
+
+    allocations = None
+    if alloc_hook is not None:
+        allocations = ctypes.CDLL(alloc_hook).bhjet_allocations
+        allocations.restype = ctypes.c_size_t
+
+    bhjet = PyBHJet()
+    bhjet.load_params(str(param_file))
+    bhjet.set_parameters(params)
+    jetrat = bhjet.get_parameter("jetrat")
+    rss_start = _peak_rss_mb()
+
+    times, allocs = [], []
+    for k in range(repeats):
+        bhjet.set_parameter("jetrat", jetrat * (1. + 1e-9 * k))
+        start_allocs = allocations() if allocations is not None else 0
+        start = time.perf_counter()
+        bhjet.run()
+        times.append(time.perf_counter() - start)
+        if allocations is not None:
+            allocs.append(allocations() - start_allocs)
+
+    later = times[1:] or times
+    result = {
+        "params": params,
+        "wall_time": {"first": times[0], "median": float(np.median(later)), "min": min(later)},
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_increase_mb": _peak_rss_mb() - rss_start,
+        "allocations": None,
+        "frequencies": list(bhjet.get_energy_grid()),
+        "total_flux": list(bhjet.get_total_flux()),
+    }
+    if allocs:
+        later = allocs[1:] or allocs
+        result["allocations"] = {"first": allocs[0], "median": float(np.median(later))}
+    if reference_dir is not None:
+        result["reference"] = check_reference(bhjet.get_output(), reference_dir, floor)
+    return result
+
+
+def _run_in_process(name, params, args):
+    """Run a case in a new Python process and return its result."""
+    reference_dir = args.reference_dir if name == REFERENCE_CASE else None
+    alloc_hook = args.alloc_hook and os.path.abspath(args.alloc_hook)
+    with tempfile.TemporaryDirectory() as tmp:
+        result_file = os.path.join(tmp, "result.json")
+        spec = {"params": params, "param_file": str(args.param_file), "repeats": args.repeats,
+                "reference_dir": reference_dir and str(reference_dir), "alloc_hook": alloc_hook,
+                "floor": args.floor, "result_file": result_file}
+        env = dict(os.environ)
+        if alloc_hook is not None:
+            env["LD_PRELOAD"] = alloc_hook
+        # the model prints warnings on stdout, so the result is passed through a file
+        subprocess.run([sys.executable, __file__, "--worker", json.dumps(spec)], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        with open(result_file) as f:
+            return json.load(f)
+
+
+def thread_scaling(param_file, nruns=None, max_workers=None):
+    """
+    Measure the speedup of pybhjet.run_parallel with the number of threads, from 1 to the number
+    of cores in powers of two.
+
+    The efficiency is the speedup divided by the ideal one, nruns / ceil(nruns / n), that of n
+    threads sharing the runs as evenly as they can.
+
+    Returns:
+        Dictionary of the wall time (s), speedup and efficiency for each number of threads.
+    """
+    from pybhjet import PyBHJet, run_parallel
+
+    max_workers = max_workers or os.cpu_count() or 1
+    nruns = nruns or 2 * max_workers
+    bhjet = PyBHJet()
+    bhjet.load_params(str(param_file))
+    jetrat = bhjet.get_parameter("jetrat")
+    param_dicts = [{"jetrat": jetrat * (1. + 1e-3 * k), "infosw": 0} for k in range(nruns)]
+
+    workers = sorted({min(2**n, max_workers) for n in range(max_workers.bit_length() + 1)})
+    # one run first, so that loading the module and filling the caches is not timed with one thread
+    run_parallel(param_dicts[:1], param_file=str(param_file), max_workers=1)
+    scaling = {}
+    for n in workers:
+        start = time.perf_counter()
+        run_parallel(param_dicts, param_file=str(param_file), max_workers=n)
+        scaling[n] = {"wall_time": time.perf_counter() - start}
+    for n in workers:
+        scaling[n]["speedup"] = scaling[workers[0]]["wall_time"] / scaling[n]["wall_time"]
+        scaling[n]["efficiency"] = scaling[n]["speedup"] / (nruns / -(-nruns // n))
+    return {str(n): value for n, value in scaling.items()}
+
+
+def scaling_failures(scaling, min_efficiency=0.5):
+    """Return the numbers of threads with which run_parallel is less than min_efficiency of linear."""
+    return [f"run_parallel with {n} threads: speedup {value['speedup']:.2f}, "
+            f"{value['efficiency']:.0%} of linear, less than {min_efficiency:.0%}"
+            for n, value in scaling.items() if value["efficiency"] < min_efficiency]
+
+
+def zone_scaling(param_file, repeats=5, max_threads=None):
+    """
+    Measure the latency of a single run with the zones computed in 1 to max_threads threads
+    (set_zone_threads), in powers of two, and check that the spectra do not depend on it.
+
+    Returns:
+        Dictionary of the median wall time (s), the speedup and whether the total flux is the same
+        bit for bit as with one thread, for each number of threads.
+    """
+    from pybhjet import PyBHJet
+
+    max_threads = max_threads or os.cpu_count() or 1
+    bhjet = PyBHJet()
+    bhjet.load_params(str(param_file))
+    bhjet.set_parameter("infosw", 0)
+    jetrat = bhjet.get_parameter("jetrat")
+
+    threads = sorted({min(2**n, max_threads) for n in range(max_threads.bit_length() + 1)})
+    scaling, reference = {}, None
+    for n in threads:
+        bhjet.set_zone_threads(n)
+        times = []
+        for k in range(repeats):
+            # a different jet power every run, so that every run computes the zones
+            bhjet.set_parameter("jetrat", jetrat * (1. + 1e-3 * k))
+            start = time.perf_counter()
+            bhjet.run()
+            times.append(time.perf_counter() - start)
+        flux = np.array(bhjet.get_total_flux())
+        reference = flux if reference is None else reference
+        scaling[n] = {"wall_time": float(np.median(times)), "identical": bool(np.array_equal(flux, reference))}
+    for n in threads:
+        scaling[n]["speedup"] = scaling[threads[0]]["wall_time"] / scaling[n]["wall_time"]
+    return {str(n): value for n, value in scaling.items()}
+
+
+def interpolation_deviations(frequencies, akima_flux, kernel_flux, floor=1e-3):
+    """
+    Relative differences between the total spectra computed with the Akima splines and with the
+    log-grid kernels, where nu*F_nu of the Akima spectrum is above floor times its peak.
+
+    Returns:
+        Dictionary with the largest difference in the resolved bins, in all bins but those of
+        exponential cutoffs, and of the flux integrated over each decade of frequency.
+    """
+    nu = np.asarray(frequencies, dtype=float)
+    akima, kernel = np.asarray(akima_flux, dtype=float), np.asarray(kernel_flux, dtype=float)
+    nufnu = nu * akima
+    above = nufnu > floor * np.max(nufnu)
+    log_nufnu = np.log10(np.maximum(nufnu, 1e-300))
+    step = np.abs(np.diff(log_nufnu))
+    bend = np.abs(np.diff(log_nufnu, 2))
+    resolved = np.zeros(nu.size, dtype=bool)
+    resolved[1:-1] = bend < INTERP_RESOLVED_BEND
+    cutoff = np.zeros(nu.size, dtype=bool)
+    cutoff[1:] |= step > INTERP_CUTOFF_STEP
+    cutoff[:-1] |= step > INTERP_CUTOFF_STEP
+    relative = np.abs(kernel / np.where(akima > 0., akima, np.inf) - 1.)
+    trapezoid = getattr(np, "trapezoid", None) or np.trapz    # np.trapz before NumPy 2.0
+
+    bands = []
+    decades = np.floor(np.log10(nu))
+    band_akima = {d: trapezoid(akima[decades == d], nu[decades == d]) for d in np.unique(decades)}
+    peak = max(band_akima.values())
+    for d, value in band_akima.items():
+        if value > floor * peak and np.count_nonzero(decades == d) > 1:
+            bands.append(float(abs(trapezoid(kernel[decades == d], nu[decades == d]) / value - 1.)))
+
+    def largest(mask):
+        return float(np.max(relative[mask])) if np.any(mask) else 0.
+    return {"resolved": largest(above & resolved), "turnover": largest(above & ~cutoff),
+            "band": max(bands, default=0.)}
+
+
+def interpolation_check(param_file, reference_dir=None, floor=1e-3, reference_tol=0.05):
+    """
+    Check the log-grid kernels (set_log_interpolation) against the Akima splines, for every velocity
+    profile with every external photon field, the EBL attenuation at a redshift, and the parameter
+    file itself, which is also compared with the reference outputs.
+
+    Args:
+        param_file (str): Parameter file.
+        reference_dir (str): Directory of reference outputs of the parameter file, or None.
+        floor (float): Fraction of the peak nu*F_nu below which spectra are not compared.
+        reference_tol (float): Allowed deviation from the reference outputs (dex).
+
+    Returns:
+        Dictionary with the differences of each case (see interpolation_deviations) and, for the
+        parameter file, the deviations from the reference outputs of both, and the list of the
+        differences beyond the tolerances documented in cpp_code/loginterp.hpp.
+    """
+    from pybhjet import PyBHJet
+
+    cases = {name: params for name, params in benchmark_cases().items() if "infosw" not in name}
+    cases[REFERENCE_CASE] = {"infosw": 3}
+    tolerances = {"resolved": INTERP_RESOLVED_TOL, "turnover": INTERP_TURNOVER_TOL, "band": INTERP_BAND_TOL}
+    results, failures = {}, []
+    for name, params in cases.items():
+        runs = {}
+        for kernels in (False, True):
+            bhjet = PyBHJet()
+            bhjet.load_params(str(param_file))
+            bhjet.set_parameters(params)
+            bhjet.set_log_interpolation(kernels)
+            bhjet.run()
+            runs[kernels] = bhjet
+        result = interpolation_deviations(runs[False].get_energy_grid(), runs[False].get_total_flux(),
+                                          runs[True].get_total_flux(), floor)
+        for key, tol in tolerances.items():
+            if result[key] > tol:
+                failures.append(f"{name}: the log-grid kernels differ from the Akima splines by "
+                                f"{result[key]:.3g} ({key}), more than {tol:g}")
+        if name == REFERENCE_CASE and reference_dir is not None:
+            akima = check_reference(runs[False].get_output(), reference_dir)["spectra_dex"]
+            kernel = check_reference(runs[True].get_output(), reference_dir)["spectra_dex"]
+            result["reference_dex"] = {"akima": akima, "kernels": kernel}
+            # the kernels may not move a component away from the reference by more than they
+            # are allowed to differ from the Akima splines at the turnovers
+            margin = np.log10(1. + INTERP_TURNOVER_TOL)
+            for component, deviation in kernel.items():
+                if deviation is None:
+                    continue
+                if deviation > reference_tol:
+                    failures.append(f"{name}: {component} with the log-grid kernels differs from the "
+                                    f"reference output by {deviation:.3g} dex")
+                if akima[component] is not None and deviation > akima[component] + margin:
+                    failures.append(f"{name}: {component} with the log-grid kernels is {deviation:.3g} dex "
+                                    f"from the reference output, with the Akima splines {akima[component]:.3g} dex")
+        results[name] = result
+    return {"cases": results, "failures": failures}
+
+
+def compare_results(results, baseline, time_tol=0.25, memory_tol=0.25, alloc_tol=0.1,
+                    flux_tol=1e-3, floor=1e-6):
+    """
+    Compare benchmark results with a baseline.
+
+    Args:
+        results (dict): Results of this run.
+        baseline (dict): Results saved earlier.
+        time_tol, memory_tol, alloc_tol (float): Allowed relative increase of the median wall
+            time, peak RSS and median allocations of a run.
+        flux_tol (float): Allowed deviation (dex) of the total spectrum.
+        floor (float): Fraction of the peak nu*F_nu below which spectra are not compared.
+
+    Returns:
+        List of the regressions found, as strings.
+    """
+    regressions = []
+    for name, result in results["cases"].items():
+        old = baseline.get("cases", {}).get(name)
+        if old is None:
+            continue
+        new_time, old_time = result["wall_time"]["median"], old["wall_time"]["median"]
+        if new_time > (1. + time_tol) * old_time:
+            regressions.append(f"{name}: run time {new_time:.3g} s, baseline {old_time:.3g} s")
+        if result["peak_rss_mb"] > (1. + memory_tol) * old["peak_rss_mb"]:
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']:.1f} MB, "
+                               f"baseline {old['peak_rss_mb']:.1f} MB")
+        if result["allocations"] and old["allocations"]:
+            new_allocs, old_allocs = result["allocations"]["median"], old["allocations"]["median"]
+            if new_allocs > (1. + alloc_tol) * old_allocs:
+                regressions.append(f"{name}: {new_allocs:.0f} allocations per run, "
+                                   f"baseline {old_allocs:.0f}")
+        if result["frequencies"] == old["frequencies"]:
+            deviation = _log_deviation(result["frequencies"], result["total_flux"],
+                                       old["frequencies"], old["total_flux"], floor)
+            if deviation is not None and deviation > flux_tol:
+                regressions.append(f"{name}: total spectrum differs from the baseline by "
+                                   f"{deviation:.3g} dex")
+    return regressions
+
+
+def reference_failures(results, reference_tol):
+    """Return the spectral components that differ from the reference outputs by more than reference_tol dex."""
+    failures = []
+    for name, result in results["cases"].items():
+        for component, deviation in result.get("reference", {}).get("spectra_dex", {}).items():
+            if deviation is not None and deviation > reference_tol:
+                failures.append(f"{name}: {component} differs from the reference output by "
+                                f"{deviation:.3g} dex")
+    return failures
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PyBHJet.run() and check its accuracy.")
+    parser.add_argument("--param-file", type=Path, default=DEFAULT_PARAM_FILE,
+                        help="parameter file the cases start from")
+    parser.add_argument("--reference-dir", type=Path, default=DEFAULT_REFERENCE_DIR,
+                        help="reference outputs of the parameter file")
+    parser.add_argument("--cases", nargs="+", help="run only the cases with these names")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per case")
+    parser.add_argument("--save", type=Path, help="save the results as a JSON baseline")
+    parser.add_argument("--compare", type=Path, help="JSON baseline to compare with")
+    parser.add_argument("--time-tol", type=float, default=0.25, help="allowed relative run time increase")
+    parser.add_argument("--memory-tol", type=float, default=0.25, help="allowed relative peak RSS increase")
+    parser.add_argument("--alloc-tol", type=float, default=0.1, help="allowed relative allocation increase")
+    parser.add_argument("--flux-tol", type=float, default=1e-3,
+                        help="allowed deviation from the baseline spectra (dex)")
+    parser.add_argument("--reference-tol", type=float, default=0.05,
+                        help="allowed deviation from the reference outputs (dex)")
+    parser.add_argument("--floor", type=float, default=1e-6,
+                        help="fraction of the peak nu*F_nu below which spectra are not compared")
+    parser.add_argument("--alloc-hook", help="path of libbhjet_alloc_hook.so, to count allocations")
+    parser.add_argument("--scaling", action="store_true",
+                        help="also measure the speedup of run_parallel with the number of threads")
+    parser.add_argument("--scaling-efficiency", type=float, default=0.5,
+                        help="smallest allowed speedup of run_parallel, as a fraction of linear")
+    parser.add_argument("--zone-scaling", action="store_true",
+                        help="also measure the latency of a single run with the number of zone threads")
+    parser.add_argument("--interp-check", action="store_true",
+                        help="also check the log-grid kernels against the Akima splines and the reference outputs")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        spec = json.loads(args.worker)
+        result = run_case(spec["params"], spec["param_file"], spec["repeats"], spec["reference_dir"],
+                          spec["alloc_hook"], spec["floor"])
+        with open(spec["result_file"], "w") as f:
+            json.dump(result, f)
+        return 0
+
+    cases = benchmark_cases()
+    if args.cases:
+        unknown = set(args.cases) - set(cases)
+        if unknown:
+            parser.error(f"unknown cases: {', '.join(sorted(unknown))}; known: {', '.join(cases)}")
+        cases = {name: cases[name] for name in args.cases}
+    if not args.reference_dir.is_dir():
+        args.reference_dir = None
+
+    results = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "param_file": str(args.param_file),
+            "repeats": args.repeats,
+        },
+        "cases": {},
+    }
+    for name, params in cases.items():
+        result = _run_in_process(name, params, args)
+        results["cases"][name] = result
+        allocs = result["allocations"]["median"] if result["allocations"] else float("nan")
+        print(f"{name:20s} first {result['wall_time']['first']:8.3f} s   median "
+              f"{result['wall_time']['median']:8.3f} s   peak RSS {result['peak_rss_mb']:7.1f} MB   "
+              f"allocations {allocs:.0f}")
+        for component, deviation in result.get("reference", {}).get("spectra_dex", {}).items():
+            print(f"    {component:8s} vs reference: {deviation if deviation is None else f'{deviation:.3g} dex'}")
+    if args.scaling:
+        results["scaling"] = thread_scaling(args.param_file)
+        for n, value in results["scaling"].items():
+            print(f"{n:>3s} threads: {value['wall_time']:.3g} s, speedup {value['speedup']:.2f}, "
+                  f"efficiency {value['efficiency']:.0%}")
+
+    if args.zone_scaling:
+        results["zone_scaling"] = zone_scaling(args.param_file, args.repeats)
+        for n, value in results["zone_scaling"].items():
+            print(f"{n:>3s} zone threads: {value['wall_time']:.3g} s, speedup {value['speedup']:.2f}"
+                  f"{'' if value['identical'] else ', SPECTRUM DIFFERS'}")
+
+    if args.interp_check:
+        results["interpolation"] = interpolation_check(args.param_file, args.reference_dir,
+                                                       reference_tol=args.reference_tol)
+        for name, value in results["interpolation"]["cases"].items():
+            print(f"{name:20s} kernels vs Akima: resolved {value['resolved']:.2%}, turnovers "
+                  f"{value['turnover']:.2%}, bands {value['band']:.2%}")
+
+    problems = reference_failures(results, args.reference_tol)
+    problems += results.get("interpolation", {}).get("failures", [])
+    problems += scaling_failures(results.get("scaling", {}), args.scaling_efficiency)
+    problems += [f"the spectrum with {n} zone threads differs from the one with one thread"
+                 for n, value in results.get("zone_scaling", {}).items() if not value["identical"]]
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        problems += compare_results(results, baseline, args.time_tol, args.memory_tol, args.alloc_tol,
+                                    args.flux_tol, args.floor)
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"Saved the results to {args.save}")
+
+    for problem in problems:
+        print("REGRESSION:", problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,17 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.pylab as pl
 import math
+import sys
 
 from matplotlib import rc
 
+# the loader only needs numpy, so it is also found without a built pybhjet
+try:
+    from pybhjet.bhjet_output import load_output
+except ImportError:
+    sys.path.insert(0, "../src/pybhjet")
+    from bhjet_output import load_output
+
 rc("text", usetex=True)
 rc("font", **{"family": "serif", "serif": ["Computer Modern"]})
 plt.rcParams.update({"font.size": 18})
@@ -62,58 +70,44 @@ zheight = np.around(zheight, decimals=2)
 z = pars[3]
 plotcheck = pars[26]
 
+# output directory of the run, Output unless given on the command line
+output_dir = sys.argv[1] if len(sys.argv) > 1 else "Output"
+
 if plotcheck >= 1:
-    Presyn = np.genfromtxt("Output/Presyn.dat")
-    Postsyn = np.genfromtxt("Output/Postsyn.dat")
-    Precom = np.genfromtxt("Output/Precom.dat")
-    Postcom = np.genfromtxt("Output/Postcom.dat")
-    Disk = np.genfromtxt("Output/Disk.dat")
-    BB = np.genfromtxt("Output/BB.dat")
-    Total = np.genfromtxt("Output/Total.dat")
+    output = load_output(output_dir)
+    Presyn = output["Presyn"]
+    Postsyn = output["Postsyn"]
+    Precom = output["Precom"]
+    Postcom = output["Postcom"]
+    Disk = output["Disk"]
+    BB = output["BB"]
+    Total = output["Total"]
 else:
     exit()
 
 mjy = 1.0e-26
 
-i = 0
-j = 0
 nzones = 100
 
-colors = pl.cm.magma(np.linspace(0.0, 0.9, nzones))
-
 size_cyclo_arr = np.zeros(nzones)
 size_com_arr = np.zeros(nzones)
 
 if plotcheck >= 2:
-    Cyclosyn_zones = np.genfromtxt("Output/Cyclosyn_zones.dat")
-    Compton_zones = np.genfromtxt("Output/Compton_zones.dat")
-    Numdens = np.genfromtxt("Output/Numdens.dat")
+    Cyclosyn_zones = output["Cyclosyn_zones"]
+    Compton_zones = output["Compton_zones"]
+    Numdens = output["Numdens"]
+    # rows of every zone, from the first row of each zone recorded by the writer
+    nzones = len(output["Numdens_offsets"]) - 1
+    size_cyclo_arr = np.diff(output["Cyclosyn_zones_offsets"])
+    size_com_arr = np.diff(output["Compton_zones_offsets"])
     size3 = len(Numdens.T[0]) // nzones
-    i = 0
-    j = 0
-    k = 0
-    for j in range(len(Cyclosyn_zones.T[0]) - 1):
-        if Cyclosyn_zones.T[0][j + 1] > Cyclosyn_zones.T[0][j]:
-            k = k + 1
-        else:
-            size_cyclo_arr[i] = k + 1
-            i = i + 1
-            k = 0
-    i = 0
-    j = 0
-    k = 0
-    for j in range(len(Compton_zones.T[0]) - 1):
-        if Compton_zones.T[0][j + 1] > Compton_zones.T[0][j]:
-            k = k + 1
-        else:
-            size_com_arr[i] = k + 1
-            i = i + 1
-            k = 0
     garr = np.zeros(size3)
     ng = np.zeros(size3)
     parr = np.zeros(size3)
     nparr = np.zeros(size3)
 
+colors = pl.cm.magma(np.linspace(0.0, 0.9, nzones))
+
 totindex1 = 0
 totindex2 = 0
 fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(18, 6))
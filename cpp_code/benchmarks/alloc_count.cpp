@@ -0,0 +1,59 @@
+// Counts the heap allocations (malloc/calloc/realloc, which also serve operator new and the GSL
+// allocations) of a single run() of BHJet, for a fresh instance, i.e. without a workspace that has
+// been used before, and for an instance that already ran once. The difference is the number of
+// allocations the workspace saves in every run after the first.
+//
+// usage: alloc_count [parameter file] [number of runs]
+
+#include <chrono>
+#include <cstdlib>
+#include <iostream>
+#include <string>
+
+#include "../bhjet_class.hpp"
+
+// from alloc_hook.cpp, which replaces malloc/calloc/realloc
+extern "C" size_t bhjet_allocations();
+
+// runs the model once with a slightly changed jet power, so that the full calculation is done
+// rather than only the observer frame step, and returns the allocations and time of the run
+static size_t counted_run(BhJetClass& model, double jetrat, double& seconds) {
+    model.set_parameter("jetrat", jetrat);
+    size_t start = bhjet_allocations();
+    auto t0 = std::chrono::steady_clock::now();
+    model.run();
+    seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - t0).count();
+    return bhjet_allocations() - start;
+}
+
+int main(int argc, char* argv[]) {
+    std::string param_file = argc > 1 ? argv[1] : "ip.dat";
+    int nruns = argc > 2 ? std::atoi(argv[2]) : 5;
+
+    BhJetClass warm;
+    warm.load_params(param_file);
+    double jetrat = warm.get_parameter("jetrat");
+    double seconds = 0.0;
+    counted_run(warm, jetrat, seconds);
+
+    size_t cold_allocs = 0, warm_allocs = 0;
+    double cold_time = 0.0, warm_time = 0.0;
+    for (int i = 1; i <= nruns; i++) {
+        double run_jetrat = jetrat * (1. + 1e-3 * i);
+
+        BhJetClass cold;
+        cold.load_params(param_file);
+        cold_allocs += counted_run(cold, run_jetrat, seconds);
+        cold_time += seconds;
+
+        warm_allocs += counted_run(warm, run_jetrat, seconds);
+        warm_time += seconds;
+    }
+
+    std::cout << "allocations per run, new instance:    " << cold_allocs / nruns << " ("
+              << cold_time / nruns << " s)\n";
+    std::cout << "allocations per run, reused instance: " << warm_allocs / nruns << " ("
+              << warm_time / nruns << " s)\n";
+    std::cout << "saved per run: " << (cold_allocs - warm_allocs) / nruns << "\n";
+    return 0;
+}
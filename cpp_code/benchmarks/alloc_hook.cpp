@@ -0,0 +1,35 @@
+// Counts the heap allocations of the process by wrapping the glibc allocator (malloc, calloc and
+// realloc, which also serve operator new and the GSL allocations). Linked into alloc_count, and
+// built as the shared library bhjet_alloc_hook, which can be preloaded into Python
+// (LD_PRELOAD=libbhjet_alloc_hook.so) to count the allocations of PyBHJet.run() with ctypes.
+
+#include <atomic>
+#include <cstddef>
+
+#ifdef __GLIBC__
+extern "C" void* __libc_malloc(size_t size);
+extern "C" void* __libc_calloc(size_t n, size_t size);
+extern "C" void* __libc_realloc(void* ptr, size_t size);
+
+static std::atomic<size_t> allocations(0);
+
+extern "C" void* malloc(size_t size) {
+    allocations++;
+    return __libc_malloc(size);
+}
+extern "C" void* calloc(size_t n, size_t size) {
+    allocations++;
+    return __libc_calloc(n, size);
+}
+extern "C" void* realloc(void* ptr, size_t size) {
+    allocations++;
+    return __libc_realloc(ptr, size);
+}
+
+// number of allocations since the start of the process
+extern "C" size_t bhjet_allocations() {
+    return allocations;
+}
+#else
+#error "the allocation hook counts allocations by wrapping the glibc allocator"
+#endif
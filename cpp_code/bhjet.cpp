@@ -1,8 +1,14 @@
+#include <algorithm>
+#include <atomic>
 #include <cmath>
 #include <cstdarg>
+#include <exception>
 #include <fstream>
+#include <optional>
+#include <sstream>
+#include <stdexcept>
+#include <thread>
 
-#include "kariba/EBL.hpp"
 #include "kariba/constants.hpp"
 #include <kariba/BBody.hpp>
 #include <kariba/Bknpower.hpp>
@@ -18,6 +24,29 @@
 
 namespace karcst = kariba::constants;    // alias the kariba::constants namespace
 
+namespace {
+
+// A zone of the jet as set up by the sequential part of the zone loop (grid, dynamics, shock
+// heating and photon fields), from which its particle distribution and emission follow without
+// the other zones
+struct zone_task {
+    size_t i = 0;               // zone of the grid
+    bool last_sub = true;       // last sub-zone of grid zone i
+    bool checkpoint = false;    // first zone from z_diss on, where zone_checkpoint is saved
+    bool shock = false;         // shock heating has started
+    double z = 0., tshift = 0., Urad = 0., Ubb1 = 0., Ubb2 = 0.;
+    double z_grid_end = 0.;     // end of grid zone i
+    zone_pars zone;
+};
+
+// work of a zone, for JetOutput::zone_counters
+struct zone_work {
+    size_t nsyn = 0, ncom = 0;
+    bool compton = false, multiple_scatters = false;
+};
+
+}    // namespace
+
 void jetmain(std::vector<double>& ear, size_t ne, std::vector<double>& param,
              std::vector<double>& photeng, std::vector<double>& photspec) {
     JetOutput empty;
@@ -27,18 +56,33 @@ void jetmain(std::vector<double>& ear, size_t ne, std::vector<double>& param,
 
 void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& param,
              std::vector<double>& photeng, std::vector<double>& photspec,
-             bool writeToFile, bool verbose, JetOutput& output) {
+             bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts) {
+    source_spectra src;
+    jetmain_output(ear, ne, param, photeng, photspec, writeToFile, verbose, output, opts, src);
+}
+
+void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& param,
+             std::vector<double>& photeng, std::vector<double>& photspec,
+             bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts,
+             source_spectra& src) {
+    JetWorkspace ws;
+    jetmain_output(ear, ne, param, photeng, photspec, writeToFile, verbose, output, opts, src, ws);
+}
+
+void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& param,
+             std::vector<double>& photeng, std::vector<double>& photspec,
+             bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts,
+             source_spectra& src, JetWorkspace& ws) {
 
     // STEP 1: VARIABLE/OBJECT DEFINITIONS
     //----------------------------------------------------------------------------------------------
 
     bool IsShock = false;    // flag to set shock heating
 
-    size_t nz = 100;    // total number of zones
-    size_t nel = 70;
-    size_t syn_res = 10;          // number of bins per decade in synch frequency;
-    size_t com_res = 6;           // number of bins per decade in compton frequency;
-    size_t nsyn = 0, ncom = 0;    // number of bins in synch/compton frequency;
+    size_t nz = opts.nz;              // total number of zones
+    size_t nel = opts.nel;            // number of bins of the particle distributions
+    size_t syn_res = opts.syn_res;    // number of bins per decade in synch frequency;
+    size_t com_res = opts.com_res;    // number of bins per decade in compton frequency;
     int npsw = 1;                 // switch to define number of protons calculations in agnjet
                                   // 0: no protons
                                   // 1: Up = Ue+Ub
@@ -75,41 +119,41 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
     double compsw = 0.0;    // switch to activate different external Compton fields
     double velsw = 0.0;     // velocity profile parameter
     int infosw = 0.0;       // switch to print info
-    int EBLsw = 0.0;        // switch to activate EBL attenuation
 
     double z = 0.0;         // distance along the jet axis
     double tshift = 0.0;    // temperature shift from initial value due to ad. cooling
     double Urad = 0.0;      // estimate of total radiation energy density in each zone
     double Ubb1 = 0.0,
            Ubb2 = 0.0;    // estimate of comoving energy density of external photons
-    double gmin = 0.0,
-           gmax = 0.0;    // minimum/maximum Lorentz factors over which to integrate
-    double syn_min = 0.0,
-           syn_max = 0.0;    // interval for synchrotron calculation in each zone
-    double com_min = 0.0,
-           com_max = 0.0;    // interval for inverse Compton calculation in each zone
-
-    std::vector<double> tot_en(ne, 0.0);    // energy arrray for sum of all
-                                            // zones and/or components
-    std::vector<double> tot_syn_pre(ne,
-                                    0.0);         // specific synchrotron luminosity
-                                                  // arrays for all zones
-    std::vector<double> tot_syn_post(ne, 0.0);    // pre/post particle
-                                                  // acceleration
-    std::vector<double> tot_com_pre(ne, 0.0);
-    ;    // same as above but for the inverse Compton part
-    std::vector<double> tot_com_post(ne, 0.0);
-    std::vector<double> tot_lum(ne, 0.0);    // specific luminosity array for
-                                             // sum of all components
-
-    std::ofstream Numdensfile;    // ofstream plot file for particle distribution
-    std::ofstream Presyn, Postsyn,
-        Syn_zones;    // ofstream plot files for synchrotron emission
-    std::ofstream Precom, Postcom,
-        Com_zones;    // same as above but for inverse Comtpon
-    std::ofstream Diskfile, Corfile,
-        BBfile;               // same as above but for disk/corona/blackbody
-    std::ofstream Totfile;    // same as above but for total model emission
+
+    // the arrays, splines and particle distributions below are kept in the workspace, so that
+    // they are only allocated again when their size changes
+    ws.set_nel(nel);
+
+    std::vector<double>& tot_en = ws.tot_en;    // energy arrray for sum of all
+                                                // zones and/or components
+    std::vector<double>& tot_syn_pre = ws.tot_syn_pre;      // specific synchrotron luminosity
+                                                            // arrays for all zones
+    std::vector<double>& tot_syn_post = ws.tot_syn_post;    // pre/post particle
+                                                            // acceleration
+    std::vector<double>& tot_com_pre = ws.tot_com_pre;    // same as above but for the inverse
+    std::vector<double>& tot_com_post = ws.tot_com_post;  // Compton part
+    std::vector<double>& tot_lum = ws.tot_lum;    // specific luminosity array for
+                                                  // sum of all components
+    tot_en.assign(ne, 0.0);
+    tot_syn_pre.assign(ne, 0.0);
+    tot_syn_post.assign(ne, 0.0);
+    tot_com_pre.assign(ne, 0.0);
+    tot_com_post.assign(ne, 0.0);
+    tot_lum.assign(ne, 0.0);
+    ws.log_interp = opts.log_interp;
+
+    // output files of the run, collected in memory and written once at the end with writeToFile
+    OutputWriter writer(opts.output_dir, opts.output_npz ? OutputWriter::NPZ : OutputWriter::TEXT);
+
+    // per-stage wall times and per-zone counters, only recorded with opts.instrument
+    StageTimer timer(opts.instrument);
+    JetOutput::Timings& timings = output.timings;
 
     grid_pars grid;            // structure with grid parameters
     jet_dynpars jet_dyn;       // structure with jet dynamical parameters
@@ -118,22 +162,19 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
     com_pars agn_com;          // structure with parameters for inverse Compton fields
                                // in AGN
 
-    // External photon object declarations
-    kariba::ShSDisk Disk;
-    kariba::BBody BLR;
-    kariba::BBody Torus;
-    kariba::BBody BlackBody;
+    // External photon objects, kept in the workspace: they only depend on Mbh, theta, l_disk,
+    // r_in, r_out, compar1-3 and compsw (parameter_stages), and are only computed again when one
+    // of those changes
+    std::vector<double> external_key = stage_key(param, STAGE_EXTERNAL);
+    bool external_cached = ws.external_ready(external_key);
+    kariba::ShSDisk& Disk = *ws.disk;
+    kariba::BBody& BLR = *ws.blr;
+    kariba::BBody& Torus = *ws.torus;
+    kariba::BBody& BlackBody = *ws.blackbody;
 
     // splines for jet acceleration
-    gsl_interp_accel* acc_speed = gsl_interp_accel_alloc();
-    gsl_spline* spline_speed = gsl_spline_alloc(gsl_interp_steffen, 54);
-
-    // splines for electron distribution
-    gsl_interp_accel* acc_eldis = gsl_interp_accel_alloc();
-    gsl_spline* spline_eldis = gsl_spline_alloc(gsl_interp_steffen, nel);
-
-    gsl_interp_accel* acc_deriv = gsl_interp_accel_alloc();
-    gsl_spline* spline_deriv = gsl_spline_alloc(gsl_interp_steffen, nel);
+    gsl_interp_accel* acc_speed = ws.acc_speed;
+    gsl_spline* spline_speed = ws.spline_speed;
 
     // STEP 2: PARAMETER/FILE INITIALIZATION
     Mbh = param[0];
@@ -165,18 +206,22 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
     compsw = param[24];
     velsw = param[25];
     infosw = static_cast<int>(param[26]);
-    EBLsw = static_cast<int>(param[27]);
     zmin = 2. * Rg;
 
     if (infosw >= 1) {
         if (writeToFile){
-            param_write(param, "Output/Starting_pars.dat");
+            writer.parameters(param);
         }
     }
 
-    // initialize total energy/luminosity arrays
+    // initialize total energy/luminosity arrays; with opts.centres the observed energies are
+    // moved to the source frame, so that the zones are summed directly on the requested grid
     for (size_t i = 0; i < ne; i++) {
-        tot_en[i] = (ear[i] + (ear[i + 1] - ear[i]) / 2.) * karcst::herg / karcst::hkev;
+        if (opts.centres) {
+            tot_en[i] = ear[i] * (1. + redsh) * karcst::herg / karcst::hkev;
+        } else {
+            tot_en[i] = (ear[i] + (ear[i + 1] - ear[i]) / 2.) * karcst::herg / karcst::hkev;
+        }
         tot_syn_pre[i] = 1.;
         tot_syn_post[i] = 1.;
         tot_com_pre[i] = 1.;
@@ -186,39 +231,43 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
 
     if (writeToFile){
         if (infosw >= 1) {
-            clean_file("Output/Presyn.dat", 2);
-            clean_file("Output/Postsyn.dat", 2);
-            clean_file("Output/Precom.dat", 2);
-            clean_file("Output/Postcom.dat", 2);
-            clean_file("Output/Disk.dat", 2);
-            clean_file("Output/BB.dat", 2);
-            clean_file("Output/Total.dat", 2);
+            writer.table("Presyn", 2);
+            writer.table("Postsyn", 2);
+            writer.table("Precom", 2);
+            writer.table("Postcom", 2);
+            writer.table("Disk", 2);
+            writer.table("BB", 2);
+            writer.table("Total", 2);
         }
         if (infosw >= 2) {
-            clean_file("Output/Numdens.dat", 4);
-            clean_file("Output/Cyclosyn_zones.dat", 2);
-            clean_file("Output/Compton_zones.dat", 2);
+            writer.table("Numdens", 4, true);
+            writer.table("Cyclosyn_zones", 2, true);
+            writer.table("Compton_zones", 2, true);
         }
         if (infosw >= 3) {
-            clean_file("Output/Spectral_properties.dat", 7);
+            writer.table("Spectral_properties", 7);
         }
         if (infosw >= 5) {
-            clean_file("Output/Profiles.dat", 6);
+            writer.table("Profiles", 6, true);
         }
     }
     // STEP 3: DISK/EXTERNAL PHOTON CALCULATIONS
     // The disk is disabled by setting r_in<r_out; its contribution is summed to
     // the total only if there are no AGN photon fields that reprocess part of
     // the luminosity, otherwise it is done later
+    timer.start();
     if (r_in < r_out) {
-        Disk.set_mbh(Mbh);
-        Disk.set_rin(r_in);
-        Disk.set_rout(r_out);
-        Disk.set_luminosity(std::abs(l_disk));
-        Disk.set_inclination(theta);
-        Disk.disk_spectrum();
+        if (!external_cached) {
+            Disk.set_mbh(Mbh);
+            Disk.set_rin(r_in);
+            Disk.set_rout(r_out);
+            Disk.set_luminosity(std::abs(l_disk));
+            Disk.set_inclination(theta);
+            Disk.disk_spectrum();
+            ws.disk_luminosity = Disk.total_luminosity();
+        }
         if (compsw != 2 && l_disk > 0) {
-            sum_ext(50, ne, Disk.get_energy_obs(), Disk.get_nphot_obs(), tot_en, tot_lum);
+            sum_ext(50, ne, Disk.get_energy_obs(), Disk.get_nphot_obs(), tot_en, tot_lum, ws);
         }
         if ((infosw >= 3) && (verbose == true)) {
             Disk.test();
@@ -231,41 +280,52 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
     // broad line region/torus of a bright AGN. For bright AGN, the reprocessed
     // fraction of disk luminosity is removed from the observed disk luminosity
     if (compsw == 1) {
-        BlackBody.set_temp_k(compar1);
-        BlackBody.set_lum(compar2);
+        if (!external_cached) {
+            BlackBody.set_temp_k(compar1);
+            BlackBody.set_lum(compar2);
+            BlackBody.bb_spectrum();
+        }
         Ubb1 = compar3;
-        BlackBody.bb_spectrum();
-        sum_ext(40, ne, BlackBody.get_energy_obs(), BlackBody.get_nphot_obs(), tot_en, tot_lum);
+        sum_ext(40, ne, BlackBody.get_energy_obs(), BlackBody.get_nphot_obs(), tot_en, tot_lum, ws);
     } else if (compsw == 2 && r_in < r_out) {
-        agn_photons_init(Disk.total_luminosity(), compar1, compar2, agn_com);
+        agn_photons_init(ws.disk_luminosity, compar1, compar2, agn_com);
 
-        BLR.set_temp_kev(agn_com.tblr);
-        BLR.set_lum(agn_com.lblr);
-        BLR.bb_spectrum();
+        if (!external_cached) {
+            BLR.set_temp_kev(agn_com.tblr);
+            BLR.set_lum(agn_com.lblr);
+            BLR.bb_spectrum();
 
-        Torus.set_temp_k(agn_com.tdt);
-        Torus.set_lum(agn_com.ldt);
-        Torus.bb_spectrum();
+            Torus.set_temp_k(agn_com.tdt);
+            Torus.set_lum(agn_com.ldt);
+            Torus.bb_spectrum();
 
-        Disk.cover_disk(compar1 + compar2);
+            Disk.cover_disk(compar1 + compar2);
+        }
         if ((infosw >= 3) && (verbose == true)) {
             std::cout << "BLR radius in Rg: " << agn_com.rblr / Rg << " and in cm: " << agn_com.rblr
                       << "\n";
             std::cout << "DT radius in Rg: " << agn_com.rdt / Rg << " and in cm: " << agn_com.rdt
                       << "\n";
         }
-        sum_ext(40, ne, Torus.get_energy_obs(), Torus.get_nphot_obs(), tot_en, tot_lum);
+        sum_ext(40, ne, Torus.get_energy_obs(), Torus.get_nphot_obs(), tot_en, tot_lum, ws);
         if (l_disk > 0) {
-            sum_ext(50, ne, Disk.get_energy_obs(), Disk.get_nphot_obs(), tot_en, tot_lum);
+            sum_ext(50, ne, Disk.get_energy_obs(), Disk.get_nphot_obs(), tot_en, tot_lum, ws);
         }
     }
+    if (!external_cached && r_in < r_out) {
+        ws.disk_tin = Disk.tin();
+        ws.disk_hdisk = Disk.hdisk();
+    }
+    ws.external_key = external_key;
+    timer.stop(timings.external);
 
     // STEP 4: JET BASE EQUIPARTITION CALCULATIONS AND SETUP
     // Dummy particle distribution, needed for average lorentz factor in
     // equipartition function The number density is just set to unity, the
     // normalisation is not needed to calculate the average Lorenz factor of the
     // thermal distribution anyway
-    kariba::Thermal dummy_elec(nel);
+    timer.start();
+    kariba::Thermal& dummy_elec = *ws.thermal;
     dummy_elec.set_temp_kev(t_e);
     dummy_elec.set_p();
     dummy_elec.set_norm(1.);
@@ -295,28 +355,43 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
     // adiabatic,isothermal,magnetically dominated jet note: the adiabatic jet
     // only runs correctly if the final temperature is above ~1kev, which means
     // the initial temperature has to be ~10^4 kev to avoid numerical issues
+    // the tabulated profiles are the same in every run, so the spline is only initialised when
+    // the profile changes
     if (velsw == 0) {
-        velprof_ad(spline_speed);
+        if (ws.speed_table != 0) {
+            velprof_ad(spline_speed);
+            ws.speed_table = 0;
+        }
         equipartition(npsw, jet_dyn, nozzle_ener);
     } else if (velsw == 1) {
-        velprof_iso(spline_speed);
+        if (ws.speed_table != 1) {
+            velprof_iso(spline_speed);
+            ws.speed_table = 1;
+        }
         equipartition(npsw, jet_dyn, nozzle_ener);
     } else {
         velprof_mag(jet_dyn, spline_speed);
+        ws.speed_table = -1;
         equipartition(jetrat, jet_dyn, nozzle_ener);
     }
 
     // check that the pair content is not negative, and also if running bljet
-    // that it's not too high
+    // that it's not too high; the warnings are kept with the source frame spectra and raised by
+    // observe_spectra, so that runs which only redo the observer frame step raise them too
+    std::vector<JetWarning> base_warnings;
     if (nozzle_ener.eta < 1) {
-        std::cout << "Unphysical pair content: " << nozzle_ener.eta
-                  << " pairs per proton. Check the value of "
-                  << "plasma beta!\n";
+        std::ostringstream message;
+        message << "Unphysical pair content: " << nozzle_ener.eta
+                << " pairs per proton. Check the value of plasma beta!";
+        base_warnings.push_back({WARNING_UNPHYSICAL_PAIRS, message.str(), nozzle_ener.eta});
     } else if (velsw > 1 && dummy_elec.av_gamma() * nozzle_ener.eta >= 3e2) {
-        std::cout << "Pair content or temperature too high for  for bljet!\n";
-        std::cout << "Pair content: " << nozzle_ener.eta << " pairs per proton\n";
-        std::cout << "Average lepton Lorenz factor: " << dummy_elec.av_gamma() << "\n";
-        std::cout << "Check the value of Te and/or plasma beta!\n";
+        std::ostringstream message;
+        message << "Pair content or temperature too high for bljet!\n"
+                << "Pair content: " << nozzle_ener.eta << " pairs per proton\n"
+                << "Average lepton Lorenz factor: " << dummy_elec.av_gamma() << "\n"
+                << "Check the value of Te and/or plasma beta!";
+        base_warnings.push_back({WARNING_BLJET_PAIRS, message.str(),
+                                 dummy_elec.av_gamma() * nozzle_ener.eta});
     }
 
     if (infosw >= 3) {
@@ -337,11 +412,100 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
                     << jet_dyn.r0 * nozzle_ener.lepdens * karcst::sigtom << "\n\n";
         }
     }
+    timer.stop(timings.equipartition);
 
     // STEP 5: TOTAL JET CALCULATIONS, LOOPING OVER EACH SEGMENT OF THE JET
-    for (size_t i = 0; i < nz; i++) {
+    // With opts.adaptive, the zones of the grid close to the nozzle, z_acc and z_diss are split in
+    // opts.zone_refine sub-zones, and the loop stops once the zones left are estimated to add less
+    // than a fraction opts.zone_tol to the total at every energy
+    double z_grid = 0., delz_grid = 0., r_grid = 0.;    // zone i of the grid
+    size_t i = 0, isub = 0, nsub = 1;                    // sub-zone isub of nsub of zone i
+    size_t zones_computed = 0;
+    double truncation = 0.;
+    std::vector<double>& zone_start = ws.zone_start;    // jet spectrum before zone i
+    std::vector<double>& zone_last = ws.zone_last;      // contribution of zone i-1
+    zone_start.assign(ne, 0.0);
+    zone_last.assign(ne, 0.0);
+
+    // The zones before z_diss only hold thermal particles, so if none of the parameters they
+    // depend on (parameter_stages, including the external photon fields) changed since the
+    // previous run with this workspace, the loop starts at the first zone from z_diss on, with the
+    // state it had there in that run. Their per-zone output is not kept, so this is only done if
+    // the run does not need it (infosw < 2, no files).
+    std::vector<double> zones_key = stage_key(param, STAGE_EXTERNAL | STAGE_THERMAL_ZONES);
+    zones_key.insert(zones_key.end(), tot_en.begin(), tot_en.end());
+    zones_key.insert(zones_key.end(),
+                     {static_cast<double>(opts.centres), static_cast<double>(nz),
+                      static_cast<double>(nel), static_cast<double>(syn_res),
+                      static_cast<double>(com_res), static_cast<double>(opts.adaptive),
+                      opts.zone_tol, static_cast<double>(opts.zone_refine),
+                      static_cast<double>(opts.log_interp)});
+    bool resume = opts.reuse_zones && infosw < 2 && !writeToFile && ws.checkpoint &&
+                  ws.checkpoint->key == zones_key;
+    bool checkpoint_saved = resume || !opts.reuse_zones;
+    size_t zones_reused = 0;
+    if (resume) {
+        const zone_checkpoint& cp = *ws.checkpoint;
+        i = cp.i, isub = cp.isub, nsub = cp.nsub, zones_computed = cp.zones_computed;
+        z = cp.z, z_grid = cp.z_grid, delz_grid = cp.delz_grid, r_grid = cp.r_grid;
+        tshift = cp.tshift, Ubb1 = cp.Ubb1, Ubb2 = cp.Ubb2, truncation = cp.truncation;
+        grid = cp.grid, zone = cp.zone, agn_com = cp.agn_com;
+        tot_syn_pre = cp.tot_syn_pre, tot_syn_post = cp.tot_syn_post;
+        tot_com_pre = cp.tot_com_pre, tot_com_post = cp.tot_com_post;
+        zone_start = cp.zone_start, zone_last = cp.zone_last;
+        if (opts.instrument) {
+            for (size_t k = 0; k < cp.nsyn.size(); k++) {
+                output.zone_counters.nsyn.push_back(cp.nsyn[k]);
+                output.zone_counters.ncom.push_back(cp.ncom[k]);
+                output.zone_counters.compton.push_back(cp.compton[k]);
+                output.zone_counters.multiple_scatters.push_back(cp.multiple_scatters[k]);
+            }
+        }
+        zones_reused = zones_computed;
+    } else if (ws.checkpoint) {
+        ws.checkpoint->key.clear();    // until this run reaches z_diss
+    }
+
+    // The zones are computed in three parts: next_zone steps the grid and sets the dynamics, shock
+    // heating and photon fields of the next zone, which depend on the zones before it;
+    // zone_emission computes the particle distribution and the spectra of a zone from those
+    // alone; finish_zone counts the zone and, with adaptive zones, decides whether to stop after
+    // it. With opts.zone_threads, zone_emission runs for several zones at once (see below), which
+    // leaves out the per-zone output, so the zones are only threaded for infosw < 2 and no files.
+    size_t zone_threads = opts.zone_threads;
+    if (zone_threads == 0) {
+        zone_threads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    if (infosw >= 2 || writeToFile) {
+        zone_threads = 1;
+    }
+
+    auto next_zone = [&](zone_task& task) {
         // calculate dynamics/energetics in each zone
-        jetgrid(i, grid, jet_dyn, zone.r, zone.delz, z);
+        if (resume) {
+            resume = false;    // z and the grid zone are those of the checkpoint
+        } else {
+            if (isub == 0) {
+                jetgrid(i, grid, jet_dyn, r_grid, delz_grid, z_grid);
+                nsub = opts.adaptive ? zone_refinement(z_grid, delz_grid, jet_dyn, z_diss, opts.zone_refine) : 1;
+            }
+            z = z_grid + static_cast<double>(isub) * delz_grid / static_cast<double>(nsub);
+        }
+        task.checkpoint = !checkpoint_saved && z >= z_diss;
+        if (task.checkpoint) {
+            // the spectra and counters are added by save_checkpoint, once the zones before this
+            // one have been summed
+            if (!ws.checkpoint) {
+                ws.checkpoint = std::make_shared<zone_checkpoint>();
+            }
+            zone_checkpoint& cp = *ws.checkpoint;
+            cp.i = i, cp.isub = isub, cp.nsub = nsub;
+            cp.z = z, cp.z_grid = z_grid, cp.delz_grid = delz_grid, cp.r_grid = r_grid;
+            cp.tshift = tshift, cp.Ubb1 = Ubb1, cp.Ubb2 = Ubb2;
+            cp.grid = grid, cp.zone = zone, cp.agn_com = agn_com;
+            checkpoint_saved = true;
+        }
+        zone.delz = delz_grid / static_cast<double>(nsub);
         if (velsw == 0) {
             adjetpars(z, jet_dyn, nozzle_ener, tshift, zone, spline_speed, acc_speed);
         } else if (velsw == 1) {
@@ -349,6 +513,9 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
         } else {
             bljetpars(z, jet_dyn, nozzle_ener, tshift, zone, spline_speed, acc_speed);
         }
+        if (isub == 0) {
+            r_grid = zone.r;    // the grid steps with the radius at the start of each grid zone
+        }
         zone.delta = 1. / (zone.gamma * (1. - zone.beta * std::cos(theta * karcst::pi / 180.)));
 
         // This is to avoid crashes due to low (sub 1 kev) particle temperatures
@@ -390,9 +557,70 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
             Urad = Urad + agn_com.urad_total;
         }
 
+        // Shock heating of the particles, from the first zone with non-thermal particles on
+        if (IsShock == false && zone.nth_frac != 0. && zone.nth_frac <= 1.) {
+            t_e = f_heat * t_e;
+            zone.eltemp =
+                std::max(tshift * t_e * std::pow(log10(z_diss) / std::log10(z), f_pl), 1.);
+            IsShock = true;
+        }
+
+        task.i = i;
+        task.shock = IsShock;
+        task.z = z, task.tshift = tshift, task.Urad = Urad, task.Ubb1 = Ubb1, task.Ubb2 = Ubb2;
+        task.z_grid_end = z_grid + delz_grid;
+        task.zone = zone;
+        task.last_sub = (++isub == nsub);
+        if (task.last_sub) {
+            isub = 0;
+            i++;
+        }
+    };
+
+    auto save_checkpoint = [&]() {
+        zone_checkpoint& cp = *ws.checkpoint;
+        cp.zones_computed = zones_computed, cp.truncation = truncation;
+        cp.tot_syn_pre = tot_syn_pre, cp.tot_syn_post = tot_syn_post;
+        cp.tot_com_pre = tot_com_pre, cp.tot_com_post = tot_com_post;
+        cp.zone_start = zone_start, cp.zone_last = zone_last;
+        const JetOutput::ZoneCounters& counters = output.zone_counters;
+        cp.nsyn.assign(counters.nsyn.data(), counters.nsyn.data() + counters.nsyn.size());
+        cp.ncom.assign(counters.ncom.data(), counters.ncom.data() + counters.ncom.size());
+        cp.compton.assign(counters.compton.data(), counters.compton.data() + counters.compton.size());
+        cp.multiple_scatters.assign(
+            counters.multiple_scatters.data(),
+            counters.multiple_scatters.data() + counters.multiple_scatters.size());
+        cp.key = zones_key;
+    };
+
+    // Particle distribution and spectra of the zone of task, summed onto syn_sum and com_sum, with
+    // the splines, particle objects and arrays of zws. The values of the zone below hide those of
+    // next_zone, which is ahead of it when the zones are threaded.
+    auto zone_emission = [&](const zone_task& task, JetWorkspace& zws, StageTimer& timer,
+                             JetOutput::Timings& timings, std::vector<double>& syn_sum,
+                             std::vector<double>& com_sum) {
+        const double z = task.z, tshift = task.tshift, Urad = task.Urad;
+        const double Ubb1 = task.Ubb1, Ubb2 = task.Ubb2;
+        zone_pars zone = task.zone;
+        double gmin = 0.0, gmax = 0.0;    // minimum/maximum Lorentz factors over which to integrate
+
+        // splines for electron distribution
+        gsl_interp_accel* acc_eldis = zws.acc_eldis;
+        gsl_spline* spline_eldis = zws.spline_eldis;
+
+        gsl_interp_accel* acc_deriv = zws.acc_deriv;
+        gsl_spline* spline_deriv = zws.spline_deriv;
+
+        if (writeToFile) {
+            writer.begin_zone(z / Rg, (z + zone.delz) / Rg);
+        } else if (infosw >= 2) {
+            output.begin_zone(z / Rg, (z + zone.delz) / Rg);
+        }
+
         // calculate particle distribution in each zone
+        timer.start();
         if (zone.nth_frac == 0.) {
-            kariba::Thermal th_lep(nel);
+            kariba::Thermal& th_lep = *zws.thermal;
             th_lep.set_temp_kev(zone.eltemp);
             th_lep.set_p();
             th_lep.set_norm(zone.lepdens);
@@ -410,8 +638,8 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
 
             if (infosw >= 2) {
                 if (writeToFile){
-                    plot_write(nel, th_lep.get_p(), th_lep.get_gamma(), th_lep.get_pdens(),
-                               th_lep.get_gdens(), "Output/Numdens.dat");
+                    writer.particles("Numdens", nel, th_lep.get_p(), th_lep.get_gamma(),
+                                     th_lep.get_pdens(), th_lep.get_gdens());
                 } else {
                     store_numdens(nel, th_lep.get_p(), th_lep.get_gamma(), th_lep.get_pdens(),
                                   th_lep.get_gdens(), output.numdens);
@@ -419,13 +647,7 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
                 
             }
         } else if (zone.nth_frac < 0.5) {
-            if (IsShock == false) {
-                t_e = f_heat * t_e;
-                IsShock = true;
-                zone.eltemp =
-                    std::max(tshift * t_e * std::pow(log10(z_diss) / std::log10(z), f_pl), 1.);
-            }
-            kariba::Mixed acc_lep(nel);
+            kariba::Mixed& acc_lep = *zws.mixed;
             acc_lep.set_temp_kev(zone.eltemp);
             acc_lep.set_pspec(pspec);
             acc_lep.set_plfrac(zone.nth_frac);
@@ -455,28 +677,22 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
 
             if (infosw >= 2) {
                 if (writeToFile){
-                    plot_write(nel, acc_lep.get_p(), acc_lep.get_gamma(), acc_lep.get_pdens(),
-                               acc_lep.get_gdens(), "Output/Numdens.dat");
+                    writer.particles("Numdens", nel, acc_lep.get_p(), acc_lep.get_gamma(),
+                                     acc_lep.get_pdens(), acc_lep.get_gdens());
                 } else {
                     store_numdens(nel, acc_lep.get_p(), acc_lep.get_gamma(), acc_lep.get_pdens(),
                                   acc_lep.get_gdens(), output.numdens);
                 }
             }
         } else if (zone.nth_frac < 1.) {
-            if (IsShock == false) {
-                t_e = f_heat * t_e;
-                zone.eltemp =
-                    std::max(tshift * t_e * std::pow(log10(z_diss) / std::log10(z), f_pl), 1.);
-                IsShock = true;
-            }
-            kariba::Thermal dummy_elec(nel);
+            kariba::Thermal& dummy_elec = *zws.thermal;
             dummy_elec.set_temp_kev(zone.eltemp);
             dummy_elec.set_p();
             dummy_elec.set_norm(zone.lepdens);
             dummy_elec.set_ndens();
             double pbrk = dummy_elec.av_p();
 
-            kariba::Bknpower acc_lep(nel);
+            kariba::Bknpower& acc_lep = *zws.bknpower;
             acc_lep.set_pspec1(-2.);
             acc_lep.set_pspec2(pspec);
 
@@ -503,28 +719,22 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
 
             if (infosw >= 2) {
                 if (writeToFile){
-                    plot_write(nel, acc_lep.get_p(), acc_lep.get_gamma(), acc_lep.get_pdens(),
-                               acc_lep.get_gdens(), "Output/Numdens.dat");
+                    writer.particles("Numdens", nel, acc_lep.get_p(), acc_lep.get_gamma(),
+                                     acc_lep.get_pdens(), acc_lep.get_gdens());
                 } else {
                     store_numdens(nel, acc_lep.get_p(), acc_lep.get_gamma(), acc_lep.get_pdens(),
                                   acc_lep.get_gdens(), output.numdens);
                 }
             }
         } else if (zone.nth_frac == 1.) {
-            if (IsShock == false) {
-                t_e = f_heat * t_e;
-                zone.eltemp =
-                    std::max(tshift * t_e * std::pow(log10(z_diss) / std::log10(z), f_pl), 1.);
-                IsShock = true;
-            }
-            kariba::Thermal dummy_elec(nel);
+            kariba::Thermal& dummy_elec = *zws.thermal;
             dummy_elec.set_temp_kev(zone.eltemp);
             dummy_elec.set_p();
             dummy_elec.set_norm(zone.lepdens);
             dummy_elec.set_ndens();
             double pmin = dummy_elec.av_p();
 
-            kariba::Powerlaw acc_lep(nel);
+            kariba::Powerlaw& acc_lep = *zws.powerlaw;
             acc_lep.set_pspec(pspec);
 
             if (f_sc < 10.) {
@@ -549,10 +759,16 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
                             acc_lep.get_gdens_diff().data(), nel);
 
             if (infosw >= 2) {
-                plot_write(nel, acc_lep.get_p(), acc_lep.get_gamma(), acc_lep.get_pdens(),
-                           acc_lep.get_gdens(), "Output/Numdens.dat");
+                if (writeToFile){
+                    writer.particles("Numdens", nel, acc_lep.get_p(), acc_lep.get_gamma(),
+                                     acc_lep.get_pdens(), acc_lep.get_gdens());
+                } else {
+                    store_numdens(nel, acc_lep.get_p(), acc_lep.get_gamma(), acc_lep.get_pdens(),
+                                  acc_lep.get_gdens(), output.numdens);
+                }
             }
         }
+        timer.stop(timings.particles);
         // Note: the energy density below assumes only cold protons
         if (infosw >= 5) {
             double Up, Ue, Ub;
@@ -560,7 +776,6 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
             Up = (zone.lepdens / nozzle_ener.eta) * karcst::pmgm * std::pow(karcst::cee, 2.);
             Ub = std::pow(zone.bfield, 2.) / (8. * karcst::pi);
 
-            std::ofstream file;
             if (!(writeToFile)){
                 output.jet_zone_properties.jet_bfield.push_back(zone.bfield); 
                 output.jet_zone_properties.lepton_ndens.push_back(zone.lepdens); 
@@ -584,10 +799,8 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
                 output.jetprofile.zone_gamma.push_back(zone.gamma); 
                 output.jetprofile.zone_eltemp.push_back(zone.eltemp); 
             } else {
-                file.open("Output/Profiles.dat", std::ios::app);
-                file << z / Rg << " " << zone.r / Rg << " " << zone.bfield << " " << zone.lepdens 
-                     << " " << zone.gamma << " " << zone.eltemp << " \n";
-                file.close();
+                writer.row("Profiles", {z / Rg, zone.r / Rg, zone.bfield, zone.lepdens, zone.gamma,
+                                        zone.eltemp});
             }
             if (verbose) {
                 std::cout << "\n"
@@ -608,33 +821,54 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
         // part, so it needs to include both the black body and disk part. This
         // is why the maximum frequency is taken as the maximum of the two scale
         // frequencies.
-        syn_min = 0.1 * std::pow(gmin, 2.) * karcst::charg * zone.bfield /
-                  (2. * karcst::pi * karcst::emgm * karcst::cee);
+        timer.start();
+        double syn_min = 0.1 * std::pow(gmin, 2.) * karcst::charg * zone.bfield /
+                         (2. * karcst::pi * karcst::emgm * karcst::cee);
+        double syn_max = 0.;
         if (r_in < r_out) {
             syn_max = std::max(50. * std::pow(gmax, 2.) * karcst::charg * zone.bfield /
                                    (2. * karcst::pi * karcst::emgm * karcst::cee),
-                               20. * Disk.tin() * karcst::kboltz / karcst::herg);
+                               20. * ws.disk_tin * karcst::kboltz / karcst::herg);
         } else {
             syn_max = 50. * std::pow(gmax, 2.) * karcst::charg * zone.bfield /
                       (2. * karcst::pi * karcst::emgm * karcst::cee);
         }
-        nsyn = (size_t) (std::log10(syn_max) - std::log10(syn_min)) * syn_res;
-        std::vector<double> syn_en(nsyn, 0.0);
-        std::vector<double> syn_lum(nsyn, 0.0);
+        size_t nsyn = (size_t) (std::log10(syn_max) - std::log10(syn_min)) * syn_res;
+        std::vector<double>& syn_en = zws.syn_en;
+        std::vector<double>& syn_lum = zws.syn_lum;
+        syn_en.assign(nsyn, 0.0);
+        syn_lum.assign(nsyn, 0.0);
         kariba::Cyclosyn Syncro(nsyn);
         Syncro.set_frequency(syn_min, syn_max);
 
-        com_min = 0.1 * Syncro.nu_syn();
-        com_max = ear[ne - 1] / karcst::hkev;
-        ncom = (size_t) (std::log10(com_max) - std::log10(com_min)) * com_res;
-        std::vector<double> com_en(ncom, 0.0);
-        std::vector<double> com_lum(ncom, 0.0);
-        kariba::Compton InvCompton(ncom, nsyn);
-        InvCompton.set_frequency(com_min, com_max);
+        double com_min = 0.1 * Syncro.nu_syn();
+        double com_max = 0.;
+        if (opts.centres) {
+            com_max = tot_en[ne - 1] / karcst::herg;
+        } else {
+            com_max = ear[ne - 1] / karcst::hkev;
+        }
+        // a grid ending below the seed photons still needs a valid Compton frequency range
+        com_max = std::max(com_max, 100. * com_min);
+        size_t ncom = (size_t) (std::log10(com_max) - std::log10(com_min)) * com_res;
+        std::vector<double>& com_en = zws.com_en;
+        std::vector<double>& com_lum = zws.com_lum;
+        com_en.assign(ncom, 0.0);
+        com_lum.assign(ncom, 0.0);
+        // the Compton object is only built if the zone output needs its grid, or if Compton_check
+        // below decides that its spectrum is worth computing
+        std::optional<kariba::Compton> InvCompton;
+        auto make_compton = [&]() {
+            if (!InvCompton) {
+                InvCompton.emplace(ncom, nsyn);
+                InvCompton->set_frequency(com_min, com_max);
+            }
+        };
 
         if (infosw > 1) {
+            make_compton();
             for (size_t k = 0; k < ncom; k++) {
-                com_en[k] = InvCompton.get_energy()[k];
+                com_en[k] = InvCompton->get_energy()[k];
             }
         }
         // Note: initializing these two arrays is only done to plot each zone
@@ -648,7 +882,9 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
         Syncro.set_geometry("cylinder", zone.r, zone.delz);
         Syncro.set_counterjet(true);
         Syncro.cycsyn_spectrum(gmin, gmax, spline_eldis, acc_eldis, spline_deriv, acc_deriv);
-        sum_counterjet(nsyn, Syncro.get_energy_obs(), Syncro.get_nphot_obs(), syn_en, syn_lum);
+        timer.stop(timings.cyclosyn);
+        timer.start();
+        sum_counterjet(nsyn, Syncro.get_energy_obs(), Syncro.get_nphot_obs(), syn_en, syn_lum, zws);
         if (infosw >= 4) {
             if (verbose){
                 Syncro.test();
@@ -656,75 +892,284 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
         }
         // Include zone's emission to the pre/post particle acceleration
         // spectrum
-        if (z < z_diss) {
-            sum_zones(nsyn, ne, syn_en, syn_lum, tot_en, tot_syn_pre);
-        } else {
-            sum_zones(nsyn, ne, syn_en, syn_lum, tot_en, tot_syn_post);
-        }
+        sum_zones(nsyn, ne, syn_en, syn_lum, tot_en, syn_sum, zws);
+        timer.stop(timings.summing);
 
         // calculate inverse Compton spectrum, if it's expected to be bright
         // enough
-        if (Compton_check(IsShock, i, Mbh, jetrat, Urad, velsw, zone) == true) {
+        bool compton_zone = Compton_check(task.shock, task.i, Mbh, jetrat, Urad, velsw, zone);
+        bool multiple_scatters = false;
+        if (compton_zone == true) {
             // if(z>z_max){
             // Set up the calculation by reading in/calculating
             // beaming,volume,counterjet presence,tau
-            InvCompton.set_beaming(theta, zone.beta, zone.delta);
-            InvCompton.set_geometry("cylinder", zone.r, zone.delz);
-            InvCompton.set_counterjet(true);
-            InvCompton.set_tau(zone.lepdens, zone.eltemp);
+            timer.start();
+            make_compton();
+            InvCompton->set_beaming(theta, zone.beta, zone.delta);
+            InvCompton->set_geometry("cylinder", zone.r, zone.delz);
+            InvCompton->set_counterjet(true);
+            InvCompton->set_tau(zone.lepdens, zone.eltemp);
             // Multiple scatters only if ypar and tau are large enough
-            if (InvCompton.get_ypar() > 1.e-2 && InvCompton.get_tau() > 5.e-2) {
-                InvCompton.set_niter(15);
+            if (InvCompton->get_ypar() > 1.e-2 && InvCompton->get_tau() > 5.e-2) {
+                InvCompton->set_niter(15);
+                multiple_scatters = true;
             }
             // Cyclosynchrotron photons are always considered in the scattering
-            InvCompton.cyclosyn_seed(Syncro.get_energy(), Syncro.get_nphot());
+            InvCompton->cyclosyn_seed(Syncro.get_energy(), Syncro.get_nphot());
 
             // Disk photons are included only if the disk is present
             if (r_in < r_out) {
-                InvCompton.shsdisk_seed(Syncro.get_energy(), Disk.tin(), r_in, r_out, Disk.hdisk(),
-                                        z + zone.delz / 2.);
+                InvCompton->shsdisk_seed(Syncro.get_energy(), ws.disk_tin, r_in, r_out,
+                                         ws.disk_hdisk, z + zone.delz / 2.);
             }
             // Black body photons included only if compsw==1
             if (compsw == 1) {
-                InvCompton.bb_seed_k(Syncro.get_energy(), Ubb1, zone.delta * BlackBody.temp_k());
+                InvCompton->bb_seed_k(Syncro.get_energy(), Ubb1, zone.delta * BlackBody.temp_k());
             }
             // AGN photon fields photons are considered only if disk is present
             // and compsw==2
             if (compsw == 2 && r_in < r_out) {
-                InvCompton.bb_seed_k(Syncro.get_energy(), Ubb1, zone.delta * BLR.temp_k());
-                InvCompton.bb_seed_k(Syncro.get_energy(), Ubb2, zone.delta * Torus.temp_k());
+                InvCompton->bb_seed_k(Syncro.get_energy(), Ubb1, zone.delta * BLR.temp_k());
+                InvCompton->bb_seed_k(Syncro.get_energy(), Ubb2, zone.delta * Torus.temp_k());
             }
             // Calculate the spectrum with whichever fields have been invoked
-            InvCompton.compton_spectrum(gmin, gmax, spline_eldis, acc_eldis);
-            sum_counterjet(ncom, InvCompton.get_energy_obs(), InvCompton.get_nphot_obs(), com_en,
-                           com_lum);
+            InvCompton->compton_spectrum(gmin, gmax, spline_eldis, acc_eldis);
+            timer.stop(timings.compton);
+            timer.start();
+            sum_counterjet(ncom, InvCompton->get_energy_obs(), InvCompton->get_nphot_obs(), com_en,
+                           com_lum, zws);
             if ((infosw >= 4) && (verbose)) {
-                InvCompton.test();
+                InvCompton->test();
             }
 
             // Include zone's emission to the pre/post particle acceleration
             // spectrum
-            if (z < z_diss) {
-                sum_zones(ncom, ne, com_en, com_lum, tot_en, tot_com_pre);
-            } else {
-                sum_zones(ncom, ne, com_en, com_lum, tot_en, tot_com_post);
-            }
+            sum_zones(ncom, ne, com_en, com_lum, tot_en, com_sum, zws);
+            timer.stop(timings.summing);
         } else if ((infosw >= 5) && (verbose == true)) {
             std::cout << "Out of the Comptonization region\n";
         }
         if (infosw >= 2) {
             if (writeToFile){
-                plot_write(nsyn, syn_en, syn_lum, "Output/Cyclosyn_zones.dat", dist, redsh);
-                plot_write(ncom, com_en, com_lum, "Output/Compton_zones.dat", dist, redsh);
+                writer.spectrum("Cyclosyn_zones", nsyn, syn_en, syn_lum, dist, redsh);
+                writer.spectrum("Compton_zones", ncom, com_en, com_lum, dist, redsh);
             } else {
                 store_output(nsyn, syn_en, syn_lum, output.cyclosyn_zones, dist, redsh); 
                 store_output(ncom, com_en, com_lum, output.compton_zones, dist, redsh);
             }
         }
+        zone_work work;
+        work.nsyn = nsyn, work.ncom = ncom;
+        work.compton = compton_zone, work.multiple_scatters = multiple_scatters;
+        return work;
+    };
+
+    // Counts a zone that has been summed onto the totals; true if the loop stops after it
+    auto finish_zone = [&](const zone_task& task, const zone_work& work) {
+        if (opts.instrument) {
+            output.zone_counters.nsyn.push_back(static_cast<double>(work.nsyn));
+            output.zone_counters.ncom.push_back(static_cast<double>(work.ncom));
+            output.zone_counters.compton.push_back(work.compton ? 1. : 0.);
+            output.zone_counters.multiple_scatters.push_back(work.multiple_scatters ? 1. : 0.);
+        }
+
+        zones_computed++;
+        if (!task.last_sub) {
+            return false;
+        }
+        // the zones left are estimated by extrapolating the ratio of the contributions of the last
+        // two grid zones geometrically; only past the nozzle, z_acc and z_diss can the loop stop
+        if (opts.adaptive && task.i + 1 < nz) {
+            double nleft = static_cast<double>(nz - task.i - 1);
+            truncation = 0.;
+            for (size_t k = 0; k < ne; k++) {
+                double jet = tot_syn_pre[k] + tot_syn_post[k] + tot_com_pre[k] + tot_com_post[k];
+                double last = jet - zone_start[k];
+                double ratio = zone_last[k] > 0. ? last / zone_last[k] : 1.;
+                double left = (std::abs(1. - ratio) < 1e-6)
+                                  ? last * nleft
+                                  : last * ratio * (1. - std::pow(ratio, nleft)) / (1. - ratio);
+                truncation = std::max(truncation, left / (jet + tot_lum[k]));
+                zone_start[k] = jet;
+                zone_last[k] = last;
+            }
+            if (truncation < opts.zone_tol &&
+                task.z_grid_end > std::max({jet_dyn.h0, z_acc, z_diss})) {
+                return true;
+            }
+        }
+        return false;
+    };
+
+    bool stopped = false;
+    if (zone_threads == 1) {
+        zone_task task;
+        while (!stopped && i < nz) {
+            next_zone(task);
+            if (task.checkpoint) {
+                save_checkpoint();
+            }
+            bool pre = task.z < z_diss;
+            zone_work work = zone_emission(task, ws, timer, timings, pre ? tot_syn_pre : tot_syn_post,
+                                           pre ? tot_com_pre : tot_com_post);
+            stopped = finish_zone(task, work);
+        }
+    } else {
+        // Threaded zones: next_zone sets up the zones left in order (with adaptive zones only
+        // zone_threads at a time, as the loop may stop after any of them), the threads compute
+        // their emission, each zone onto rows of its own, and the rows are summed onto the totals
+        // in the order of the zones, so that the spectra are the same bit for bit as those of
+        // the sequential loop for any number of threads
+        std::vector<zone_task> tasks;
+        std::vector<zone_work> work;
+        std::vector<std::vector<double>>& rows = ws.zone_rows;
+        while (ws.zone_workspaces.size() + 1 < zone_threads) {
+            ws.zone_workspaces.push_back(std::make_unique<JetWorkspace>());
+        }
+        for (auto& zws : ws.zone_workspaces) {
+            zws->log_interp = opts.log_interp;
+        }
+        while (!stopped && i < nz) {
+            tasks.clear();
+            while (i < nz && (!opts.adaptive || tasks.size() < zone_threads)) {
+                tasks.emplace_back();
+                next_zone(tasks.back());
+            }
+            size_t ntasks = tasks.size();
+            size_t nthreads = std::min(zone_threads, ntasks);
+            work.assign(ntasks, zone_work());
+            if (rows.size() < 2 * ntasks) {
+                rows.resize(2 * ntasks);
+            }
+            for (size_t k = 0; k < 2 * ntasks; k++) {
+                rows[k].assign(ne, 0.0);
+            }
+
+            std::atomic<size_t> next_task(0);
+            std::vector<JetOutput::Timings> thread_timings(nthreads);
+            std::vector<std::exception_ptr> errors(nthreads);
+            auto worker = [&](size_t t) {
+                try {
+                    JetWorkspace& zws = (t == 0) ? ws : *ws.zone_workspaces[t - 1];
+                    zws.set_nel(nel);
+                    StageTimer thread_timer(opts.instrument);
+                    for (size_t k = next_task++; k < ntasks; k = next_task++) {
+                        work[k] = zone_emission(tasks[k], zws, thread_timer, thread_timings[t],
+                                                rows[2 * k], rows[2 * k + 1]);
+                    }
+                } catch (...) {
+                    errors[t] = std::current_exception();
+                }
+            };
+            std::vector<std::thread> pool;
+            pool.reserve(nthreads - 1);
+            for (size_t t = 1; t < nthreads; t++) {
+                pool.emplace_back(worker, t);
+            }
+            worker(0);
+            for (auto& thread : pool) {
+                thread.join();
+            }
+            for (const auto& error : errors) {
+                if (error) {
+                    std::rethrow_exception(error);
+                }
+            }
+            // the stage times of the threads add up to more than the wall time of the run
+            for (const auto& thread_timing : thread_timings) {
+                timings.particles += thread_timing.particles;
+                timings.cyclosyn += thread_timing.cyclosyn;
+                timings.compton += thread_timing.compton;
+                timings.summing += thread_timing.summing;
+            }
+
+            timer.start();
+            for (size_t k = 0; k < ntasks && !stopped; k++) {
+                if (tasks[k].checkpoint) {
+                    save_checkpoint();
+                }
+                bool pre = tasks[k].z < z_diss;
+                std::vector<double>& tot_syn = pre ? tot_syn_pre : tot_syn_post;
+                std::vector<double>& tot_com = pre ? tot_com_pre : tot_com_post;
+                for (size_t m = 0; m < ne; m++) {
+                    tot_syn[m] += rows[2 * k][m];
+                    tot_com[m] += rows[2 * k + 1][m];
+                }
+                stopped = finish_zone(tasks[k], work[k]);
+            }
+            timer.stop(timings.summing);
+        }
+    }
+    if (!stopped) {
+        truncation = 0.;
+    }
+    if (opts.adaptive && (infosw >= 3) && (verbose == true)) {
+        std::cout << "Adaptive zones: " << zones_computed << " zones computed, estimated truncation "
+                  << "error: " << truncation << "\n\n";
+    }
+
+    // FINAL STEP: STORE THE SOURCE FRAME SPECTRA, CONVERT THEM TO THE OBSERVED SPECTRUM AND
+    // WRITE/STORE THE OUTPUT
+    src.en = tot_en;
+    src.ext = tot_lum;
+    src.syn_pre = tot_syn_pre;
+    src.syn_post = tot_syn_post;
+    src.com_pre = tot_com_pre;
+    src.com_post = tot_com_post;
+    src.disk_en = Disk.get_energy_obs();
+    src.disk_lum = Disk.get_nphot_obs();
+    if (compsw == 2) {
+        src.bb_en = Torus.get_energy_obs();
+        src.bb_lum = Torus.get_nphot_obs();
+    } else {
+        src.bb_en = BlackBody.get_energy_obs();
+        src.bb_lum = BlackBody.get_nphot_obs();
+    }
+    src.zones_computed = zones_computed;
+    src.zones_reused = zones_reused;
+    src.truncation_error = truncation;
+    src.warnings = base_warnings;
+    observe_spectra(ear, ne, param, photeng, photspec, writeToFile, verbose, output, opts, src,
+                    &writer);
+    if (writeToFile) {
+        writer.write();
+    }
+}
+
+// Final step of jetmain_output: sums the source frame spectra of a run to the total, applies the
+// EBL attenuation and the distance/redshift of the source, and writes/stores the output. This only
+// depends on the observer frame parameters (dist, redsh, EBLsw, infosw) and on src, so it can be
+// repeated without recalculating the jet when nothing else changes. With writeToFile the output
+// files go to writer, which the caller writes afterwards.
+void observe_spectra(std::vector<double>& ear, size_t ne, std::vector<double>& param,
+                     std::vector<double>& photeng, std::vector<double>& photspec,
+                     bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts,
+                     const source_spectra& src, OutputWriter* writer) {
+    double Rg = karcst::gconst * param[0] * karcst::msun / (karcst::cee * karcst::cee);
+    double dist = param[2] * karcst::kpc;
+    double redsh = param[3];
+    double r_0 = param[5] * Rg;
+    int infosw = static_cast<int>(param[26]);
+    int EBLsw = static_cast<int>(param[27]);
+    if (writeToFile && writer == nullptr) {
+        throw std::invalid_argument("observe_spectra needs an OutputWriter to write to file");
     }
 
-    // FINAL STEP: SUM JET COMPONENTS TO TOTAL OUTPUT, WRITE/CLOSE PLOT FILES,
-    // FREE MEMORY
+    output.zones_computed = src.zones_computed;
+    output.zones_reused = src.zones_reused;
+    output.truncation_error = src.truncation_error;
+    for (const JetWarning& warning : src.warnings) {
+        jet_warning(output, warning.code, warning.message, warning.value);
+    }
+    StageTimer timer(opts.instrument);
+
+    std::vector<double> tot_en = src.en;
+    std::vector<double> tot_syn_pre = src.syn_pre;
+    std::vector<double> tot_syn_post = src.syn_post;
+    std::vector<double> tot_com_pre = src.com_pre;
+    std::vector<double> tot_com_post = src.com_post;
+    std::vector<double> tot_lum = src.ext;
+
     for (size_t k = 0; k < ne; k++) {
         tot_lum[k] =
             (tot_lum[k] + tot_syn_pre[k] + tot_syn_post[k] + tot_com_pre[k] + tot_com_post[k]);
@@ -732,49 +1177,53 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
     }
 
     // Apply EBL attenuation factor for extragalactic sources
+    timer.start();
     if (redsh > 0. && EBLsw == 1) {
-        kariba::ebl_atten_gil(tot_en, tot_lum, redsh);    // correction for total luminosity
-        kariba::ebl_atten_gil(tot_en, tot_com_post,
-                              redsh);    // correction for post Compton luminosity
+        // the attenuation only depends on redshift and grid, so it is taken from the EBL cache
+        std::vector<double> ebl_atten;
+        ebl_factors(tot_en, redsh, ebl_atten);
+        for (size_t k = 0; k < ne; k++) {
+            tot_lum[k] = tot_lum[k] * ebl_atten[k];              // correction for total luminosity
+            tot_com_post[k] = tot_com_post[k] * ebl_atten[k];    // and post Compton luminosity
+        }
+    }
+    timer.stop(output.timings.ebl);
+    timer.start();
+    if (opts.centres) {
+        // the grid is already in the source frame, so no interpolation is needed
+        for (size_t k = 0; k < ne; k++) {
+            photeng[k] = std::log10(ear[k] / karcst::hkev);
+            photspec[k] = std::log10(tot_lum[k] * (1. + redsh) /
+                                     (4. * karcst::pi * std::pow(dist, 2.) * karcst::mjy));
+        }
+    } else {
+        output_spectrum(ne, tot_en, tot_lum, photspec, redsh, dist, opts.log_interp);
     }
-    output_spectrum(ne, tot_en, tot_lum, photspec, redsh, dist);
 
     // Output to files and print information on terminal if user requires it
     if (infosw >= 1) {
         if (writeToFile){
-            plot_write(ne, tot_en, tot_syn_pre, "Output/Presyn.dat", dist, redsh);
-            plot_write(ne, tot_en, tot_syn_post, "Output/Postsyn.dat", dist, redsh);
-            plot_write(ne, tot_en, tot_com_pre, "Output/Precom.dat", dist, redsh);
-            plot_write(ne, tot_en, tot_com_post, "Output/Postcom.dat", dist, redsh);
-            plot_write(50, Disk.get_energy_obs(), Disk.get_nphot_obs(), "Output/Disk.dat", dist, redsh);
-            if (compsw == 2) {
-                plot_write(40, Torus.get_energy_obs(), Torus.get_nphot_obs(), "Output/BB.dat", dist,
-                        redsh);
-            } else {
-                plot_write(40, BlackBody.get_energy_obs(), BlackBody.get_nphot_obs(), "Output/BB.dat",
-                        dist, redsh);
-            }
-            plot_write(ne, tot_en, tot_lum, "Output/Total.dat", dist, redsh);
+            writer->spectrum("Presyn", ne, tot_en, tot_syn_pre, dist, redsh);
+            writer->spectrum("Postsyn", ne, tot_en, tot_syn_post, dist, redsh);
+            writer->spectrum("Precom", ne, tot_en, tot_com_pre, dist, redsh);
+            writer->spectrum("Postcom", ne, tot_en, tot_com_post, dist, redsh);
+            writer->spectrum("Disk", 50, src.disk_en, src.disk_lum, dist, redsh);
+            writer->spectrum("BB", 40, src.bb_en, src.bb_lum, dist, redsh);
+            writer->spectrum("Total", ne, tot_en, tot_lum, dist, redsh);
         } else {
             store_output(ne, tot_en, tot_syn_pre, output.presyn, dist, redsh); 
             store_output(ne, tot_en, tot_syn_post, output.postsyn, dist, redsh); 
             store_output(ne, tot_en, tot_com_pre, output.precom, dist, redsh); 
             store_output(ne, tot_en, tot_com_post,output.postcom, dist, redsh);
-            store_output(50, Disk.get_energy_obs(), Disk.get_nphot_obs(), output.disk, dist, redsh); 
-
-            if(compsw==2){
-                store_output(40, Torus.get_energy_obs(), Torus.get_nphot_obs(), output.bb, dist, redsh); 
-            } else {
-                store_output(40, BlackBody.get_energy_obs(), BlackBody.get_nphot_obs(),
-                             output.bb, dist, redsh); 
-            }			
+            store_output(50, src.disk_en, src.disk_lum, output.disk, dist, redsh); 
+            store_output(40, src.bb_en, src.bb_lum, output.bb, dist, redsh); 
             store_output(ne, tot_en, tot_lum, output.total, dist, redsh); 
         }
     }
     if (infosw >= 3) {
         double disk_lum, IC_lum, Xray_lum, Radio_lum, Xray_index, Radio_index, compactness;
-        disk_lum = integrate_lum(50, 0.3 * 2.41e17, 5. * 2.41e17, Disk.get_energy_obs(),
-                                 Disk.get_nphot_obs());
+        disk_lum = integrate_lum(50, 0.3 * 2.41e17, 5. * 2.41e17, src.disk_en,
+                                 src.disk_lum);
         IC_lum = integrate_lum(ne, 0.3 * 2.41e17, 300. * 2.41e17, tot_en, tot_com_pre);
         Xray_lum = integrate_lum(ne, 1. * 2.41e17, 10. * 2.41e17, tot_en, tot_lum);
         Radio_lum = integrate_lum(ne, 4e9, 6e9, tot_en, tot_lum);
@@ -792,11 +1241,8 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
             std::cout << "Jet base compactness: " << compactness << "\n\n";
         }
         if (writeToFile){
-            std::ofstream file;
-            file.open("Output/Spectral_properties.dat", std::ios::app);
-            file << disk_lum << " " << IC_lum << " " << Xray_lum << " " << Radio_lum << " "
-                << Xray_index << " " << Radio_index << " " << compactness << "\n";
-            file.close();
+            writer->row("Spectral_properties", {disk_lum, IC_lum, Xray_lum, Radio_lum, Xray_index,
+                                                Radio_index, compactness});
         } else {
             output.spectral_properties.disk_lum.push_back(disk_lum); 
             output.spectral_properties.IC_lum.push_back(IC_lum); 
@@ -807,15 +1253,13 @@ void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& pa
             output.spectral_properties.jetbase_compactness.push_back(compactness); 
         }
         if (compactness >= 10. * (param[9] / 511.) * std::exp(511. / param[9])) {
-            std::cout << "Possible pair production in the jet base!" << "\n";
-            std::cout << "Lower limit on allowed compactness: "
-                      << 10. * (param[9] / 511.) * std::exp(511. / param[9]) << "\n";
-            std::cout << "Note: this is for a slab, a cylinder allows higher l by a "
-                         "factor of ~10\n";
+            std::ostringstream message;
+            message << "Possible pair production in the jet base!\n"
+                    << "Lower limit on allowed compactness: "
+                    << 10. * (param[9] / 511.) * std::exp(511. / param[9]) << "\n"
+                    << "Note: this is for a slab, a cylinder allows higher l by a factor of ~10";
+            jet_warning(output, WARNING_PAIR_PRODUCTION, message.str(), compactness);
         }
     }
-
-    gsl_spline_free(spline_eldis), gsl_interp_accel_free(acc_eldis);
-    gsl_spline_free(spline_deriv), gsl_interp_accel_free(acc_deriv);
-    gsl_spline_free(spline_speed), gsl_interp_accel_free(acc_speed);
+    timer.stop(output.timings.output);
 }
@@ -1,7 +1,11 @@
 #pragma once
 
 #include "jetoutput.hpp"
+#include "eblcache.hpp"
+#include "jetworkspace.hpp"
+#include "outputwriter.hpp"
 #include <algorithm>
+#include <chrono>
 #include <cmath>
 #include <cstdio>
 #include <cstdlib>
@@ -87,22 +91,125 @@ typedef struct com_pars {
     double urad_total;    // total energy density
 } com_pars;
 
+// Structure with settings of a single run that are not model parameters
+typedef struct run_pars {
+    bool centres = false;    // ear holds the ne observed energies in keV at which the spectrum
+                             // is computed, instead of ne+1 bin edges in keV
+    size_t nz = 100;         // total number of zones
+    size_t nel = 70;         // number of bins of the particle distributions
+    size_t syn_res = 10;     // number of bins per decade in synch frequency
+    size_t com_res = 6;      // number of bins per decade in compton frequency
+    bool adaptive = false;   // adaptive zones: refine near the nozzle, z_acc and z_diss, and stop
+                             // once the remaining zones are negligible
+    double zone_tol = 1e-3;  // largest estimated fraction of the total the skipped zones may add
+    size_t zone_refine = 4;  // number of sub-zones of the refined zones
+    bool instrument = false; // record the time of each stage and the work of each zone in the output
+    std::string output_dir = "Output";    // directory of the output files (with writeToFile)
+    bool output_npz = false; // write them to a single bhjet_output.npz instead of text files
+    bool reuse_zones = true; // start from the zones before z_diss of the previous run in the same
+                             // workspace if the parameters they depend on did not change
+    size_t zone_threads = 1; // threads computing the zones of a run, 0 for one per core
+    bool log_interp = false; // interpolate the spectra on log-uniform grids with the kernels of
+                             // loginterp.hpp instead of Akima splines
+} run_pars;
+
+// Stages of a run and which parameters (in the order of the parameter file) they depend on, in
+// parameter_stages: the disk and external photon fields (step 3), the zones before z_diss, which
+// only hold thermal particles, the zones from z_diss on, and the observer frame step
+// (observe_spectra). The results of a stage kept from an earlier run are only reused while none of
+// the parameters of the stage changed.
+enum JetStage : unsigned {
+    STAGE_EXTERNAL = 1u << 0,
+    STAGE_THERMAL_ZONES = 1u << 1,
+    STAGE_NONTHERMAL_ZONES = 1u << 2,
+    STAGE_OBSERVER = 1u << 3,
+};
+extern const unsigned parameter_stages[28];
+// values of the parameters that the stage depends on
+std::vector<double> stage_key(const std::vector<double>& param, unsigned stage);
+
+// State of the zone loop of jetmain_output at the first zone at or beyond z_diss, kept in the
+// workspace so that the next run can start there if only parameters of the later zones changed
+typedef struct zone_checkpoint {
+    std::vector<double> key;    // stage_key of the thermal zones, energy grid and run options
+    size_t i, isub, nsub, zones_computed;
+    double z, z_grid, delz_grid, r_grid, tshift, Ubb1, Ubb2, truncation;
+    grid_pars grid;
+    zone_pars zone;
+    com_pars agn_com;
+    std::vector<double> tot_syn_pre, tot_syn_post, tot_com_pre, tot_com_post;
+    std::vector<double> zone_start, zone_last;
+    std::vector<double> nsyn, ncom, compton, multiple_scatters;    // zone counters
+} zone_checkpoint;
+
+// Adds the wall time from start() to stop() to a total, if enabled; used for JetOutput::timings
+class StageTimer {
+public:
+    explicit StageTimer(bool enabled) : enabled(enabled) {}
+    void start() {
+        if (enabled) {
+            t0 = std::chrono::steady_clock::now();
+        }
+    }
+    void stop(double& total) {
+        if (enabled) {
+            total += std::chrono::duration<double>(std::chrono::steady_clock::now() - t0).count();
+        }
+    }
+
+private:
+    bool enabled;
+    std::chrono::steady_clock::time_point t0;
+};
+
+// Records a warning in the output of a run, and prints its message unless printing has been turned
+// off with set_print_warnings(false); the switch is shared by all instances and threads
+void jet_warning(JetOutput& output, unsigned code, const std::string& message, double value);
+void set_print_warnings(bool enabled);
+bool get_print_warnings();
+
+// Sets the resolution of opts (nz, nel, syn_res, com_res) to one of the named presets "draft",
+// "standard" (the default values above) or "publication"; returns false for an unknown name
+bool resolution_preset(const std::string& name, run_pars& opts);
+
+// Structure with the source frame spectra of a run, from which the observed spectrum follows
+// given only the observer frame parameters (distance, redshift, EBL switch)
+typedef struct source_spectra {
+    std::vector<double> en;          // energy grid of the total spectrum in erg
+    std::vector<double> ext;         // disk/external photon fields summed onto the grid
+    std::vector<double> syn_pre;     // synchrotron luminosity before/after particle acceleration
+    std::vector<double> syn_post;
+    std::vector<double> com_pre;     // same as above but for inverse Compton
+    std::vector<double> com_post;
+    std::vector<double> disk_en;     // disk spectrum on its own grid
+    std::vector<double> disk_lum;
+    std::vector<double> bb_en;       // black body/torus spectrum on its own grid
+    std::vector<double> bb_lum;
+    size_t zones_computed = 0;       // number of zones (including sub-zones) of the run
+    size_t zones_reused = 0;         // of which taken over from the previous run
+    double truncation_error = 0.;    // estimated fraction of the total missed by stopping early
+    std::vector<JetWarning> warnings;    // warnings about the jet base, raised by every run
+} source_spectra;
+
 void jetmain(std::vector<double>& ear, size_t ne, std::vector<double>& param,
              std::vector<double>& photeng, std::vector<double>& photspec);
 
 void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& param,
              std::vector<double>& photeng, std::vector<double>& photspec,
-             bool writeToFile, bool verbose, JetOutput& output);
-
-void param_write(const std::vector<double>& par, const std::string& path);
-void plot_write(size_t size, const std::vector<double>& en, const std::vector<double>& lum,
-                const std::string& path, double dist, double redshift);
-// void plot_write(size_t size, const std::vector<double> &en, const
-// std::vector<double> &lum, 		const std::string& path, double dist, double
-// redshift);
-void plot_write(size_t size, const std::vector<double>& p, const std::vector<double>& g,
-                const std::vector<double>& pdens, const std::vector<double>& gdens,
-                const std::string& path);
+             bool writeToFile, bool verbose, JetOutput& output,
+             const run_pars& opts = run_pars());
+void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& param,
+             std::vector<double>& photeng, std::vector<double>& photspec,
+             bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts,
+             source_spectra& src);
+void jetmain_output(std::vector<double>& ear, size_t ne, std::vector<double>& param,
+             std::vector<double>& photeng, std::vector<double>& photspec,
+             bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts,
+             source_spectra& src, JetWorkspace& ws);
+void observe_spectra(std::vector<double>& ear, size_t ne, std::vector<double>& param,
+                     std::vector<double>& photeng, std::vector<double>& photspec,
+                     bool writeToFile, bool verbose, JetOutput& output, const run_pars& opts,
+                     const source_spectra& src, OutputWriter* writer = nullptr);
 
 bool Compton_check(bool IsShock, size_t i, double Mbh, double Nj, double Ucom, double velsw,
                    zone_pars& zone);
@@ -110,13 +217,22 @@ bool Compton_check(bool IsShock, size_t i, double Mbh, double Nj, double Ucom, d
 void sum_counterjet(size_t size, const std::vector<double>& input_en,
                     const std::vector<double>& input_lum, std::vector<double>& en,
                     std::vector<double>& lum);
+void sum_counterjet(size_t size, const std::vector<double>& input_en,
+                    const std::vector<double>& input_lum, std::vector<double>& en,
+                    std::vector<double>& lum, JetWorkspace& ws);
 void output_spectrum(size_t size, std::vector<double>& en, std::vector<double>& lum,
-                     std::vector<double>& spec, double redsh, double dist);
+                     std::vector<double>& spec, double redsh, double dist, bool log_interp = false);
 void sum_zones(size_t size_in, size_t size_out, std::vector<double>& input_en,
                std::vector<double>& input_lum, std::vector<double>& en, std::vector<double>& lum);
+void sum_zones(size_t size_in, size_t size_out, std::vector<double>& input_en,
+               std::vector<double>& input_lum, std::vector<double>& en, std::vector<double>& lum,
+               JetWorkspace& ws);
 void sum_ext(size_t size_in, size_t size_out, const std::vector<double>& input_en,
              const std::vector<double>& input_lum, std::vector<double>& en,
              std::vector<double>& lum);
+void sum_ext(size_t size_in, size_t size_out, const std::vector<double>& input_en,
+             const std::vector<double>& input_lum, std::vector<double>& en,
+             std::vector<double>& lum, JetWorkspace& ws);
 double integrate_lum(size_t size, double numin, double numax, const std::vector<double>& input_en,
                      const std::vector<double>& input_lum);
 double photon_index(size_t size, double numin, double numax, const std::vector<double>& input_en,
@@ -130,6 +246,7 @@ void equipartition(int npsw, jet_dynpars& dyn, jet_enpars& en);
 void equipartition(double Nj, jet_dynpars& dyn, jet_enpars& en);
 
 void jetgrid(size_t i, grid_pars& grid, jet_dynpars& dyn, double r, double& delz, double& z);
+size_t zone_refinement(double z, double delz, const jet_dynpars& dyn, double z_diss, size_t refine);
 void isojetpars(double z, jet_dynpars& dyn, jet_enpars& en, double& t, zone_pars& zone,
                 gsl_spline* spline, gsl_interp_accel* acc);
 void adjetpars(double z, jet_dynpars& dyn, jet_enpars& en, double& t, zone_pars& zone,
@@ -142,11 +259,12 @@ void agn_photons_init(double lum, double f1, double f2, com_pars& agn_com);
 void zone_agn_phfields(double z, zone_pars& zone, double& ublr_zone, double& udt_zone,
                        com_pars& agn_com);
 
-void clean_file(std::string path, int check);
+std::string file_header(int check);
 void jetinterp(std::vector<double>& ear, std::vector<double>& energ, std::vector<double>& phot,
                std::vector<double>& photar, size_t ne, size_t newne);
 
 
-void store_output(int size, const std::vector<double>& en, const std::vector<double>& lum, std::vector<DataPoint>& output_vector, double dist, double redsh);
+void store_output(int size, const std::vector<double>& en, const std::vector<double>& lum, ZoneTable& output_table, double dist, double redsh);
+void store_output(int size, const std::vector<double>& en, const std::vector<double>& lum, SpectrumArrays& output_arrays, double dist, double redsh);
 
-void store_numdens(int size, const std::vector<double>& p, const std::vector<double>& g, const std::vector<double>& n_p, const std::vector<double>& n_g, std::vector<NumDenPoint>& output_vector);
+void store_numdens(int size, const std::vector<double>& p, const std::vector<double>& g, const std::vector<double>& n_p, const std::vector<double>& n_g, ZoneTable& output_table);
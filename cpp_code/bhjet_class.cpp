@@ -10,10 +10,34 @@
 #include <sstream>
 #include <cstdlib>
 #include <memory>
+#include <atomic>
+#include <exception>
+#include <filesystem>
+#include <map>
+#include <mutex>
+#include <set>
+#include <thread>
+
+#include <kariba/constants.hpp>
 
 using namespace std;
 
-BhJetClass::BhJetClass() : params(28, 0.0), writeToFile(false), verbose(false) {
+// Separate BhJetClass instances can run concurrently (e.g. with the GIL released): all kariba
+// objects, splines and accumulation arrays are local to jetmain_output or to the workspace of the
+// instance (run_batch uses one workspace per thread), and the GSL error handler is never changed
+// at run time. The only state shared between runs are the output files, so runs that write to the
+// same directory are serialised on the mutex of that directory. Calls on the same instance from
+// several threads are serialised on the recursive mutex of the instance (see lock()), which every
+// run and every method that changes or reads the settings of the runs holds.
+static std::mutex& output_dir_mutex(const std::string& directory) {
+    static std::mutex map_mutex;
+    static std::map<std::string, std::mutex> dir_mutexes;
+    std::lock_guard<std::mutex> lock(map_mutex);
+    return dir_mutexes[std::filesystem::absolute(directory).lexically_normal().string()];
+}
+
+BhJetClass::BhJetClass()
+    : writeToFile(false), verbose(false), npar(28), ne(201), emin(-10), emax(10), params(npar, 0.0) {
     //initializing a vector with 28 elements 
     initialize_parameter_map(); //setting up mapping between the parameter names and their indicies in the file 
     initialize_parameter_units();
@@ -21,6 +45,7 @@ BhJetClass::BhJetClass() : params(28, 0.0), writeToFile(false), verbose(false) {
 
 // read parameters from a file (like .dat, normal) from some file 
 void BhJetClass::load_params(const std::string& file) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
     std::ifstream inFile(file); //opening file 
     if (!inFile) {
         throw std::runtime_error("Cannot open parameter file: " + file);
@@ -168,6 +193,7 @@ void BhJetClass::update_internal_parameters() {
 }
 
 double BhJetClass::get_parameter(const std::string& name) const {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
     auto it = param_name_to_index.find(name); //using the param map created above now 
     if (it != param_name_to_index.end()) {
         size_t index = it->second;
@@ -179,6 +205,7 @@ double BhJetClass::get_parameter(const std::string& name) const {
 
 // this takes a parameter name and a new value to assign to it 
 void BhJetClass::set_parameter(const std::string& name, double value) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
     auto it = param_name_to_index.find(name); //param map 
     if (it != param_name_to_index.end()) {
         size_t index = it->second;
@@ -189,6 +216,28 @@ void BhJetClass::set_parameter(const std::string& name, double value) {
     }
 }
 
+void BhJetClass::set_parameters(const std::unordered_map<std::string, double>& values) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    for (const auto& [name, value] : values) {
+        auto it = param_name_to_index.find(name);
+        if (it == param_name_to_index.end()) {
+            throw std::invalid_argument("Parameter name not found: " + name);
+        }
+        params[it->second] = value;
+    }
+    update_internal_parameters();
+}
+
+void BhJetClass::set_parameter_array(const std::vector<double>& values) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    if (values.size() != static_cast<size_t>(npar)) {
+        throw std::invalid_argument("Parameter array must have " + std::to_string(npar) +
+                                    " values");
+    }
+    std::copy(values.begin(), values.end(), params.begin());
+    update_internal_parameters();
+}
+
 std::vector<std::string> BhJetClass::get_parameter_names() const {
     std::vector<std::string> names;
     names.reserve(param_name_to_index.size());
@@ -203,46 +252,186 @@ const JetOutput& BhJetClass::get_output() const {
     return output;
 }
 
+std::unique_lock<std::recursive_mutex> BhJetClass::lock() const {
+    return std::unique_lock<std::recursive_mutex>(state_mutex);
+}
+
+void BhJetClass::set_energy_grid(const std::vector<double>& energies) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    for (size_t i = 0; i < energies.size(); i++) {
+        if (!(energies[i] > 0.) || (i > 0 && energies[i] <= energies[i - 1])) {
+            throw std::invalid_argument("Energy grid must be positive and strictly increasing");
+        }
+    }
+    grid_energies = energies;
+}
+
+// energy grid handed to jetmain_output: the logarithmic grid of ne bin edges in keV, as in the
+// bhwrap file for running bhjet alone, or the observed energies in keV set by the user
+std::vector<double> BhJetClass::make_energy_bins() const {
+    if (!grid_energies.empty()) {
+        return grid_energies;
+    }
+    double einc = (emax - emin) / static_cast<double>(ne);
+
+    std::vector<double> ebins(ne, 0.0);
+    for (int i = 0; i < ne; i++) {
+        ebins[i] = std::pow(10, (emin + static_cast<double>(i) * einc));
+    }
+    return ebins;
+}
+
+size_t BhJetClass::n_energy_bins() const {
+    return grid_energies.empty() ? ne - 1 : grid_energies.size();
+}
+
+std::vector<double> BhJetClass::get_energy_grid() const {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    std::vector<double> ebins = make_energy_bins();
+    std::vector<double> freq(n_energy_bins(), 0.0);
+    for (size_t i = 0; i < freq.size(); i++) {
+        if (grid_energies.empty()) {
+            freq[i] = (ebins[i] + (ebins[i + 1] - ebins[i]) / 2.) / kariba::constants::hkev;
+        } else {
+            freq[i] = ebins[i] / kariba::constants::hkev;
+        }
+    }
+    return freq;
+}
+
+void BhJetClass::set_resolution(const std::string& preset) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    run_pars opts;
+    if (!resolution_preset(preset, opts)) {
+        throw std::invalid_argument("Unknown resolution preset: " + preset +
+                                    " (use draft, standard or publication)");
+    }
+    set_resolution(opts.nz, opts.nel, opts.syn_res, opts.com_res);
+}
+
+void BhJetClass::set_resolution(size_t nz, size_t nel, size_t syn_res, size_t com_res) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    if (nz < 10 || nel < 10 || syn_res < 1 || com_res < 1) {
+        throw std::invalid_argument("Resolution needs nz >= 10, nel >= 10, syn_res >= 1 and com_res >= 1");
+    }
+    resolution.nz = nz;
+    resolution.nel = nel;
+    resolution.syn_res = syn_res;
+    resolution.com_res = com_res;
+    source_param.clear();    // the source frame spectra of the last run depend on the resolution
+}
+
+std::map<std::string, size_t> BhJetClass::get_resolution() const {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    return {{"nz", resolution.nz}, {"nel", resolution.nel}, {"syn_res", resolution.syn_res},
+            {"com_res", resolution.com_res}};
+}
+
+void BhJetClass::set_adaptive_zones(bool enabled, double tolerance, size_t refine) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    if (!(tolerance > 0.) || refine < 1) {
+        throw std::invalid_argument("Adaptive zones need tolerance > 0 and refine >= 1");
+    }
+    resolution.adaptive = enabled;
+    resolution.zone_tol = tolerance;
+    resolution.zone_refine = refine;
+    source_param.clear();
+}
+
+void BhJetClass::set_zone_reuse(bool enabled) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    resolution.reuse_zones = enabled;
+    source_param.clear();
+}
+
+void BhJetClass::set_zone_threads(size_t nthreads) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    resolution.zone_threads = nthreads;
+    source_param.clear();
+}
+
+void BhJetClass::set_log_interpolation(bool enabled) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    resolution.log_interp = enabled;
+    source_param.clear();
+}
+
+void BhJetClass::set_instrumentation(bool enabled) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    resolution.instrument = enabled;
+    source_param.clear();
+}
+
+void BhJetClass::set_output_files(bool enabled, const std::string& directory,
+                                  const std::string& format) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    if (directory.empty()) {
+        throw std::invalid_argument("The output directory must not be empty");
+    }
+    resolution.output_npz = (OutputWriter::format_from_name(format) == OutputWriter::NPZ);
+    resolution.output_dir = directory;
+    writeToFile = enabled;
+}
+
+const std::vector<double>& BhJetClass::get_total_flux() const {
+    return total_flux_vals;
+}
+
+void BhJetClass::run(const std::vector<double>& energies) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    set_energy_grid(energies);
+    run();
+}
+
+void BhJetClass::run_parameters(const std::vector<double>& param_array) {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    set_parameter_array(param_array);
+    run();
+}
+
 void BhJetClass::run() {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
     // if (!params_loaded) {
     //     throw std::runtime_error("Parameters have not been loaded. Please call load_params() first.");
     // }
 
     // auto start_time = std::chrono::high_resolution_clock::now();
 
-    //this is what was used in the bhwrap file for running bhjet alone ---- 
-    
-    size_t npar = 28;
-    size_t ne = 201;
-    double emin = -10;
-    double emax = 10;
-    double einc = (emax - emin) / static_cast<double>(ne);
+    std::vector<double> ebins = make_energy_bins();
+    size_t nbins = n_energy_bins();
+    std::vector<double> param = params;    // params is already in the order of the parameter file
+    std::vector<double> spec(nbins, 0.0);
+    std::vector<double> dumarr(nbins, 0.0);
 
-    std::vector<double> ebins(ne, 0.0);
-    std::vector<double> param(npar, 0.0);
-    std::vector<double> spec(ne - 1, 0.0);
-    std::vector<double> dumarr(ne - 1, 0.0);
-
-    for (size_t i = 0; i < ne; i++) {
-        ebins[i] = std::pow(10, (emin + static_cast<double>(i) * einc));
-    }
+    run_pars opts = resolution;
+    opts.centres = !grid_energies.empty();
 
     output.clear();
 
-    // invert the mapping
-    std::vector<std::string> param_index_to_name(param_name_to_index.size());
-    for (const auto& [name, index] : param_name_to_index) {
-        param_index_to_name[index] = name;
+    // run the jetmain function, or only redo its observer frame step if nothing else changed
+    if (observer_only(param, ebins)) {
+        observe_spectra(ebins, nbins, param, spec, dumarr, writeToFile, verbose, output, opts,
+                        source);
+    } else if (writeToFile) {
+        source_param.clear();
+        std::lock_guard<std::mutex> lock(output_dir_mutex(opts.output_dir));
+        jetmain_output(ebins, nbins, param, spec, dumarr, writeToFile, verbose, output, opts,
+                       source, workspace);
+    } else {
+        source_param.clear();
+        jetmain_output(ebins, nbins, param, spec, dumarr, writeToFile, verbose, output, opts,
+                       source, workspace);
     }
+    source_param = param;
+    source_ebins = ebins;
 
-    // fill in param array
-    for (size_t i = 0; i < param_index_to_name.size(); ++i) {
-        std::string name = param_index_to_name[i];
-        param[i] = get_parameter(name);
+    // spec holds log10(nu [Hz]) and dumarr log10(flux [mJy]) on the observed grid
+    energy_grid.resize(nbins);
+    total_flux_vals.resize(nbins);
+    for (size_t k = 0; k < nbins; k++) {
+        energy_grid[k] = std::pow(10., spec[k]);
+        total_flux_vals[k] = std::pow(10., dumarr[k]);
     }
- 
-    // run the jetmain function: 
-    jetmain_output(ebins, ne - 1, param, spec, dumarr, writeToFile, verbose, output);
 
     // Stop the timer
     // auto end_time = std::chrono::high_resolution_clock::now();
@@ -252,3 +441,198 @@ void BhJetClass::run() {
     // std::cout << "run() execution time: " << elapsed_time.count() << " seconds" << std::endl;
 
 }
+
+// True if the source frame spectra of the last run can be reused: since then only the distance,
+// redshift, EBL switch or infosw (below 2, as the zone output depends on distance and redshift)
+// changed, on the same energy grid. A user energy grid is moved to the source frame with the
+// redshift, so in that case the redshift has to be the same as well.
+bool BhJetClass::observer_only(const std::vector<double>& param,
+                               const std::vector<double>& ebins) const {
+    if (source_param.empty() || writeToFile || infosw >= 2 || ebins != source_ebins) {
+        return false;
+    }
+    for (const auto& [name, index] : param_name_to_index) {
+        bool observer_par = (name == "dist" || name == "EBLsw" || name == "infosw" ||
+                             (name == "redsh" && grid_energies.empty()));
+        if (!observer_par && param[index] != source_param[index]) {
+            return false;
+        }
+    }
+    return true;
+}
+
+// Runs the model for every row of a flattened (nrows, npar) parameter matrix and returns the
+// flattened (nrows, nbins) matrix of total fluxes in mJy on the grid of get_energy_grid(). The rows
+// are handed out to nthreads native threads (0 means one per hardware core); every row gets its
+// own JetOutput, and nothing is written to file, so the instance itself is left untouched.
+std::vector<double> BhJetClass::run_batch(const std::vector<double>& param_matrix,
+                                          size_t nthreads) const {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    if (param_matrix.size() % npar != 0) {
+        throw std::invalid_argument("Parameter matrix must have " + std::to_string(npar) +
+                                    " values per row");
+    }
+    size_t nrows = param_matrix.size() / npar;
+    size_t nbins = n_energy_bins();
+
+    std::vector<double> ebins = make_energy_bins();
+    std::vector<double> spectra(nrows * nbins, 0.0);
+    run_pars opts = resolution;
+    opts.centres = !grid_energies.empty();
+    opts.zone_threads = 1;    // the rows are already spread over the threads
+
+    if (nthreads == 0) {
+        nthreads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    nthreads = std::max<size_t>(1, std::min(nthreads, nrows));
+
+    std::atomic<size_t> next_row(0);
+    std::vector<std::exception_ptr> errors(nthreads);
+
+    auto worker = [&](size_t t) {
+        try {
+            std::vector<double> param(npar, 0.0);
+            std::vector<double> photeng(nbins, 0.0);
+            std::vector<double> photspec(nbins, 0.0);
+            JetOutput row_output;
+            source_spectra row_source;
+            JetWorkspace row_workspace;
+
+            for (size_t row = next_row++; row < nrows; row = next_row++) {
+                std::copy(param_matrix.begin() + row * npar,
+                          param_matrix.begin() + (row + 1) * npar, param.begin());
+                row_output.clear();
+                jetmain_output(ebins, nbins, param, photeng, photspec, false, false, row_output,
+                               opts, row_source, row_workspace);
+                for (size_t k = 0; k < nbins; k++) {
+                    spectra[row * nbins + k] = std::pow(10., photspec[k]);
+                }
+            }
+        } catch (...) {
+            errors[t] = std::current_exception();
+        }
+    };
+
+    std::vector<std::thread> pool;
+    pool.reserve(nthreads - 1);
+    for (size_t t = 1; t < nthreads; t++) {
+        pool.emplace_back(worker, t);
+    }
+    worker(0);
+    for (auto& thread : pool) {
+        thread.join();
+    }
+
+    for (const auto& error : errors) {
+        if (error) {
+            std::rethrow_exception(error);
+        }
+    }
+    return spectra;
+}
+
+// Parameters that span decades: the jacobian steps them by a factor 10^(+-step) instead of by
+// step times their value, so that the step is the same fraction of a decade at any scale
+static bool log_step_parameter(const std::string& name) {
+    static const std::set<std::string> names = {"Mbh", "dist", "jetrat", "r_0", "z_diss", "z_acc",
+                                                "z_max", "t_e", "f_nth", "f_sc", "sig_acc", "l_disk",
+                                                "r_in", "r_out", "compar1", "compar2"};
+    return names.count(name) > 0;
+}
+
+// Parameters that cannot be negative: the jacobian takes a one-sided difference instead of a
+// central one where the lower step would go below zero. pspec and l_disk (whose sign selects the
+// disk model) are not bounded.
+static bool non_negative_parameter(const std::string& name) {
+    return name != "pspec" && name != "l_disk";
+}
+
+// Finite difference derivatives of the total flux (mJy per unit of each parameter) on the grid of
+// get_energy_grid() with respect to the free parameters, as a flattened (nfree, nbins) matrix.
+// All perturbed models run concurrently in run_batch. Central differences need two runs per
+// parameter; forward differences need one, and reuse the spectrum of the last run when it was
+// made with the same parameters and energy grid. An empty param_array means the parameters of the
+// instance; steps holds one relative (or, for log_step_parameter, dex) step or one per parameter.
+// Parameters at or close to zero that cannot be negative get a forward difference.
+std::vector<double> BhJetClass::jacobian(const std::vector<double>& param_array,
+                                         const std::vector<std::string>& free,
+                                         const std::vector<double>& steps, bool central,
+                                         size_t nthreads) const {
+    std::lock_guard<std::recursive_mutex> guard(state_mutex);
+    std::vector<double> base = param_array.empty() ? params : param_array;
+    if (base.size() != static_cast<size_t>(npar)) {
+        throw std::invalid_argument("Parameter array must have " + std::to_string(npar) +
+                                    " values");
+    }
+    if (steps.size() != 1 && steps.size() != free.size()) {
+        throw std::invalid_argument("Need one step or one step per free parameter");
+    }
+    base[param_name_to_index.at("infosw")] = 0.;    // only the total flux is needed
+
+    size_t nfree = free.size();
+    size_t nbins = n_energy_bins();
+    std::vector<double> rows, lower(nfree), upper(nfree);
+    for (size_t i = 0; i < nfree; i++) {
+        auto it = param_name_to_index.find(free[i]);
+        if (it == param_name_to_index.end()) {
+            throw std::invalid_argument("Parameter name not found: " + free[i]);
+        }
+        if (free[i] == "compsw" || free[i] == "velsw" || free[i] == "infosw" || free[i] == "EBLsw") {
+            throw std::invalid_argument("Cannot differentiate with respect to the switch " + free[i]);
+        }
+        double value = base[it->second];
+        double step = steps.size() == 1 ? steps[0] : steps[i];
+        if (!(step > 0.)) {
+            throw std::invalid_argument("Step of " + free[i] + " must be positive");
+        }
+        bool bounded = non_negative_parameter(free[i]);
+        if (bounded && value < 0.) {
+            throw std::invalid_argument("Cannot differentiate with respect to " + free[i] +
+                                        " at a negative value");
+        }
+        if (log_step_parameter(free[i]) && value > 0.) {
+            upper[i] = value * std::pow(10., step);
+            lower[i] = central ? value * std::pow(10., -step) : value;
+        } else {
+            // a step below zero of a parameter that cannot be negative is replaced by no step, which
+            // makes the central difference a forward one
+            double delta = step * (value != 0. ? std::abs(value) : 1.);
+            upper[i] = value + delta;
+            lower[i] = central && !(bounded && value - delta < 0.) ? value - delta : value;
+        }
+        for (double perturbed : central ? std::vector<double>{upper[i], lower[i]}
+                                        : std::vector<double>{upper[i]}) {
+            size_t row = rows.size();
+            rows.insert(rows.end(), base.begin(), base.end());
+            rows[row + it->second] = perturbed;
+        }
+    }
+
+    // forward differences are taken from the unperturbed spectrum, from the last run if possible
+    bool reuse = false;
+    if (!central && !source_param.empty() && make_energy_bins() == source_ebins &&
+        total_flux_vals.size() == nbins) {
+        reuse = true;
+        for (const auto& [name, index] : param_name_to_index) {
+            if (name != "infosw" && base[index] != source_param[index]) {
+                reuse = false;
+            }
+        }
+    }
+    if (!central && !reuse) {
+        rows.insert(rows.end(), base.begin(), base.end());
+    }
+
+    std::vector<double> spectra = run_batch(rows, nthreads);
+    const double* unperturbed = reuse ? total_flux_vals.data() : spectra.data() + nfree * nbins;
+
+    std::vector<double> derivatives(nfree * nbins, 0.0);
+    for (size_t i = 0; i < nfree; i++) {
+        const double* up = spectra.data() + (central ? 2 * i : i) * nbins;
+        const double* down = central ? up + nbins : unperturbed;
+        for (size_t k = 0; k < nbins; k++) {
+            derivatives[i * nbins + k] = (up[k] - down[k]) / (upper[i] - lower[i]);
+        }
+    }
+    return derivatives;
+}
@@ -2,6 +2,9 @@
 
 
 #include "jetoutput.hpp" 
+#include "bhjet.hpp"
+#include <map>
+#include <mutex>
 #include <unordered_map>
 #include <vector>
 #include <string>
@@ -13,16 +16,64 @@ public:
     void load_params(const std::string& file);
     void print_parameters() const; 
     void run();
+    void run(const std::vector<double>& energies);
+    void run_parameters(const std::vector<double>& param_array);
+    std::vector<double> run_batch(const std::vector<double>& param_matrix, size_t nthreads = 0) const;
+    // finite difference derivatives of the total flux with respect to the free parameters, computed
+    // with run_batch; a flattened (free.size(), nbins) matrix in mJy per unit of each parameter
+    std::vector<double> jacobian(const std::vector<double>& param_array,
+                                 const std::vector<std::string>& free,
+                                 const std::vector<double>& steps, bool central = true,
+                                 size_t nthreads = 0) const;
     // void run_singlezone();
     const JetOutput& get_output() const;
+    // the runs and setters of an instance hold its lock, so that threads sharing the instance take
+    // turns; holding it also keeps the output of the last run from being replaced while it is read
+    std::unique_lock<std::recursive_mutex> lock() const;
 
     //Accessing parameters by name in python 
     double get_parameter(const std::string& name) const;
     void set_parameter(const std::string& name, double value);
+    // setting many parameters at once updates the internal parameters only once; the array holds
+    // all npar parameters in the order of the parameter file
+    void set_parameters(const std::unordered_map<std::string, double>& values);
+    void set_parameter_array(const std::vector<double>& values);
 
     // expose parameter names to Python
     std::vector<std::string> get_parameter_names() const;
 
+    // observed energies (keV) at which to compute the spectrum; an empty grid restores the
+    // default ne log-spaced bins between 10^emin and 10^emax keV
+    void set_energy_grid(const std::vector<double>& energies);
+    // observed frequencies (Hz) of the spectral bins returned by run/run_batch
+    std::vector<double> get_energy_grid() const;
+    const std::vector<double>& get_total_flux() const;
+
+    // resolution of the runs: a named preset ("draft", "standard", "publication") or the number of
+    // zones, particle distribution bins and synchrotron/Compton bins per decade
+    void set_resolution(const std::string& preset);
+    void set_resolution(size_t nz, size_t nel, size_t syn_res, size_t com_res);
+    std::map<std::string, size_t> get_resolution() const;
+    // adaptive zones: the grid zones near the nozzle, z_acc and z_diss are split in refine sub-zones,
+    // and the outer zones are skipped once they are estimated to add less than a fraction tolerance
+    // of the total at every energy
+    void set_adaptive_zones(bool enabled, double tolerance = 1e-3, size_t refine = 4);
+    // keep the state of the jet at z_diss, so that the next run only computes the zones from z_diss
+    // on if only the non-thermal parameters changed (on by default)
+    void set_zone_reuse(bool enabled);
+    // compute the zones of a run in nthreads threads (0 means one per hardware core, 1 turns it off);
+    // the spectrum is the same as with one thread, but the per-zone output (infosw >= 2) is not
+    void set_zone_threads(size_t nthreads);
+    // interpolate the spectra on log-uniform grids with the kernels of loginterp.hpp instead of Akima
+    // splines (off by default): faster, within the tolerance documented in loginterp.hpp
+    void set_log_interpolation(bool enabled);
+    // record the wall time of each stage and the work of each zone of the runs in the output
+    void set_instrumentation(bool enabled);
+    // write the output files of the runs (infosw >= 1) to directory, as text files or as a single
+    // npz file ("text" or "npz"), instead of storing them in the JetOutput
+    void set_output_files(bool enabled, const std::string& directory = "Output",
+                          const std::string& format = "text");
+
     double Mbh, Eddlum, Rg, theta, dist, redsh, jetrat, zmin, r_0, h, z_acc, z_diss, z_max, t_e;
     double f_nth, f_pl, pspec, f_heat, f_beta, f_sc, p_beta, sig_acc, l_disk, r_in, r_out;
     double compar1, compar2, compar3, compsw, velsw;
@@ -34,6 +85,8 @@ private:
     int npar, ne;
     double emin, emax;
     bool params_loaded = false; //Checking if parameters were loaded first before running code 
+    std::vector<double> grid_energies; // user energy grid in keV, empty for the default grid
+    run_pars resolution; // settings of the runs: resolution, adaptive zones, instrumentation, output files
 
     std::vector<double> params;
     std::vector<std::pair<std::string, std::string>> param_units; // Add units map
@@ -42,7 +95,17 @@ private:
     void initialize_parameter_map();
     void initialize_parameter_units();
 
+    mutable std::recursive_mutex state_mutex;    // see lock()
     JetOutput output;  // JetOutput instance to store results, maybe should change to be more detailed per output type: 
 
     void update_internal_parameters();
+
+    // source frame spectra of the last run, reused when only observer frame parameters change
+    source_spectra source;
+    std::vector<double> source_param, source_ebins;
+    bool observer_only(const std::vector<double>& param, const std::vector<double>& ebins) const;
+    // splines and arrays reused by every run of this instance
+    JetWorkspace workspace;
+    std::vector<double> make_energy_bins() const;
+    size_t n_energy_bins() const;
 };
@@ -0,0 +1,414 @@
+// Native parameter sweep: runs BHJet for every row of a parameter table on all cores with OpenMP,
+// without Python, e.g. in a batch queue. The results go to memory mapped .npy files in the output
+// directory, which numpy.load(..., mmap_mode="r") opens without copying (or pybhjet.load_sweep):
+//
+//   params.npy               (N, 28) parameters of every row, in the order of the parameter file
+//   frequencies.npy          (nbins,) observed frequencies [Hz] of the spectra
+//   spectra.npy              (N, nbins) total flux [mJy]
+//   spectral_properties.npy  (N, 7) columns of Spectral_properties.dat (infosw is raised to 3)
+//   status.npy               (N,) 0 not run yet, 1 done, 2 failed
+//
+// A row is marked done only after its results are in the mapped files, and the files are flushed
+// to disk every --sync seconds and at the end, so a job that is killed (or stopped with SIGINT or
+// SIGTERM) resumes with the rows that are not done when it is started again with the same table
+// and output directory.
+//
+// usage: bhsweep <table.csv|table.npy|table.bin> <output directory> [options]
+//   --base FILE        parameter file with the parameters the table does not set
+//   --threads N        number of OpenMP threads (default: all cores)
+//   --energies FILE    observed energies [keV] to compute the spectra on, one per line
+//   --resolution NAME  resolution preset (draft, standard, publication)
+//   --sync SECONDS     interval between flushes of the output to disk (default 60)
+//
+// A CSV table has one row per run, with either all 28 parameters or the columns named in a first
+// line of parameter names (other parameters from --base); lines starting with # are skipped. A
+// .npy table holds a float64 (N, 28) array, a .bin table the N*28 raw float64 values.
+
+#include <algorithm>
+#include <atomic>
+#include <cctype>
+#include <cerrno>
+#include <csignal>
+#include <cstdlib>
+#include <cstring>
+#include <filesystem>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#else
+static int omp_get_max_threads() { return 1; }
+static void omp_set_num_threads(int) {}
+static double omp_get_wtime() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+#endif
+
+#include "bhjet_class.hpp"
+#include "outputwriter.hpp"
+
+namespace fs = std::filesystem;
+
+static const std::vector<std::string> parameter_names = {
+    "Mbh", "theta", "dist", "redsh", "jetrat", "r_0", "z_diss", "z_acc", "z_max", "t_e",
+    "f_nth", "f_pl", "pspec", "f_heat", "f_beta", "f_sc", "p_beta", "sig_acc", "l_disk", "r_in",
+    "r_out", "compar1", "compar2", "compar3", "compsw", "velsw", "infosw", "EBLsw"};
+static const size_t npar = 28;
+static const size_t nprop = 7;
+
+enum RowStatus : unsigned char { ROW_PENDING = 0, ROW_DONE = 1, ROW_FAILED = 2 };
+
+static std::atomic<bool> stop_requested(false);
+
+static void request_stop(int) {
+    stop_requested = true;
+}
+
+// A .npy file mapped into memory; it is created (filled with zeros) if it does not exist yet or
+// holds an array of another type or shape, and opened as it is otherwise.
+class MappedNpy {
+public:
+    MappedNpy(const std::string& path, const std::string& descr, const std::vector<size_t>& shape,
+              size_t itemsize)
+        : path(path) {
+        std::string header = npy_header(descr, shape);
+        size_t count = 1;
+        for (size_t dim : shape) {
+            count *= dim;
+        }
+        size = header.size() + count * itemsize;
+
+        created = !matches(header);
+        fd = open(path.c_str(), O_RDWR | O_CREAT | (created ? O_TRUNC : 0), 0644);
+        if (fd < 0 || (created && (ftruncate(fd, static_cast<off_t>(size)) != 0 ||
+                                   pwrite(fd, header.data(), header.size(), 0) !=
+                                       static_cast<ssize_t>(header.size())))) {
+            throw std::runtime_error("Cannot create " + path + ": " + std::strerror(errno));
+        }
+        map = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+        if (map == MAP_FAILED) {
+            throw std::runtime_error("Cannot map " + path + ": " + std::strerror(errno));
+        }
+        data = static_cast<char*>(map) + header.size();
+    }
+    ~MappedNpy() {
+        if (map != MAP_FAILED) {
+            munmap(map, size);
+        }
+        if (fd >= 0) {
+            close(fd);
+        }
+    }
+    MappedNpy(const MappedNpy&) = delete;
+    MappedNpy& operator=(const MappedNpy&) = delete;
+
+    template <typename T>
+    T* as() { return reinterpret_cast<T*>(data); }
+
+    void sync() { msync(map, size, MS_SYNC); }
+
+    bool created = false;
+
+private:
+    // true if the file exists with exactly this header and size
+    bool matches(const std::string& header) const {
+        std::ifstream file(path, std::ios::binary);
+        if (!file || fs::file_size(path) != size) {
+            return false;
+        }
+        std::string existing(header.size(), '\0');
+        file.read(&existing[0], static_cast<std::streamsize>(existing.size()));
+        return existing == header;
+    }
+
+    std::string path;
+    size_t size = 0;
+    int fd = -1;
+    void* map = MAP_FAILED;
+    char* data = nullptr;
+};
+
+static std::vector<double> read_values(const std::string& path) {
+    std::ifstream file(path);
+    if (!file) {
+        throw std::runtime_error("Cannot open " + path);
+    }
+    std::vector<double> values;
+    std::string line;
+    while (std::getline(file, line)) {
+        line.erase(0, line.find_first_not_of(" \t\r"));
+        if (!line.empty() && line[0] != '#') {
+            values.push_back(std::atof(line.c_str()));
+        }
+    }
+    return values;
+}
+
+// parameter table of a CSV file: columns of the header (or all parameters), others from base
+static std::vector<double> read_csv(const std::string& path, const std::vector<double>& base,
+                                    bool have_base) {
+    std::ifstream file(path);
+    if (!file) {
+        throw std::runtime_error("Cannot open parameter table " + path);
+    }
+    std::vector<size_t> columns;
+    std::vector<double> table;
+    std::string line;
+    size_t line_nb = 0;
+    while (std::getline(file, line)) {
+        line_nb++;
+        line.erase(0, line.find_first_not_of(" \t\r"));
+        if (line.empty() || line[0] == '#') {
+            continue;
+        }
+        std::replace(line.begin(), line.end(), ',', ' ');
+        std::istringstream fields(line);
+        std::vector<std::string> tokens;
+        for (std::string token; fields >> token;) {
+            tokens.push_back(token);
+        }
+
+        if (columns.empty() && table.empty() && std::isalpha(static_cast<unsigned char>(tokens[0][0]))) {
+            for (const auto& name : tokens) {
+                auto it = std::find(parameter_names.begin(), parameter_names.end(), name);
+                if (it == parameter_names.end()) {
+                    throw std::runtime_error("Unknown parameter in the table header: " + name);
+                }
+                columns.push_back(static_cast<size_t>(it - parameter_names.begin()));
+            }
+            if (columns.size() < npar && !have_base) {
+                throw std::runtime_error("The table sets " + std::to_string(columns.size()) +
+                                         " parameters; give the others with --base");
+            }
+            continue;
+        }
+        if (columns.empty()) {
+            for (size_t k = 0; k < npar; k++) {
+                columns.push_back(k);
+            }
+        }
+        if (tokens.size() != columns.size()) {
+            throw std::runtime_error(path + ":" + std::to_string(line_nb) + ": expected " +
+                                     std::to_string(columns.size()) + " values");
+        }
+        table.insert(table.end(), base.begin(), base.end());
+        double* row = &table[table.size() - npar];
+        for (size_t k = 0; k < columns.size(); k++) {
+            row[columns[k]] = std::atof(tokens[k].c_str());
+        }
+    }
+    return table;
+}
+
+// parameter table of a float64 (N, 28) .npy file or of raw float64 values
+static std::vector<double> read_binary(const std::string& path) {
+    std::ifstream file(path, std::ios::binary);
+    if (!file) {
+        throw std::runtime_error("Cannot open parameter table " + path);
+    }
+    std::string contents((std::istreambuf_iterator<char>(file)), std::istreambuf_iterator<char>());
+    size_t offset = 0;
+    if (fs::path(path).extension() == ".npy") {
+        if (contents.size() < 10 || contents.compare(0, 6, "\x93NUMPY") != 0) {
+            throw std::runtime_error(path + " is not a .npy file");
+        }
+        size_t major = static_cast<unsigned char>(contents[6]);
+        size_t length = static_cast<unsigned char>(contents[8]) |
+                        static_cast<size_t>(static_cast<unsigned char>(contents[9])) << 8;
+        offset = 10 + length;
+        if (major >= 2) {
+            length |= static_cast<size_t>(static_cast<unsigned char>(contents[10])) << 16 |
+                      static_cast<size_t>(static_cast<unsigned char>(contents[11])) << 24;
+            offset = 12 + length;
+        }
+        std::string header = contents.substr(0, offset);
+        if (header.find("'<f8'") == std::string::npos ||
+            header.find("'fortran_order': False") == std::string::npos ||
+            header.find(", " + std::to_string(npar) + ")") == std::string::npos) {
+            throw std::runtime_error(path + " must hold a C ordered float64 (N, 28) array");
+        }
+    }
+    if ((contents.size() - offset) % (npar * sizeof(double)) != 0) {
+        throw std::runtime_error(path + " does not hold a whole number of rows of 28 float64");
+    }
+    std::vector<double> table((contents.size() - offset) / sizeof(double));
+    std::memcpy(table.data(), contents.data() + offset, table.size() * sizeof(double));
+    return table;
+}
+
+int main(int argc, char* argv[]) {
+    if (argc < 3) {
+        std::cerr << "usage: " << argv[0] << " <table.csv|table.npy|table.bin> <output directory> "
+                  << "[--base FILE] [--threads N] [--energies FILE] [--resolution NAME] "
+                  << "[--sync SECONDS]\n";
+        return EXIT_FAILURE;
+    }
+    std::string table_path = argv[1];
+    fs::path out_dir = argv[2];
+    std::string base_file, energies_file, resolution;
+    int nthreads = omp_get_max_threads();
+    double sync_interval = 60.;
+    for (int i = 3; i < argc; i++) {
+        std::string option = argv[i];
+        if (i + 1 >= argc) {
+            std::cerr << "Missing value of " << option << "\n";
+            return EXIT_FAILURE;
+        }
+        std::string value = argv[++i];
+        if (option == "--base") {
+            base_file = value;
+        } else if (option == "--threads") {
+            nthreads = std::max(1, std::atoi(value.c_str()));
+        } else if (option == "--energies") {
+            energies_file = value;
+        } else if (option == "--resolution") {
+            resolution = value;
+        } else if (option == "--sync") {
+            sync_interval = std::atof(value.c_str());
+        } else {
+            std::cerr << "Unknown option " << option << "\n";
+            return EXIT_FAILURE;
+        }
+    }
+
+    try {
+        // the instance of every thread is set up like this one
+        BhJetClass setup;
+        std::vector<double> base(npar, 0.0);
+        if (!base_file.empty()) {
+            setup.load_params(base_file);
+            for (size_t k = 0; k < npar; k++) {
+                base[k] = setup.get_parameter(parameter_names[k]);
+            }
+        }
+        std::vector<double> energies;
+        if (!energies_file.empty()) {
+            energies = read_values(energies_file);
+            setup.set_energy_grid(energies);
+        }
+        if (!resolution.empty()) {
+            setup.set_resolution(resolution);
+        }
+
+        std::string extension = fs::path(table_path).extension().string();
+        std::vector<double> table = (extension == ".npy" || extension == ".bin")
+                                        ? read_binary(table_path)
+                                        : read_csv(table_path, base, !base_file.empty());
+        size_t nrows = table.size() / npar;
+        std::vector<double> frequencies = setup.get_energy_grid();
+        size_t nbins = frequencies.size();
+
+        fs::create_directories(out_dir);
+        MappedNpy params((out_dir / "params.npy").string(), "<f8", {nrows, npar}, sizeof(double));
+        MappedNpy spectra((out_dir / "spectra.npy").string(), "<f8", {nrows, nbins}, sizeof(double));
+        MappedNpy properties((out_dir / "spectral_properties.npy").string(), "<f8", {nrows, nprop},
+                             sizeof(double));
+        MappedNpy freqs((out_dir / "frequencies.npy").string(), "<f8", {nbins}, sizeof(double));
+        MappedNpy status((out_dir / "status.npy").string(), "|u1", {nrows}, 1);
+
+        // a checkpoint only belongs to the same table and energy grid
+        bool resume = !params.created && !status.created && !spectra.created &&
+                      std::equal(table.begin(), table.end(), params.as<double>()) &&
+                      std::equal(frequencies.begin(), frequencies.end(), freqs.as<double>());
+        if (!resume) {
+            std::copy(table.begin(), table.end(), params.as<double>());
+            std::copy(frequencies.begin(), frequencies.end(), freqs.as<double>());
+            std::fill(status.as<unsigned char>(), status.as<unsigned char>() + nrows, ROW_PENDING);
+        }
+        unsigned char* row_status = status.as<unsigned char>();
+        size_t todo = static_cast<size_t>(
+            std::count_if(row_status, row_status + nrows, [](unsigned char s) { return s != ROW_DONE; }));
+        std::cout << (resume ? "Resuming " : "Starting ") << "sweep of " << nrows << " rows, "
+                  << todo << " to run on " << nthreads << " threads\n";
+
+        std::signal(SIGINT, request_stop);
+        std::signal(SIGTERM, request_stop);
+
+        double start = omp_get_wtime();
+        double last_sync = start;
+        std::atomic<size_t> completed(0), failed(0);
+        omp_set_num_threads(nthreads);
+
+#pragma omp parallel
+        {
+            BhJetClass model;
+            if (!base_file.empty()) {
+                model.load_params(base_file);
+            }
+            if (!energies.empty()) {
+                model.set_energy_grid(energies);
+            }
+            if (!resolution.empty()) {
+                model.set_resolution(resolution);
+            }
+            std::vector<double> param(npar);
+
+#pragma omp for schedule(dynamic, 1)
+            for (size_t row = 0; row < nrows; row++) {
+                if (row_status[row] == ROW_DONE || stop_requested) {
+                    continue;
+                }
+                std::copy(table.begin() + row * npar, table.begin() + (row + 1) * npar, param.begin());
+                param[26] = std::max(param[26], 3.);    // infosw >= 3 for the spectral properties
+                try {
+                    model.run_parameters(param);
+                    const std::vector<double>& flux = model.get_total_flux();
+                    std::copy(flux.begin(), flux.end(), spectra.as<double>() + row * nbins);
+                    const auto& sp = model.get_output().spectral_properties;
+                    if (sp.disk_lum.empty()) {
+                        throw std::runtime_error("the run returned no spectral properties");
+                    }
+                    double values[nprop] = {sp.disk_lum.back(), sp.IC_lum.back(),
+                                            sp.xray_lum.back(), sp.radio_lum.back(),
+                                            sp.xray_index.back(), sp.radio_index.back(),
+                                            sp.jetbase_compactness.back()};
+                    std::copy(values, values + nprop, properties.as<double>() + row * nprop);
+                    std::atomic_thread_fence(std::memory_order_release);
+                    row_status[row] = ROW_DONE;
+                    completed++;
+                } catch (const std::exception& error) {
+                    row_status[row] = ROW_FAILED;
+                    failed++;
+#pragma omp critical(bhsweep_log)
+                    std::cerr << "Row " << row << " failed: " << error.what() << "\n";
+                }
+
+#pragma omp critical(bhsweep_sync)
+                {
+                    double now = omp_get_wtime();
+                    if (now - last_sync >= sync_interval) {
+                        // the results before the status, so that a done row is never missing them
+                        spectra.sync(), properties.sync(), status.sync();
+                        last_sync = now;
+                        std::cout << completed << "/" << todo << " rows done, "
+                                  << completed / (now - start) << " rows/s\n" << std::flush;
+                    }
+                }
+            }
+        }
+
+        spectra.sync(), properties.sync(), status.sync(), params.sync(), freqs.sync();
+        double elapsed = omp_get_wtime() - start;
+        std::cout << completed << " rows done, " << failed << " failed in " << elapsed << " s";
+        if (stop_requested) {
+            std::cout << "; stopped, run again to resume";
+        }
+        std::cout << "\n";
+        return (failed > 0 || stop_requested) ? EXIT_FAILURE : EXIT_SUCCESS;
+    } catch (const std::exception& error) {
+        std::cerr << "bhsweep: " << error.what() << "\n";
+        return EXIT_FAILURE;
+    }
+}
@@ -0,0 +1,202 @@
+#include <algorithm>
+#include <cfloat>
+#include <cmath>
+#include <list>
+#include <memory>
+#include <mutex>
+#include <stdexcept>
+
+#include "kariba/EBL.hpp"
+#include <kariba/constants.hpp>
+
+#include "eblcache.hpp"
+
+namespace karcst = kariba::constants;    // alias the kariba::constants namespace
+
+namespace {
+
+// energy axis of the table, log-uniform between 1e-2 and 1e11 keV in the source frame
+constexpr double table_log_emin = -2., table_log_emax = 11.;
+constexpr size_t table_per_decade = 40;
+
+struct EblEntry {
+    double redsh;
+    std::vector<double> en, factors;
+};
+
+// tau at the redshifts z_max * j / (nz - 1) and the energies of the energy axis, row major
+struct EblTable {
+    double z_max = 0.;
+    size_t nz = 0, ne = 0;
+    std::vector<double> tau;
+};
+
+struct EblCache {
+    std::mutex mutex;
+    std::list<EblEntry> entries;    // most recently used first
+    std::shared_ptr<const EblTable> table;
+    double z_max = 0.;
+    size_t nz = 0;
+    size_t max_entries = 16;
+    size_t hits = 0, misses = 0;
+};
+
+EblCache& cache() {
+    static EblCache instance;
+    return instance;
+}
+
+void direct_factors(const std::vector<double>& en, double redsh, std::vector<double>& factors) {
+    std::vector<double> energies = en;
+    factors.assign(en.size(), 1.);
+    if (redsh > 0.) {
+        kariba::ebl_atten_gil(energies, factors, redsh);
+    }
+}
+
+std::shared_ptr<const EblTable> make_table(double z_max, size_t nz) {
+    auto table = std::make_shared<EblTable>();
+    table->z_max = z_max;
+    table->nz = nz;
+    table->ne = static_cast<size_t>((table_log_emax - table_log_emin) * table_per_decade) + 1;
+    std::vector<double> en(table->ne), factors;
+    for (size_t m = 0; m < table->ne; m++) {
+        en[m] = std::pow(10., table_log_emin + static_cast<double>(m) / table_per_decade) *
+                karcst::herg / karcst::hkev;
+    }
+    table->tau.assign(nz * table->ne, 0.);
+    for (size_t j = 1; j < nz; j++) {
+        direct_factors(en, z_max * static_cast<double>(j) / static_cast<double>(nz - 1), factors);
+        for (size_t m = 0; m < table->ne; m++) {
+            table->tau[j * table->ne + m] = -std::log(std::max(factors[m], DBL_MIN));
+        }
+    }
+    return table;
+}
+
+// bilinear interpolation of tau in redshift and log10(energy); energies outside the axis take the
+// values at its ends
+void table_factors(const EblTable& table, const std::vector<double>& en, double redsh,
+                   std::vector<double>& factors) {
+    double x = std::max(redsh, 0.) / table.z_max * static_cast<double>(table.nz - 1);
+    size_t j = std::min(static_cast<size_t>(x), table.nz - 2);
+    double wz = x - static_cast<double>(j);
+    const double* tau0 = table.tau.data() + j * table.ne;
+    const double* tau1 = tau0 + table.ne;
+
+    factors.resize(en.size());
+    for (size_t k = 0; k < en.size(); k++) {
+        double u = (std::log10(en[k] * karcst::hkev / karcst::herg) - table_log_emin) *
+                   table_per_decade;
+        u = std::min(std::max(u, 0.), static_cast<double>(table.ne - 1));
+        size_t m = std::min(static_cast<size_t>(u), table.ne - 2);
+        double we = u - static_cast<double>(m);
+        double tau = (1. - wz) * ((1. - we) * tau0[m] + we * tau0[m + 1]) +
+                     wz * ((1. - we) * tau1[m] + we * tau1[m + 1]);
+        factors[k] = std::exp(-tau);
+    }
+}
+
+}    // namespace
+
+void ebl_factors(const std::vector<double>& en, double redsh, std::vector<double>& factors) {
+    EblCache& ebl = cache();
+    std::unique_lock<std::mutex> lock(ebl.mutex);
+
+    if (ebl.nz > 1 && redsh <= ebl.z_max) {
+        std::shared_ptr<const EblTable> table = ebl.table;
+        if (!table) {
+            double z_max = ebl.z_max;
+            size_t nz = ebl.nz;
+            ebl.misses++;
+            lock.unlock();
+            table = make_table(z_max, nz);
+            lock.lock();
+            if (ebl.z_max == z_max && ebl.nz == nz && !ebl.table) {
+                ebl.table = table;
+            }
+        } else {
+            ebl.hits++;
+        }
+        lock.unlock();
+        table_factors(*table, en, redsh, factors);
+        return;
+    }
+
+    for (auto it = ebl.entries.begin(); it != ebl.entries.end(); ++it) {
+        if (it->redsh == redsh && it->en == en) {
+            ebl.hits++;
+            ebl.entries.splice(ebl.entries.begin(), ebl.entries, it);
+            factors = it->factors;
+            return;
+        }
+    }
+    ebl.misses++;
+    lock.unlock();
+    direct_factors(en, redsh, factors);
+    lock.lock();
+    if (ebl.max_entries > 0) {
+        ebl.entries.push_front({redsh, en, factors});
+        while (ebl.entries.size() > ebl.max_entries) {
+            ebl.entries.pop_back();
+        }
+    }
+}
+
+void set_ebl_cache(size_t entries) {
+    EblCache& ebl = cache();
+    std::lock_guard<std::mutex> lock(ebl.mutex);
+    ebl.max_entries = entries;
+    while (ebl.entries.size() > ebl.max_entries) {
+        ebl.entries.pop_back();
+    }
+}
+
+void set_ebl_table(double z_max, size_t nz) {
+    if (z_max < 0. || (z_max > 0. && nz < 2)) {
+        throw std::invalid_argument("The EBL table needs z_max >= 0 and at least 2 redshifts");
+    }
+    EblCache& ebl = cache();
+    std::lock_guard<std::mutex> lock(ebl.mutex);
+    ebl.z_max = z_max;
+    ebl.nz = z_max > 0. ? nz : 0;
+    ebl.table.reset();
+}
+
+void clear_ebl_cache() {
+    EblCache& ebl = cache();
+    std::lock_guard<std::mutex> lock(ebl.mutex);
+    ebl.entries.clear();
+    ebl.table.reset();
+    ebl.hits = 0;
+    ebl.misses = 0;
+}
+
+std::map<std::string, size_t> get_ebl_cache_info() {
+    EblCache& ebl = cache();
+    std::lock_guard<std::mutex> lock(ebl.mutex);
+    return {{"hits", ebl.hits},
+            {"misses", ebl.misses},
+            {"entries", ebl.entries.size()},
+            {"max_entries", ebl.max_entries},
+            {"table_redshifts", ebl.table ? ebl.table->nz : 0}};
+}
+
+double check_ebl_cache(const std::vector<double>& en, const std::vector<double>& lum, double redsh) {
+    if (lum.size() != en.size()) {
+        throw std::invalid_argument("The energies and luminosities must have the same size");
+    }
+    std::vector<double> energies = en, direct = lum, factors;
+    kariba::ebl_atten_gil(energies, direct, redsh);
+    ebl_factors(en, redsh, factors);
+
+    double deviation = 0.;
+    for (size_t k = 0; k < en.size(); k++) {
+        double cached = lum[k] * factors[k];
+        if (direct[k] != cached) {
+            deviation = std::max(deviation, std::abs(cached - direct[k]) /
+                                                std::max(std::abs(direct[k]), DBL_MIN));
+        }
+    }
+    return deviation;
+}
@@ -0,0 +1,30 @@
+#pragma once
+
+#include <map>
+#include <string>
+#include <vector>
+
+// Per process cache of the EBL attenuation factors exp(-tau) of kariba::ebl_atten_gil, which only
+// depend on the redshift and on the energy grid (erg, in the source frame) of a run, not on the jet
+// parameters. The factors are found by attenuating a spectrum of ones, and are kept for the last
+// few (redshift, grid) pairs, so that fits with a fixed redshift only compute them once. For fits
+// with a free redshift, set_ebl_table tabulates tau on a grid of redshifts and of energies (40 per
+// decade between 1e-2 and 1e11 keV), which is interpolated linearly in redshift and log(energy),
+// so that any energy grid can use it. The cache is shared by all instances and threads.
+
+// attenuation factors at redshift redsh on the energies en, from the cache if possible
+void ebl_factors(const std::vector<double>& en, double redsh, std::vector<double>& factors);
+
+// number of (redshift, grid) pairs kept, 0 disables the cache (16 by default)
+void set_ebl_cache(size_t entries);
+// tabulates tau at nz redshifts between 0 and z_max, built at the next run that needs it; redshifts
+// above z_max go through the cache; z_max = 0 removes the table (the default)
+void set_ebl_table(double z_max, size_t nz = 201);
+void clear_ebl_cache();
+// hits, misses (computing the factors of a pair, or building the table), entries, max_entries and
+// table_redshifts (0 without a table)
+std::map<std::string, size_t> get_ebl_cache_info();
+
+// largest relative difference between attenuating lum with ebl_factors and calling ebl_atten_gil
+// on it directly
+double check_ebl_cache(const std::vector<double>& en, const std::vector<double>& lum, double redsh);
@@ -1,5 +1,6 @@
 #pragma once
 
+#include <memory>
 #include <vector>
 #include <string>
 
@@ -18,32 +19,134 @@ struct NumDenPoint {
 };
 
 
+// Contiguous array of doubles that can be shared with NumPy without copying. The views hold a
+// reference to the buffer, so clear() only reuses it (and its capacity) when no view is alive;
+// otherwise the next run starts a new buffer and old views keep the values of their own run
+class SharedArray {
+public:
+    void clear() {
+        if (values.use_count() > 1) {
+            values = std::make_shared<std::vector<double>>();
+        } else {
+            values->clear();
+        }
+    }
+    void push_back(double value) { values->push_back(value); }
+    void resize(size_t size) { values->resize(size); }
+    void reserve(size_t size) { values->reserve(size); }
+    size_t size() const { return values->size(); }
+    double* data() { return values->data(); }
+    const double* data() const { return values->data(); }
+    double& operator[](size_t i) { return (*values)[i]; }
+    double operator[](size_t i) const { return (*values)[i]; }
+    const std::shared_ptr<std::vector<double>>& buffer() const { return values; }
+
+private:
+    std::shared_ptr<std::vector<double>> values = std::make_shared<std::vector<double>>();
+};
+
+// Spectrum stored as a structure of arrays: one buffer with the n energies (nu [Hz]) followed by
+// the n fluxes (flux [mJy]), so that it can be viewed as an (n, 2) array with no copies
+struct SpectrumArrays {
+    size_t size = 0;
+    SharedArray values;
+
+    void resize(size_t n) {
+        values.clear();
+        values.resize(2 * n);
+        size = n;
+    }
+    double* energy() { return values.data(); }
+    double* flux() { return values.data() + size; }
+    const double* energy() const { return values.data(); }
+    const double* flux() const { return values.data() + size; }
+
+    std::vector<DataPoint> points() const {
+        std::vector<DataPoint> result(size);
+        for (size_t k = 0; k < size; k++) {
+            result[k] = {energy()[k], flux()[k]};
+        }
+        return result;
+    }
+
+    void clear() {
+        values.clear();
+        size = 0;
+    }
+};
+
+// Per-zone table stored ragged: the rows of all zones one after another in a single row-major
+// buffer of ncols values per row, and the first row of every zone in offsets, so that zone j holds
+// the rows from offsets[j] up to offsets[j + 1] (or up to rows() for the last zone). The layout is
+// that of the per-zone tables of OutputWriter and load_output.
+struct ZoneTable {
+    size_t ncols;
+    SharedArray values;
+    std::vector<size_t> offsets;
+
+    explicit ZoneTable(size_t ncols) : ncols(ncols) {}
+    size_t rows() const { return values.size() / ncols; }
+    void begin_zone() { offsets.push_back(rows()); }
+
+    void clear() {
+        values.clear();
+        offsets.clear();
+    }
+};
+
+// Warnings a run can raise. The codes are bit flags, so that JetOutput::warning_flags holds every
+// kind raised by a run
+enum JetWarningCode : unsigned {
+    WARNING_UNPHYSICAL_PAIRS = 1,    // pair content below one pair per proton
+    WARNING_BLJET_PAIRS = 2,         // pair content or temperature too high for bljet
+    WARNING_PAIR_PRODUCTION = 4,     // jet base compact enough for pair production
+};
+
+inline const char* warning_name(unsigned code) {
+    switch (code) {
+        case WARNING_UNPHYSICAL_PAIRS: return "unphysical_pairs";
+        case WARNING_BLJET_PAIRS: return "bljet_pairs";
+        case WARNING_PAIR_PRODUCTION: return "pair_production";
+        default: return "unknown";
+    }
+}
+
+struct JetWarning {
+    unsigned code;
+    std::string message;
+    double value;    // quantity that raised the warning: pair content, pair content times average
+                     // lepton Lorentz factor, or jet base compactness
+};
+
 class JetOutput {
 public:
 
     // infosw = 1 ---------
     //all output here is in units of (nu [Hz], flux [mJy])
-    std::vector<DataPoint> presyn;
-    std::vector<DataPoint> postsyn;
-    std::vector<DataPoint> precom;
-    std::vector<DataPoint> postcom;
-    std::vector<DataPoint> disk;
-    std::vector<DataPoint> bb;
-    std::vector<DataPoint> total;
+    SpectrumArrays presyn;
+    SpectrumArrays postsyn;
+    SpectrumArrays precom;
+    SpectrumArrays postcom;
+    SpectrumArrays disk;
+    SpectrumArrays bb;
+    SpectrumArrays total;
 
     // For infosw >= 2 ------
-    
+    // the per-zone tables numdens, cyclosyn_zones and compton_zones, with z and z + delz [Rg] of
+    // every zone in zone_bounds
+    std::vector<double> zone_bounds;
+
     //output is (p [g cm s-1], g [], n(p) [# cm^-3 p^-1], n(g) [# cm^-3 g^-1])
-    std::vector<NumDenPoint> numdens;
+    ZoneTable numdens{4};
 
     //for infosw >=5 ---- 
     struct JetProfile {
-        std::vector<double> z_rg; 
-        std::vector<double> zone_rg; 
-        std::vector<double> zone_bfield; 
-        std::vector<double> zone_lepdens; 
-        std::vector<double> zone_gamma; 
-        std::vector<double> zone_eltemp; 
+        SharedArray z_rg; 
+        SharedArray zone_rg; 
+        SharedArray zone_bfield; 
+        SharedArray zone_lepdens; 
+        SharedArray zone_gamma; 
+        SharedArray zone_eltemp; 
 
         void clear() {
             z_rg.clear();
@@ -57,8 +160,8 @@ public:
     JetProfile jetprofile;  
     
     // output for these is in units of (nu [Hz], flux [mJy])
-    std::vector<DataPoint> cyclosyn_zones;
-    std::vector<DataPoint> compton_zones;
+    ZoneTable cyclosyn_zones{2};
+    ZoneTable compton_zones{2};
 
     // For infosw >= 3 --------
     struct SpectralProperties {
@@ -103,18 +206,18 @@ public:
     // For infosw >= 5 ---- 
     //this returns values for each zone, as the code loops over each segement of the jet: 
     struct JetZoneProperties {
-        std::vector<double> jet_bfield;
-        std::vector<double> lepton_ndens; 
-        std::vector<double> speed_gamma; 
-        std::vector<double> delta; 
-        std::vector<double> tshift; 
-        std::vector<double> temp_kev; 
-        std::vector<double> grid_r;  
-        std::vector<double> delz; 
-        std::vector<double> dist_z;  
-        std::vector<double> z_delz; 
-        std::vector<double> equpar_check; 
-        std::vector<double> ue_ub; 
+        SharedArray jet_bfield;
+        SharedArray lepton_ndens; 
+        SharedArray speed_gamma; 
+        SharedArray delta; 
+        SharedArray tshift; 
+        SharedArray temp_kev; 
+        SharedArray grid_r;  
+        SharedArray delz; 
+        SharedArray dist_z;  
+        SharedArray z_delz; 
+        SharedArray equpar_check; 
+        SharedArray ue_ub; 
 
         // Method to clear all vectors
         void clear() {
@@ -134,9 +237,64 @@ public:
     };
     JetZoneProperties jet_zone_properties;
 
+    // For run_pars::instrument ----
+    // wall time (s) of each stage of the run, summed over the zones; only the ebl and output
+    // stages run when the jet itself is not recomputed
+    struct Timings {
+        double external = 0.;         // disk and external photon fields
+        double equipartition = 0.;    // jet base equipartition and velocity profile
+        double particles = 0.;        // particle distributions
+        double cyclosyn = 0.;         // cyclosynchrotron spectra
+        double compton = 0.;          // inverse Compton spectra
+        double summing = 0.;          // summing the zones onto the total
+        double ebl = 0.;              // EBL attenuation
+        double output = 0.;           // observed spectrum and stored output
+
+        void clear() { *this = Timings(); }
+    };
+    Timings timings;
+
+    // work of each zone: number of synchrotron/inverse Compton frequency bins, whether the zone
+    // passed Compton_check (1 or 0) and whether its Compton spectrum used multiple scatters
+    // (set_niter(15), 1 or 0)
+    struct ZoneCounters {
+        SharedArray nsyn;
+        SharedArray ncom;
+        SharedArray compton;
+        SharedArray multiple_scatters;
+
+        void clear() {
+            nsyn.clear();
+            ncom.clear();
+            compton.clear();
+            multiple_scatters.clear();
+        }
+    };
+    ZoneCounters zone_counters;
+
+    // warnings raised by the run, in order, and the bitwise or of their codes
+    std::vector<JetWarning> warnings;
+    unsigned warning_flags = 0;
+
+    // number of zones computed (sub-zones included), of which zones_reused were the zones before
+    // z_diss taken over from the previous run, and, with adaptive zones, the estimated fraction of
+    // the total at any energy missed by not computing the zones left
+    size_t zones_computed = 0;
+    size_t zones_reused = 0;
+    double truncation_error = 0.;
+
     // Constructor
     JetOutput() = default;
 
+    // starts the rows of a new zone in the per-zone tables
+    void begin_zone(double z, double z_end) {
+        zone_bounds.push_back(z);
+        zone_bounds.push_back(z_end);
+        numdens.begin_zone();
+        cyclosyn_zones.begin_zone();
+        compton_zones.begin_zone();
+    }
+
     // Clear method
     void clear() {
         // Clear all vectors
@@ -147,6 +305,7 @@ public:
         disk.clear();
         bb.clear();
         total.clear();
+        zone_bounds.clear();
         numdens.clear();
         cyclosyn_zones.clear();
         compton_zones.clear();
@@ -154,6 +313,13 @@ public:
         spectral_properties.clear();
         jet_base_properties.clear();
         jet_zone_properties.clear();
+        timings.clear();
+        warnings.clear();
+        warning_flags = 0;
+        zone_counters.clear();
+        zones_computed = 0;
+        zones_reused = 0;
+        truncation_error = 0.;
 
     }
 };
@@ -184,6 +184,18 @@ void jetgrid(size_t i, grid_pars& grid, jet_dynpars& dyn, double r, double& delz
     }
 }
 
+// Number of sub-zones in which the adaptive grid splits the zone from z to z+delz: refine if the
+// zone or one of its neighbours contains the end of the nozzle, the end of the acceleration region
+// or the dissipation region, where the emission changes quickly from zone to zone, and 1 otherwise
+size_t zone_refinement(double z, double delz, const jet_dynpars& dyn, double z_diss, size_t refine) {
+    for (double feature : {dyn.h0, dyn.acc, z_diss}) {
+        if (feature >= z - delz && feature <= z + 2. * delz) {
+            return refine;
+        }
+    }
+    return 1;
+}
+
 void isojetpars(double z, jet_dynpars& dyn, jet_enpars& en, double& t, zone_pars& zone,
                 gsl_spline* spline, gsl_interp_accel* acc) {
 
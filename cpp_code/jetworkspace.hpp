@@ -0,0 +1,158 @@
+#pragma once
+
+#include <algorithm>
+#include <cmath>
+#include <map>
+#include <memory>
+#include <vector>
+
+#include <gsl/gsl_spline.h>
+#include <kariba/BBody.hpp>
+#include <kariba/Bknpower.hpp>
+#include <kariba/Mixed.hpp>
+#include <kariba/Powerlaw.hpp>
+#include <kariba/ShSDisk.hpp>
+#include <kariba/Thermal.hpp>
+
+#include "loginterp.hpp"
+
+struct zone_checkpoint;    // bhjet.hpp
+
+// Splines, particle distributions and arrays used by jetmain_output that only depend on the array
+// sizes of a run. A BhJetClass owns one workspace (run_batch one per thread) and reuses it for all
+// zones of a run and for consecutive runs, so that after the first run nothing is allocated again
+// unless the sizes change. A workspace must not be shared by two runs at the same time.
+class JetWorkspace {
+public:
+    JetWorkspace() : acc_speed(gsl_interp_accel_alloc()), spline_speed(gsl_spline_alloc(gsl_interp_steffen, 54)) {
+        for (auto& acc : acc_akima) {
+            acc = gsl_interp_accel_alloc();
+        }
+    }
+    ~JetWorkspace() {
+        free_eldis();
+        for (size_t slot = 0; slot < 2; slot++) {
+            for (auto& [size, spline] : akima_splines[slot]) {
+                gsl_spline_free(spline);
+            }
+            gsl_interp_accel_free(acc_akima[slot]);
+        }
+        gsl_spline_free(spline_speed), gsl_interp_accel_free(acc_speed);
+    }
+    JetWorkspace(const JetWorkspace&) = delete;
+    JetWorkspace& operator=(const JetWorkspace&) = delete;
+
+    // Akima spline with size points; two slots, as sum_counterjet needs two splines of the same size
+    // at once. The matching accelerator is reset, as the spline is about to be initialised again.
+    gsl_spline* akima(size_t size, size_t slot = 0) {
+        gsl_interp_accel_reset(acc_akima[slot]);
+        auto it = akima_splines[slot].find(size);
+        if (it == akima_splines[slot].end()) {
+            it = akima_splines[slot].emplace(size, gsl_spline_alloc(gsl_interp_akima, size)).first;
+        }
+        return it->second;
+    }
+    gsl_interp_accel* akima_acc(size_t slot = 0) { return acc_akima[slot]; }
+
+    // log10 of the energies the zones are summed on, only recomputed when the grid changes
+    const std::vector<double>& log_grid(const std::vector<double>& en, size_t size) {
+        if (!std::equal(en.begin(), en.begin() + size, grid_en.begin(), grid_en.end())) {
+            grid_en.assign(en.begin(), en.begin() + size);
+            grid_log.resize(size);
+            for (size_t k = 0; k < size; k++) {
+                grid_log[k] = std::log10(en[k]);
+            }
+        }
+        return grid_log;
+    }
+
+    // (re)allocates the electron distribution splines and particle objects for nel momentum bins
+    void set_nel(size_t n) {
+        if (n == nel) {
+            return;
+        }
+        free_eldis();
+        nel = n;
+        acc_eldis = gsl_interp_accel_alloc();
+        spline_eldis = gsl_spline_alloc(gsl_interp_steffen, nel);
+        acc_deriv = gsl_interp_accel_alloc();
+        spline_deriv = gsl_spline_alloc(gsl_interp_steffen, nel);
+        thermal = std::make_unique<kariba::Thermal>(nel);
+        mixed = std::make_unique<kariba::Mixed>(nel);
+        bknpower = std::make_unique<kariba::Bknpower>(nel);
+        powerlaw = std::make_unique<kariba::Powerlaw>(nel);
+    }
+
+    // True if the disk and external photon fields below were computed for the same key (the
+    // parameters they depend on) in an earlier run; otherwise they are created anew, to be computed
+    // and marked with external_key by the run once they are complete
+    bool external_ready(const std::vector<double>& key) {
+        if (disk && key == external_key) {
+            return true;
+        }
+        external_key.clear();
+        disk_luminosity = disk_tin = disk_hdisk = 0.;
+        disk = std::make_unique<kariba::ShSDisk>();
+        blr = std::make_unique<kariba::BBody>();
+        torus = std::make_unique<kariba::BBody>();
+        blackbody = std::make_unique<kariba::BBody>();
+        return false;
+    }
+
+    // velocity profile spline; speed_table records which tabulated profile (velsw 0 or 1) it
+    // holds, so that it is only initialised once, and is -1 for the magnetic profile, which
+    // depends on the parameters of the run
+    gsl_interp_accel* acc_speed;
+    gsl_spline* spline_speed;
+    int speed_table = -1;
+
+    size_t nel = 0;
+    gsl_interp_accel* acc_eldis = nullptr;
+    gsl_spline* spline_eldis = nullptr;
+    gsl_interp_accel* acc_deriv = nullptr;
+    gsl_spline* spline_deriv = nullptr;
+
+    // particle distributions, all of their arrays are set again by the setters of each zone
+    std::unique_ptr<kariba::Thermal> thermal;
+    std::unique_ptr<kariba::Mixed> mixed;
+    std::unique_ptr<kariba::Bknpower> bknpower;
+    std::unique_ptr<kariba::Powerlaw> powerlaw;
+
+    // disk and external photon fields, with the disk luminosity before the BLR/torus covering,
+    // inner temperature and scale height, which are reused while external_key does not change
+    std::unique_ptr<kariba::ShSDisk> disk;
+    std::unique_ptr<kariba::BBody> blr, torus, blackbody;
+    double disk_luminosity = 0., disk_tin = 0., disk_hdisk = 0.;
+    std::vector<double> external_key;
+
+    // total spectra of the run and spectra of the current zone
+    std::vector<double> tot_en, tot_syn_pre, tot_syn_post, tot_com_pre, tot_com_post, tot_lum;
+    std::vector<double> syn_en, syn_lum, com_en, com_lum;
+    // jet/counterjet scratch arrays of sum_counterjet
+    std::vector<double> en_j, en_cj, lum_j, lum_cj, log_en;
+    // log-uniform grid interpolation of sum_counterjet (jet and counterjet) and sum_zones, only used
+    // with log_interp (run_pars::log_interp)
+    LogGridInterp interp_j, interp_cj, interp_zones;
+    bool log_interp = false;
+    // state of the zone loop of the last run at z_diss, see zone_checkpoint
+    std::shared_ptr<zone_checkpoint> checkpoint;
+    // jet spectrum before the current grid zone and contribution of the previous one, to estimate
+    // the truncation error of the adaptive zones
+    std::vector<double> zone_start, zone_last;
+    // with threaded zones (run_pars::zone_threads), the workspaces of the threads other than the
+    // calling one and the synchrotron and Compton spectra of each zone on the total grid
+    std::vector<std::unique_ptr<JetWorkspace>> zone_workspaces;
+    std::vector<std::vector<double>> zone_rows;
+
+private:
+    void free_eldis() {
+        if (nel > 0) {
+            gsl_spline_free(spline_eldis), gsl_interp_accel_free(acc_eldis);
+            gsl_spline_free(spline_deriv), gsl_interp_accel_free(acc_deriv);
+        }
+    }
+
+    std::vector<double> grid_en, grid_log;
+    std::map<size_t, gsl_spline*> akima_splines[2];
+    gsl_interp_accel* acc_akima[2];
+};
@@ -0,0 +1,291 @@
+#include <array>
+#include <cmath>
+#include <cstdint>
+#include <filesystem>
+#include <fstream>
+#include <sstream>
+#include <stdexcept>
+
+#include <kariba/constants.hpp>
+
+#include "bhjet.hpp"
+#include "outputwriter.hpp"
+
+namespace karcst = kariba::constants;    // alias the kariba::constants namespace
+
+void OutputWriter::table(const std::string& name, int check, bool per_zone) {
+    static const std::map<int, size_t> columns = {{2, 2}, {4, 4}, {6, 6}, {7, 7}};
+    Table& table = get(name, columns.at(check));
+    table.header = file_header(check);
+    table.per_zone = per_zone;
+}
+
+void OutputWriter::parameters(const std::vector<double>& param) {
+    Table& table = get("Starting_pars", 1);
+    table.values.assign(param.begin(), param.begin() + 27);
+}
+
+// Hz and mJy in the observer frame; the factor 1+z in the specific luminosity makes the spectrum
+// only move to lower frequency, not up/down
+void OutputWriter::spectrum(const std::string& name, size_t size, const std::vector<double>& en,
+                            const std::vector<double>& lum, double dist, double redsh) {
+    Table& table = get(name, 2);
+    for (size_t k = 0; k < size; k++) {
+        table.values.push_back(en[k] / (karcst::herg * (1. + redsh)));
+        table.values.push_back(lum[k] * (1. + redsh) /
+                               (4. * karcst::pi * std::pow(dist, 2.) * karcst::mjy));
+    }
+}
+
+void OutputWriter::particles(const std::string& name, size_t size, const std::vector<double>& p,
+                             const std::vector<double>& g, const std::vector<double>& pdens,
+                             const std::vector<double>& gdens) {
+    Table& table = get(name, 4);
+    for (size_t k = 0; k < size; k++) {
+        table.values.insert(table.values.end(), {p[k], g[k], pdens[k], gdens[k]});
+    }
+}
+
+void OutputWriter::row(const std::string& name, const std::vector<double>& values) {
+    Table& table = get(name, values.size());
+    table.values.insert(table.values.end(), values.begin(), values.end());
+}
+
+void OutputWriter::begin_zone(double z, double z_end) {
+    zone_bounds.push_back(z);
+    zone_bounds.push_back(z_end);
+    for (auto& [name, table] : tables) {
+        if (table.per_zone) {
+            table.zone_offsets.push_back(table.rows());
+        }
+    }
+}
+
+void OutputWriter::write() const {
+    std::error_code error;
+    std::filesystem::create_directories(directory, error);
+    if (error) {
+        throw std::runtime_error("Cannot create output directory " + directory + ": " +
+                                 error.message());
+    }
+    if (format == NPZ) {
+        write_npz();
+    } else {
+        write_text();
+    }
+}
+
+OutputWriter::Format OutputWriter::format_from_name(const std::string& name) {
+    if (name == "text") {
+        return TEXT;
+    } else if (name == "npz") {
+        return NPZ;
+    }
+    throw std::invalid_argument("Unknown output format: " + name + " (use text or npz)");
+}
+
+OutputWriter::Table& OutputWriter::get(const std::string& name, size_t ncols) {
+    auto it = tables.find(name);
+    if (it == tables.end()) {
+        it = tables.emplace(name, Table()).first;
+        order.push_back(name);
+    }
+    if (it->second.ncols == 0) {
+        it->second.ncols = ncols;
+    } else if (it->second.ncols != ncols) {
+        throw std::logic_error("Output table " + name + " has " +
+                               std::to_string(it->second.ncols) + " columns, not " +
+                               std::to_string(ncols));
+    }
+    return it->second;
+}
+
+static void write_file(const std::string& path, const std::string& contents) {
+    std::ofstream file(path, std::ios::trunc | std::ios::binary);
+    file.write(contents.data(), static_cast<std::streamsize>(contents.size()));
+    if (!file) {
+        throw std::runtime_error("Cannot write output file " + path);
+    }
+}
+
+// Same formatting as the old per-zone appends (default stream precision), but every file is
+// formatted in memory and written with a single call
+void OutputWriter::write_text() const {
+    std::vector<std::string> zone_tables;
+    for (const auto& name : order) {
+        const Table& table = tables.at(name);
+        std::ostringstream text;
+        if (!table.header.empty()) {
+            text << table.header << "\n";
+        }
+        for (size_t row = 0; row < table.rows(); row++) {
+            for (size_t col = 0; col < table.ncols; col++) {
+                text << (col == 0 ? "" : " ") << table.values[row * table.ncols + col];
+            }
+            text << "\n";
+        }
+        write_file(directory + "/" + name + ".dat", text.str());
+        if (table.per_zone) {
+            zone_tables.push_back(name);
+        }
+    }
+
+    if (zone_tables.empty()) {
+        return;
+    }
+    std::ostringstream text;
+    text << "#z [Rg]: " << " z+delz [Rg]:";
+    for (const auto& name : zone_tables) {
+        text << "  first row of " << name << ":";
+    }
+    text << "\n";
+    for (size_t zone = 0; zone < zone_bounds.size() / 2; zone++) {
+        text << zone_bounds[2 * zone] << " " << zone_bounds[2 * zone + 1];
+        for (const auto& name : zone_tables) {
+            text << " " << tables.at(name).zone_offsets[zone];
+        }
+        text << "\n";
+    }
+    write_file(directory + "/Zones.dat", text.str());
+}
+
+std::string npy_header(const std::string& descr, const std::vector<size_t>& shape) {
+    std::ostringstream dict;
+    dict << "{'descr': '" << descr << "', 'fortran_order': False, 'shape': (";
+    for (size_t k = 0; k < shape.size(); k++) {
+        dict << (k == 0 ? "" : ", ") << shape[k];
+    }
+    dict << (shape.size() == 1 ? ",), }" : "), }");
+    std::string header = dict.str();
+    header.append(63 - (10 + header.size()) % 64, ' ');    // total header length multiple of 64
+    header.push_back('\n');
+
+    std::string out("\x93NUMPY\x01\x00", 8);
+    out.push_back(static_cast<char>(header.size() & 0xFF));
+    out.push_back(static_cast<char>(header.size() >> 8));
+    return out + header;
+}
+
+// Minimal writer of an uncompressed zip archive of .npy arrays, the format read by numpy.load.
+// The arrays are written in the byte order of the host, which is assumed to be little endian.
+namespace {
+
+uint32_t crc32(const std::string& data) {
+    static const std::array<uint32_t, 256> crc_table = [] {
+        std::array<uint32_t, 256> values{};
+        for (uint32_t n = 0; n < 256; n++) {
+            uint32_t c = n;
+            for (int k = 0; k < 8; k++) {
+                c = (c & 1) ? 0xEDB88320u ^ (c >> 1) : c >> 1;
+            }
+            values[n] = c;
+        }
+        return values;
+    }();
+    uint32_t crc = 0xFFFFFFFFu;
+    for (unsigned char byte : data) {
+        crc = crc_table[(crc ^ byte) & 0xFF] ^ (crc >> 8);
+    }
+    return crc ^ 0xFFFFFFFFu;
+}
+
+void put(std::string& out, uint64_t value, size_t bytes) {
+    for (size_t k = 0; k < bytes; k++) {
+        out.push_back(static_cast<char>((value >> (8 * k)) & 0xFF));
+    }
+}
+
+// .npy file (format version 1.0) of a C ordered array with the given shape
+template <typename T>
+std::string npy(const std::string& descr, const std::vector<size_t>& shape, const T* data,
+                size_t size) {
+    std::string out = npy_header(descr, shape);
+    out.append(reinterpret_cast<const char*>(data), size * sizeof(T));
+    return out;
+}
+
+class NpzArchive {
+public:
+    void add(const std::string& name, const std::string& contents) {
+        std::string file = name + ".npy";
+        uint32_t crc = crc32(contents);
+        size_t offset = archive.size();
+
+        put(archive, 0x04034b50, 4);    // local file header
+        put(archive, 20, 2);            // version needed to extract
+        put(archive, 0, 2);             // flags
+        put(archive, 0, 2);             // stored, no compression
+        put(archive, 0, 2);             // time
+        put(archive, 0x21, 2);          // date, 1980-01-01
+        put(archive, crc, 4);
+        put(archive, contents.size(), 4);
+        put(archive, contents.size(), 4);
+        put(archive, file.size(), 2);
+        put(archive, 0, 2);
+        archive += file;
+        archive += contents;
+
+        put(directory, 0x02014b50, 4);    // central directory header
+        put(directory, 20, 2);            // version made by
+        put(directory, 20, 2);
+        put(directory, 0, 2);
+        put(directory, 0, 2);
+        put(directory, 0, 2);
+        put(directory, 0x21, 2);
+        put(directory, crc, 4);
+        put(directory, contents.size(), 4);
+        put(directory, contents.size(), 4);
+        put(directory, file.size(), 2);
+        put(directory, 0, 2);             // extra field length
+        put(directory, 0, 2);             // comment length
+        put(directory, 0, 2);             // disk number
+        put(directory, 0, 2);             // internal attributes
+        put(directory, 0, 4);             // external attributes
+        put(directory, offset, 4);
+        directory += file;
+        entries++;
+    }
+
+    std::string finish() const {
+        std::string out = archive + directory;
+        put(out, 0x06054b50, 4);    // end of central directory
+        put(out, 0, 2);
+        put(out, 0, 2);
+        put(out, entries, 2);
+        put(out, entries, 2);
+        put(out, directory.size(), 4);
+        put(out, archive.size(), 4);
+        put(out, 0, 2);
+        return out;
+    }
+
+private:
+    std::string archive, directory;
+    size_t entries = 0;
+};
+
+}    // namespace
+
+void OutputWriter::write_npz() const {
+    NpzArchive npz;
+    bool zones = false;
+    for (const auto& name : order) {
+        const Table& table = tables.at(name);
+        std::vector<size_t> shape = {table.rows(), table.ncols};
+        if (name == "Starting_pars") {
+            shape = {table.values.size()};
+        }
+        npz.add(name, npy("<f8", shape, table.values.data(), table.values.size()));
+        if (table.per_zone) {
+            std::vector<int64_t> offsets(table.zone_offsets.begin(), table.zone_offsets.end());
+            offsets.push_back(static_cast<int64_t>(table.rows()));
+            npz.add(name + "_offsets", npy("<i8", {offsets.size()}, offsets.data(), offsets.size()));
+            zones = true;
+        }
+    }
+    if (zones) {
+        npz.add("zone_bounds",
+                npy("<f8", {zone_bounds.size() / 2, 2}, zone_bounds.data(), zone_bounds.size()));
+    }
+    write_file(directory + "/bhjet_output.npz", npz.finish());
+}
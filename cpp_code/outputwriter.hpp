@@ -0,0 +1,72 @@
+#pragma once
+
+#include <map>
+#include <string>
+#include <vector>
+
+// Collects the output files of a run (infosw >= 1 with writeToFile) in memory and writes them once
+// at the end of the run, instead of reopening and appending to a file for every zone. The files go
+// to a directory chosen per run, either as the usual text files (Output/Total.dat etc., with the
+// same names, headers and columns) or as a single uncompressed NumPy .npz container. Every run owns
+// its writer, so runs with different directories never share a file.
+//
+// The per-zone tables (Numdens, Cyclosyn_zones, Compton_zones, Profiles) also record the first row
+// of every zone, so that they can be split into zones without guessing from the frequency grid:
+// the text output adds Zones.dat with the bounds and first rows of each zone, and the container
+// holds <table>_offsets (nzones+1 rows) and zone_bounds (z and z+delz in Rg for each zone).
+class OutputWriter {
+public:
+    enum Format { TEXT, NPZ };
+
+    OutputWriter(const std::string& directory, Format format) : directory(directory), format(format) {}
+
+    // adds an empty table, with the header of file_header check code check; per_zone tables are
+    // split into the zones started with begin_zone
+    void table(const std::string& name, int check, bool per_zone = false);
+
+    // starting parameters of the run, Starting_pars.dat
+    void parameters(const std::vector<double>& param);
+
+    // appends a spectrum in Hz and mJy in the observer frame, or a particle distribution
+    void spectrum(const std::string& name, size_t size, const std::vector<double>& en,
+                  const std::vector<double>& lum, double dist, double redsh);
+    void particles(const std::string& name, size_t size, const std::vector<double>& p,
+                   const std::vector<double>& g, const std::vector<double>& pdens,
+                   const std::vector<double>& gdens);
+
+    // appends one row of values to a table
+    void row(const std::string& name, const std::vector<double>& values);
+
+    // starts a new zone between z and z_end (in Rg) for all per-zone tables
+    void begin_zone(double z, double z_end);
+
+    // creates the directory if needed and writes all tables; throws std::runtime_error if a file
+    // cannot be written
+    void write() const;
+
+    static Format format_from_name(const std::string& name);
+
+private:
+    struct Table {
+        std::string header;
+        size_t ncols = 0;
+        bool per_zone = false;
+        std::vector<double> values;         // row major
+        std::vector<size_t> zone_offsets;   // first row of every zone
+        size_t rows() const { return ncols == 0 ? 0 : values.size() / ncols; }
+    };
+
+    Table& get(const std::string& name, size_t ncols);
+    void write_text() const;
+    void write_npz() const;
+
+    std::string directory;
+    Format format;
+    std::map<std::string, Table> tables;
+    std::vector<std::string> order;         // tables in the order they were added
+    std::vector<double> zone_bounds;        // z and z_end of every zone
+};
+
+// Header of a .npy file (format version 1.0) of a C ordered array of type descr (e.g. "<f8") with
+// the given shape; its length is a multiple of 64 bytes, so the data that follows is aligned
+std::string npy_header(const std::string& descr, const std::vector<size_t>& shape);
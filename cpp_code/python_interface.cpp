@@ -5,9 +5,16 @@
 #include <pybind11/functional.h>
 
 #include "bhjet_class.hpp"
+#include "eblcache.hpp"
 #include "jetoutput.hpp"
 
+#include <algorithm>
+#include <functional>
+
+#include <kariba/constants.hpp>
+
 namespace py = pybind11; 
+namespace karcst = kariba::constants;    // alias the kariba::constants namespace
 
 #define SET_ARGS_VEC(classtype, function, type) \
 	[](classtype &a, py::array_t<type> array) { \
@@ -27,6 +34,90 @@ namespace py = pybind11;
 		py::return_value_policy::copy
 
 
+// Read-only NumPy view of a SharedArray buffer. The view keeps the buffer alive, so it stays
+// valid (and unchanged) when the model is run again
+static py::array_t<double> shared_view(const SharedArray& a, std::vector<py::ssize_t> shape,
+                                       std::vector<py::ssize_t> strides) {
+	auto* owner = new std::shared_ptr<std::vector<double>>(a.buffer());
+	py::capsule base(owner, [](void* p) { delete static_cast<std::shared_ptr<std::vector<double>>*>(p); });
+	py::array_t<double> view(shape, strides, (*owner)->data(), base);
+	view.attr("setflags")(py::arg("write") = false);
+	return view;
+}
+
+// (n, 2) view of a spectrum: column 0 is nu [Hz], column 1 the flux [mJy]
+static py::array_t<double> spectrum_view(const SpectrumArrays& s) {
+	py::ssize_t n = static_cast<py::ssize_t>(s.size);
+	return shared_view(s.values, {n, 2}, {static_cast<py::ssize_t>(sizeof(double)), n * static_cast<py::ssize_t>(sizeof(double))});
+}
+
+static py::array_t<double> array_view(const SharedArray& a) {
+	return shared_view(a, {static_cast<py::ssize_t>(a.size())}, {static_cast<py::ssize_t>(sizeof(double))});
+}
+
+// (rows, ncols) view of a per-zone table
+static py::array_t<double> zone_table_view(const ZoneTable& t) {
+	py::ssize_t itemsize = static_cast<py::ssize_t>(sizeof(double));
+	return shared_view(t.values, {static_cast<py::ssize_t>(t.rows()), static_cast<py::ssize_t>(t.ncols)},
+	                   {static_cast<py::ssize_t>(t.ncols) * itemsize, itemsize});
+}
+
+// first row of every zone followed by the number of rows, as in load_output
+static py::array_t<int64_t> zone_offsets(const ZoneTable& t) {
+	py::array_t<int64_t> offsets(static_cast<py::ssize_t>(t.offsets.size() + 1));
+	auto o = offsets.mutable_unchecked<1>();
+	for (size_t j = 0; j < t.offsets.size(); j++) {
+		o(j) = static_cast<int64_t>(t.offsets[j]);
+	}
+	o(t.offsets.size()) = static_cast<int64_t>(t.rows());
+	return offsets;
+}
+
+static std::vector<DataPoint> zone_points(const ZoneTable& t) {
+	std::vector<DataPoint> points(t.rows());
+	for (size_t k = 0; k < points.size(); k++) {
+		points[k] = {t.values[2 * k], t.values[2 * k + 1]};
+	}
+	return points;
+}
+
+#define GET_SPECTRUM_POINTS(member) \
+	[](const JetOutput &a) { return a.member.points(); }
+
+#define GET_SPECTRUM_ARRAY(member) \
+	[](const JetOutput &a) { return spectrum_view(a.member); }
+
+#define GET_ARRAY_VIEW(classtype, member) \
+	[](const classtype &a) { return array_view(a.member); }
+
+// Python callable that receives the warnings of every run, or None. It is never freed, as it would
+// otherwise be destroyed after the interpreter has shut down
+static py::object& warning_handler() {
+	static py::object* handler = new py::object(py::none());
+	return *handler;
+}
+
+// passes the warnings of a run to the handler; called with the GIL held, after the run
+static void dispatch_warnings(const std::vector<JetWarning>& warnings) {
+	py::object& handler = warning_handler();
+	if (handler.is_none()) {
+		return;
+	}
+	for (const JetWarning& warning : warnings) {
+		handler(warning);
+	}
+}
+
+// calls f on an instance holding its lock, with the GIL released, so that a run of the instance in
+// another thread can finish while waiting; f must not touch Python objects
+template <typename F>
+static auto locked(const BhJetClass& a, F&& f) {
+	py::gil_scoped_release release;
+	auto lock = a.lock();
+	return f();
+}
+
+
 PYBIND11_MODULE(pybhjet, m){
 
     py::class_<NumDenPoint>(m, "NumDenPoint")
@@ -43,18 +134,18 @@ PYBIND11_MODULE(pybhjet, m){
 
     py::class_<JetOutput::JetZoneProperties>(m, "JetZoneProperties")
         .def(py::init<>())
-        .def_readonly("jet_bfield", &JetOutput::JetZoneProperties::jet_bfield, "Jet magnetic field")
-        .def_readonly("lepton_ndens", &JetOutput::JetZoneProperties::lepton_ndens, "Lepton number density")
-        .def_readonly("speed_gamma", &JetOutput::JetZoneProperties::speed_gamma, "Speed gamma")
-        .def_readonly("delta", &JetOutput::JetZoneProperties::delta, "Doppler factor delta")
-        .def_readonly("tshift", &JetOutput::JetZoneProperties::tshift, "Temperature shift")
-        .def_readonly("temp_kev", &JetOutput::JetZoneProperties::temp_kev, "Electron temperature in keV")
-        .def_readonly("grid_r", &JetOutput::JetZoneProperties::grid_r, "Grid radius in Rg")
-        .def_readonly("delz", &JetOutput::JetZoneProperties::delz, "Zone size in z/Rg")
-        .def_readonly("dist_z", &JetOutput::JetZoneProperties::dist_z, "Distance z/Rg")
-        .def_readonly("z_delz", &JetOutput::JetZoneProperties::z_delz, "Distance z+delz/Rg")
-        .def_readonly("equpar_check", &JetOutput::JetZoneProperties::equpar_check, "Equipartition check")
-        .def_readonly("ue_ub", &JetOutput::JetZoneProperties::ue_ub, "Energy density ratio (Ue/Ub)");
+        .def_property_readonly("jet_bfield", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, jet_bfield), "Jet magnetic field")
+        .def_property_readonly("lepton_ndens", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, lepton_ndens), "Lepton number density")
+        .def_property_readonly("speed_gamma", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, speed_gamma), "Speed gamma")
+        .def_property_readonly("delta", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, delta), "Doppler factor delta")
+        .def_property_readonly("tshift", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, tshift), "Temperature shift")
+        .def_property_readonly("temp_kev", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, temp_kev), "Electron temperature in keV")
+        .def_property_readonly("grid_r", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, grid_r), "Grid radius in Rg")
+        .def_property_readonly("delz", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, delz), "Zone size in z/Rg")
+        .def_property_readonly("dist_z", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, dist_z), "Distance z/Rg")
+        .def_property_readonly("z_delz", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, z_delz), "Distance z+delz/Rg")
+        .def_property_readonly("equpar_check", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, equpar_check), "Equipartition check")
+        .def_property_readonly("ue_ub", GET_ARRAY_VIEW(JetOutput::JetZoneProperties, ue_ub), "Energy density ratio (Ue/Ub)");
 
     py::class_<JetOutput::JetBaseProperties>(m, "JetBaseProperties")
         .def(py::init<>())
@@ -76,30 +167,144 @@ PYBIND11_MODULE(pybhjet, m){
 
     py::class_<JetOutput::JetProfile>(m, "JetProfile")
         .def(py::init<>())
-        .def_readonly("z_rg", &JetOutput::JetProfile::z_rg, "Distance along jet axis (z/Rg)")
-        .def_readonly("zone_rg", &JetOutput::JetProfile::zone_rg, "Zone radius (R/Rg)")
-        .def_readonly("zone_bfield", &JetOutput::JetProfile::zone_bfield, "Magnetic field in the zone")
-        .def_readonly("zone_lepdens", &JetOutput::JetProfile::zone_lepdens, "Lepton number density in the zone")
-        .def_readonly("zone_gamma", &JetOutput::JetProfile::zone_gamma, "Lorentz factor in the zone")
-        .def_readonly("zone_eltemp", &JetOutput::JetProfile::zone_eltemp, "Electron temperature in the zone");
+        .def_property_readonly("z_rg", GET_ARRAY_VIEW(JetOutput::JetProfile, z_rg), "Distance along jet axis (z/Rg)")
+        .def_property_readonly("zone_rg", GET_ARRAY_VIEW(JetOutput::JetProfile, zone_rg), "Zone radius (R/Rg)")
+        .def_property_readonly("zone_bfield", GET_ARRAY_VIEW(JetOutput::JetProfile, zone_bfield), "Magnetic field in the zone")
+        .def_property_readonly("zone_lepdens", GET_ARRAY_VIEW(JetOutput::JetProfile, zone_lepdens), "Lepton number density in the zone")
+        .def_property_readonly("zone_gamma", GET_ARRAY_VIEW(JetOutput::JetProfile, zone_gamma), "Lorentz factor in the zone")
+        .def_property_readonly("zone_eltemp", GET_ARRAY_VIEW(JetOutput::JetProfile, zone_eltemp), "Electron temperature in the zone");
+
+    py::class_<JetOutput::ZoneCounters>(m, "ZoneCounters")
+        .def(py::init<>())
+        .def_property_readonly("nsyn", GET_ARRAY_VIEW(JetOutput::ZoneCounters, nsyn), "Synchrotron frequency bins of each zone")
+        .def_property_readonly("ncom", GET_ARRAY_VIEW(JetOutput::ZoneCounters, ncom), "Inverse Compton frequency bins of each zone")
+        .def_property_readonly("compton", GET_ARRAY_VIEW(JetOutput::ZoneCounters, compton), "1 if the zone passed Compton_check, 0 otherwise")
+        .def_property_readonly("multiple_scatters", GET_ARRAY_VIEW(JetOutput::ZoneCounters, multiple_scatters),
+                               "1 if the Compton spectrum of the zone used 15 scatters, 0 otherwise");
+
+    py::class_<JetWarning>(m, "JetWarning")
+        .def_readonly("code", &JetWarning::code, "Warning code (one of the WARNING_* flags)")
+        .def_property_readonly("name", [](const JetWarning &w) { return warning_name(w.code); }, "Name of the warning")
+        .def_readonly("message", &JetWarning::message, "Warning message")
+        .def_readonly("value", &JetWarning::value, "Quantity that raised the warning")
+        .def("__repr__", [](const JetWarning &w) {
+            return std::string("<JetWarning ") + warning_name(w.code) + ": " + w.message + ">";
+        });
+
+    m.attr("WARNING_UNPHYSICAL_PAIRS") = static_cast<unsigned>(WARNING_UNPHYSICAL_PAIRS);
+    m.attr("WARNING_BLJET_PAIRS") = static_cast<unsigned>(WARNING_BLJET_PAIRS);
+    m.attr("WARNING_PAIR_PRODUCTION") = static_cast<unsigned>(WARNING_PAIR_PRODUCTION);
+    m.def("set_print_warnings", &set_print_warnings, py::arg("enabled"),
+          "Print the warnings of every run to stdout (the default), for all instances.");
+    m.def("get_print_warnings", &get_print_warnings, "Whether the warnings of the runs are printed to stdout.");
+    m.def("set_warning_handler", [](py::object handler) {
+            if (!handler.is_none() && !PyCallable_Check(handler.ptr())) {
+                throw std::runtime_error("The warning handler must be callable or None");
+            }
+            warning_handler() = handler;
+        }, py::arg("handler"),
+        "Call handler(warning) with every JetWarning of PyBHJet.run, after the run; None removes the handler.");
+
+    m.def("set_ebl_cache", &set_ebl_cache, py::arg("entries") = 16,
+          "Number of (redshift, energy grid) pairs whose EBL attenuation is kept, for all instances; 0 disables the cache.");
+    m.def("set_ebl_table", &set_ebl_table, py::arg("z_max"), py::arg("nz") = 201,
+          "Tabulate the EBL optical depth at nz redshifts up to z_max and interpolate it, for fits with a free "
+          "redshift; z_max=0 removes the table.");
+    m.def("clear_ebl_cache", &clear_ebl_cache, "Empty the EBL attenuation cache and table, and reset the counters.");
+    m.def("ebl_cache_info", &get_ebl_cache_info,
+          "Dictionary with the hits, misses, entries, max_entries and table_redshifts of the EBL cache.");
+    m.def("check_ebl_cache",
+          [](double redsh, const std::vector<double>& energies, py::object lum) {
+              std::vector<double> en(energies.size());
+              for (size_t k = 0; k < en.size(); k++) {
+                  en[k] = energies[k] * karcst::herg / karcst::hkev;
+              }
+              std::vector<double> values(en.size(), 1.);
+              if (!lum.is_none()) {
+                  values = lum.cast<std::vector<double>>();
+              }
+              return check_ebl_cache(en, values, redsh);
+          },
+          py::arg("redsh"), py::arg("energies"), py::arg("lum") = py::none(),
+          "Largest relative difference between the EBL attenuation of lum (default ones) at the energies [keV, "
+          "source frame] taken from the cache and computed directly.");
 
     // Expose JetOutput class
     py::class_<JetOutput>(m, "JetOutput")
         .def(py::init<>())
-        .def_readonly("presyn", &JetOutput::presyn)
-        .def_readonly("postsyn", &JetOutput::postsyn)
-        .def_readonly("precom", &JetOutput::precom)
-        .def_readonly("postcom", &JetOutput::postcom)
-        .def_readonly("disk", &JetOutput::disk)
-        .def_readonly("bb", &JetOutput::bb)
-        .def_readonly("total", &JetOutput::total)
-        .def_readonly("numdens", &JetOutput::numdens)
+        .def_property_readonly("presyn", GET_SPECTRUM_POINTS(presyn))
+        .def_property_readonly("postsyn", GET_SPECTRUM_POINTS(postsyn))
+        .def_property_readonly("precom", GET_SPECTRUM_POINTS(precom))
+        .def_property_readonly("postcom", GET_SPECTRUM_POINTS(postcom))
+        .def_property_readonly("disk", GET_SPECTRUM_POINTS(disk))
+        .def_property_readonly("bb", GET_SPECTRUM_POINTS(bb))
+        .def_property_readonly("total", GET_SPECTRUM_POINTS(total))
+        .def_property_readonly("presyn_array", GET_SPECTRUM_ARRAY(presyn), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("postsyn_array", GET_SPECTRUM_ARRAY(postsyn), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("precom_array", GET_SPECTRUM_ARRAY(precom), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("postcom_array", GET_SPECTRUM_ARRAY(postcom), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("disk_array", GET_SPECTRUM_ARRAY(disk), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("bb_array", GET_SPECTRUM_ARRAY(bb), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("total_array", GET_SPECTRUM_ARRAY(total), "Read-only (n, 2) view of nu [Hz], flux [mJy]")
+        .def_property_readonly("numdens", [](const JetOutput &a) {
+                std::vector<NumDenPoint> points(a.numdens.rows());
+                for (size_t k = 0; k < points.size(); k++) {
+                    const double* row = a.numdens.values.data() + 4 * k;
+                    points[k] = {row[0], row[1], row[2], row[3]};
+                }
+                return points;
+            })
+        .def_property_readonly("numdens_array", [](const JetOutput &a) { return zone_table_view(a.numdens); },
+                               "Read-only (rows, 4) view of p [g cm s^-1], g [], n(p), n(g) of all zones")
+        .def_property_readonly("numdens_offsets", [](const JetOutput &a) { return zone_offsets(a.numdens); },
+                               "First row of every zone in numdens_array, followed by the number of rows")
         .def_readonly("jetprofile", &JetOutput::jetprofile)
         .def_readonly("spectral_properties", &JetOutput::spectral_properties)
         .def_readonly("jet_base_properties", &JetOutput::jet_base_properties)
         .def_readonly("jet_zone_properties", &JetOutput::jet_zone_properties)
-        .def_readonly("cyclosyn_zones", &JetOutput::cyclosyn_zones)
-        .def_readonly("compton_zones", &JetOutput::compton_zones) 
+        .def_property_readonly("cyclosyn_zones", [](const JetOutput &a) { return zone_points(a.cyclosyn_zones); })
+        .def_property_readonly("compton_zones", [](const JetOutput &a) { return zone_points(a.compton_zones); })
+        .def_property_readonly("cyclosyn_zones_array", [](const JetOutput &a) { return zone_table_view(a.cyclosyn_zones); },
+                               "Read-only (rows, 2) view of nu [Hz], flux [mJy] of all zones")
+        .def_property_readonly("cyclosyn_zones_offsets", [](const JetOutput &a) { return zone_offsets(a.cyclosyn_zones); },
+                               "First row of every zone in cyclosyn_zones_array, followed by the number of rows")
+        .def_property_readonly("compton_zones_array", [](const JetOutput &a) { return zone_table_view(a.compton_zones); },
+                               "Read-only (rows, 2) view of nu [Hz], flux [mJy] of all zones")
+        .def_property_readonly("compton_zones_offsets", [](const JetOutput &a) { return zone_offsets(a.compton_zones); },
+                               "First row of every zone in compton_zones_array, followed by the number of rows")
+        .def_property_readonly("zone_bounds", [](const JetOutput &a) {
+                py::array_t<double> bounds({static_cast<py::ssize_t>(a.zone_bounds.size() / 2), static_cast<py::ssize_t>(2)});
+                std::copy(a.zone_bounds.begin(), a.zone_bounds.end(), bounds.mutable_data());
+                return bounds;
+            }, "(nzones, 2) array of z and z + delz [Rg] of every zone of the per-zone output")
+        .def_property_readonly("timings", [](const JetOutput &o) {
+                py::dict timings;
+                timings["external"] = o.timings.external;
+                timings["equipartition"] = o.timings.equipartition;
+                timings["particles"] = o.timings.particles;
+                timings["cyclosyn"] = o.timings.cyclosyn;
+                timings["compton"] = o.timings.compton;
+                timings["summing"] = o.timings.summing;
+                timings["ebl"] = o.timings.ebl;
+                timings["output"] = o.timings.output;
+                return timings;
+            }, "Wall time [s] of each stage of the run (with set_instrumentation)")
+        .def_readonly("zone_counters", &JetOutput::zone_counters, "Work of each zone (with set_instrumentation)")
+        .def_readonly("warnings", &JetOutput::warnings, "List of the JetWarnings raised by the run")
+        .def_readonly("warning_flags", &JetOutput::warning_flags, "Bitwise or of the codes of the warnings raised by the run")
+        .def_property_readonly("warning_counts", [](const JetOutput &o) {
+                py::dict counts;
+                for (const JetWarning& w : o.warnings) {
+                    const char* name = warning_name(w.code);
+                    counts[name] = counts.contains(name) ? counts[name].cast<size_t>() + 1 : 1;
+                }
+                return counts;
+            }, "Number of warnings of each kind raised by the run")
+        .def_readonly("zones_computed", &JetOutput::zones_computed, "Number of zones computed, sub-zones included")
+        .def_readonly("zones_reused", &JetOutput::zones_reused,
+                      "Number of those zones taken from the previous run (set_zone_reuse)")
+        .def_readonly("truncation_error", &JetOutput::truncation_error,
+                      "Estimated fraction of the total missed by the zones the adaptive grid skipped")
         ;
 
     // Expose BhJetClass - for running 
@@ -107,12 +312,143 @@ PYBIND11_MODULE(pybhjet, m){
         .def(py::init<>(), "Initialize the BHJet model.")
         .def("load_params", &BhJetClass::load_params, "Load parameters from a file.")
         .def("print_parameters", &BhJetClass::print_parameters, "Print all parameters with units.")
-        .def("run", &BhJetClass::run, "Run the BHJet model.")
+        .def("run", [](BhJetClass &a) {
+                dispatch_warnings(locked(a, [&] {
+                    a.run();
+                    return a.get_output().warnings;
+                }));
+            },
+            "Run the BHJet model. The GIL is released, so separate instances can run in parallel threads; "
+            "threads sharing an instance take turns.")
+        .def("run", [](BhJetClass &a, const std::vector<double>& energies) {
+                // 28 values that are not an energy grid are most likely a parameter array
+                bool increasing = std::adjacent_find(energies.begin(), energies.end(),
+                                                     std::greater_equal<double>()) == energies.end();
+                if (energies.size() == 28 && !increasing) {
+                    throw std::runtime_error("run(energy_grid) got 28 values that are not increasing energies; "
+                                                "use run_parameters(params) to run with an array of the 28 parameters");
+                }
+                dispatch_warnings(locked(a, [&] {
+                    a.run(energies);
+                    return a.get_output().warnings;
+                }));
+            },
+            py::arg("energy_grid"),
+            "Set the observed energies [keV] to compute the spectrum on, then run the BHJet model.")
+        .def("run_parameters", [](BhJetClass &a, py::array_t<double> params) {
+                py::buffer_info buf = params.request();
+                if (buf.ndim != 1) {
+                    throw std::runtime_error("params must be a one dimensional array");
+                }
+                std::vector<double> param_array(params.data(), params.data() + params.size());
+                dispatch_warnings(locked(a, [&] {
+                    a.run_parameters(param_array);
+                    return a.get_output().warnings;
+                }));
+            },
+            py::arg("params"),
+            "Set all 28 parameters from an array in the order of the parameter file, then run the BHJet model.")
+        .def("set_energy_grid", &BhJetClass::set_energy_grid, py::arg("energy_grid"),
+             "Set the observed energies [keV] to compute the spectrum on; an empty grid restores the default grid.")
+        .def("run_batch",
+            [](const BhJetClass &a, py::array_t<double, py::array::c_style | py::array::forcecast> param_matrix,
+               size_t n_threads) {
+                py::buffer_info buf = param_matrix.request();
+                if (buf.ndim != 2 || buf.shape[1] != 28) {
+                    throw std::runtime_error("param_matrix must have shape (N, 28)");
+                }
+                size_t nrows = buf.shape[0];
+                std::vector<double> params(param_matrix.data(), param_matrix.data() + param_matrix.size());
+                size_t nbins = 0;
+                std::vector<double> spectra = locked(a, [&] {
+                    nbins = a.get_energy_grid().size();
+                    return a.run_batch(params, n_threads);
+                });
+                py::array_t<double> result({nrows, nbins});
+                std::copy(spectra.begin(), spectra.end(), result.mutable_data());
+                return result;
+            },
+            py::arg("param_matrix"), py::arg("n_threads") = 0,
+            "Run the model for each row of an (N, 28) parameter array on n_threads native threads "
+            "(0: one per core) and return the (N, ne) array of total fluxes [mJy] on get_energy_grid().")
+        .def("jacobian",
+            [](const BhJetClass &a, py::object params, const std::vector<std::string>& free,
+               py::object step, bool central, size_t n_threads) {
+                std::vector<double> param_array;
+                if (!params.is_none()) {
+                    param_array = params.cast<std::vector<double>>();
+                }
+                // one step per parameter from a sequence or an array with at least one dimension, and
+                // otherwise one step for all of them from any number, NumPy scalars included
+                bool sequence = py::isinstance<py::array>(step) ? py::array(step).ndim() > 0
+                                                                : py::isinstance<py::sequence>(step);
+                std::vector<double> steps;
+                if (sequence) {
+                    steps = step.cast<std::vector<double>>();
+                } else {
+                    steps.push_back(step.cast<double>());
+                }
+                size_t nbins = 0;
+                std::vector<double> derivatives = locked(a, [&] {
+                    nbins = a.get_energy_grid().size();
+                    return a.jacobian(param_array, free, steps, central, n_threads);
+                });
+                py::array_t<double> result({free.size(), nbins});
+                std::copy(derivatives.begin(), derivatives.end(), result.mutable_data());
+                return result;
+            },
+            py::arg("params"), py::arg("free"), py::arg("step") = 1e-2,
+            py::arg("central") = true, py::arg("n_threads") = 0,
+            "Derivatives [mJy per unit] of the total flux on get_energy_grid() with respect to the free parameters, "
+            "as a (k, ne) array, from finite differences run on n_threads native threads. params is an array of the 28 "
+            "parameters (None: the current ones); step is relative, or in dex for scale parameters such as Mbh, jetrat "
+            "and f_sc; parameters that cannot be negative get a forward difference where the central one would step "
+            "below zero. Forward differences (central=False) reuse the last run if it had the same parameters.")
+        .def("set_resolution", py::overload_cast<const std::string&>(&BhJetClass::set_resolution),
+             py::arg("preset"),
+             "Set the resolution of the runs to a preset: draft, standard (default) or publication.")
+        .def("set_resolution", py::overload_cast<size_t, size_t, size_t, size_t>(&BhJetClass::set_resolution),
+             py::arg("nz") = 100, py::arg("nel") = 70, py::arg("syn_res") = 10, py::arg("com_res") = 6,
+             "Set the number of zones, particle distribution bins and synchrotron/Compton bins per decade.")
+        .def("set_adaptive_zones", &BhJetClass::set_adaptive_zones,
+             py::arg("enabled") = true, py::arg("tolerance") = 1e-3, py::arg("refine") = 4,
+             "Refine the zones near the nozzle, z_acc and z_diss in refine sub-zones, and stop once the "
+             "zones left are estimated to add less than a fraction tolerance of the total.")
+        .def("set_zone_reuse", &BhJetClass::set_zone_reuse, py::arg("enabled") = true,
+             "Start the next run at z_diss, from the state of the previous one, when only f_nth, f_pl, pspec, "
+             "f_heat, f_beta, f_sc or the observer parameters changed (on by default).")
+        .def("set_zone_threads", &BhJetClass::set_zone_threads, py::arg("n_threads") = 0,
+             "Compute the zones of each run in n_threads native threads (0 for one per core, 1 to turn it off); "
+             "the spectrum is the same bit for bit, and runs with infosw >= 2 use one thread.")
+        .def("set_log_interpolation", &BhJetClass::set_log_interpolation, py::arg("enabled") = true,
+             "Interpolate the spectra on log-uniform grids with Catmull-Rom kernels instead of Akima splines "
+             "(off by default): faster, and within 1% of the Akima spectra where the grid resolves them.")
+        .def("set_instrumentation", &BhJetClass::set_instrumentation, py::arg("enabled") = true,
+             "Record the wall time of each stage (output.timings) and the work of each zone (output.zone_counters).")
+        .def("set_output_files", &BhJetClass::set_output_files, py::arg("enabled") = true,
+             py::arg("directory") = "Output", py::arg("format") = "text",
+             "Write the output of the runs (infosw >= 1) to directory instead of the JetOutput, as the usual "
+             "text files (format=\"text\") or as a single bhjet_output.npz (format=\"npz\"); read it with load_output.")
+        .def("get_resolution", &BhJetClass::get_resolution,
+             "Dictionary with the number of zones, particle bins and synchrotron/Compton bins per decade.")
+        .def("get_energy_grid", &BhJetClass::get_energy_grid, "Frequencies [Hz] of the spectral bins returned by run and run_batch.")
+        .def("get_total_flux", [](const BhJetClass &a) {
+                std::vector<double> flux = locked(a, [&] { return a.get_total_flux(); });
+                return py::array_t<double>(flux.size(), flux.data());
+            }, "Total flux [mJy] of the last run on get_energy_grid().")
         // .def("run_singlezone", &BhJetClass::run_singlezone, "Run the BHJet Single Zone model.")
-        .def("get_output", &BhJetClass::get_output, py::return_value_policy::reference, "Retrieve the output from the run.")
+        .def("get_output", [](const BhJetClass &a) {
+                return locked(a, [&] { return a.get_output(); });
+            },
+            "Retrieve the output of the last run. It is taken under the lock of the instance and is not changed "
+            "by later runs; the arrays are shared with the instance, not copied.")
         // Expose generic parameter getter and setter
         .def("get_parameter", &BhJetClass::get_parameter, "Get the value of a parameter by name.")
         .def("set_parameter", &BhJetClass::set_parameter, "Set the value of a parameter by name.")
+        .def("set_parameters", &BhJetClass::set_parameters, py::arg("values"),
+             "Set the values of several parameters from a dictionary of names and values.")
+        .def("set_parameter_array", SET_ARGS_VEC(BhJetClass, set_parameter_array, double), py::arg("params"),
+             "Set all 28 parameters from an array in the order of the parameter file.")
         .def("get_parameter_names", &BhJetClass::get_parameter_names, "Get the names of all parameters.")
         // Implement __getitem__ and __setitem__ for dictionary-like access
         .def("__getitem__", &BhJetClass::get_parameter, "Get the value of a parameter by name.")
@@ -1,4 +1,6 @@
+#include <atomic>
 #include <cmath>
+#include <sstream>
 
 #include <kariba/Radiation.hpp>
 #include <kariba/constants.hpp>
@@ -7,6 +9,24 @@
 
 namespace karcst = kariba::constants;    // alias the kariba::constants namespace
 
+static std::atomic<bool> print_warnings(true);
+
+void set_print_warnings(bool enabled) {
+    print_warnings = enabled;
+}
+
+bool get_print_warnings() {
+    return print_warnings;
+}
+
+void jet_warning(JetOutput& output, unsigned code, const std::string& message, double value) {
+    output.warnings.push_back({code, message, value});
+    output.warning_flags |= code;
+    if (print_warnings) {
+        std::cout << message + "\n";
+    }
+}
+
 // This function determines very, very roughly whether the Compton emission from
 // a zone is worth computing or not. The criteria are a) are we in the first
 // zone (which we almost always care about because it's the corona) or b) do we
@@ -52,48 +72,76 @@ bool Compton_check(bool IsShock, size_t i, double Mbh, double Nj, double Urad, d
     }
 }
 
-void param_write(const std::vector<double>& par, const std::string& path) {
-    std::ofstream file;
-    file.open(path, std::ios::trunc);
-
-    for (size_t k = 0; k < 27; k++) {
-        file << par[k] << std::endl;
-    }
-
-    file.close();
-}
-
-// Plots a given array in units of ergs (x axis) and erg/s/Hz (y axis) to the
-// file on the provided path. The overloard with or without const is to be able
-// to pass arrays directly from the radiation libraries note: the factor 1+z in
-// the specific luminosity calculation is to ensure that the output spectrum
-// only moves to lower frequency, not up/down.
-void plot_write(size_t size, const std::vector<double>& en, const std::vector<double>& lum,
-                const std::string& path, double dist, double redsh) {
-    std::ofstream file;
-    file.open(path, std::ios::app);
-
-    for (size_t k = 0; k < size; k++) {
-        file << en[k] / (karcst::herg * (1. + redsh)) << " "
-             << lum[k] * (1. + redsh) / (4. * karcst::pi * std::pow(dist, 2.) * karcst::mjy)
-             << std::endl;
+bool resolution_preset(const std::string& name, run_pars& opts) {
+    if (name == "draft") {
+        opts.nz = 50;
+        opts.nel = 40;
+        opts.syn_res = 5;
+        opts.com_res = 3;
+    } else if (name == "standard") {
+        opts.nz = 100;
+        opts.nel = 70;
+        opts.syn_res = 10;
+        opts.com_res = 6;
+    } else if (name == "publication") {
+        opts.nz = 200;
+        opts.nel = 120;
+        opts.syn_res = 20;
+        opts.com_res = 12;
+    } else {
+        return false;
     }
-
-    file.close();
+    return true;
 }
 
-// Same as above but for particle distributions
-void plot_write(size_t size, const std::vector<double>& p, const std::vector<double>& g,
-                const std::vector<double>& pdens, const std::vector<double>& gdens,
-                const std::string& path) {
-
-    std::ofstream file;
-    file.open(path.c_str(), std::ios::app);
-    for (size_t k = 0; k < size; k++) {
-        file << p[k] << " " << g[k] << " " << pdens[k] << " " << gdens[k] << std::endl;
+// Dependency table of the stages of a run, see JetStage. The external fields change Urad and the
+// seed photons of every zone; the redshift moves a user energy grid to the source frame; f_nth,
+// f_pl, pspec, f_heat, f_beta and f_sc only enter the zones with non-thermal particles. A stage
+// also has to be redone whenever a stage before it is.
+namespace {
+constexpr unsigned ALL_ZONES = STAGE_THERMAL_ZONES | STAGE_NONTHERMAL_ZONES;
+constexpr unsigned EXTERNAL = STAGE_EXTERNAL | ALL_ZONES;
+}    // namespace
+
+const unsigned parameter_stages[28] = {
+    EXTERNAL | STAGE_OBSERVER,     // Mbh
+    EXTERNAL,                      // theta
+    STAGE_OBSERVER,                // dist
+    ALL_ZONES | STAGE_OBSERVER,    // redsh
+    ALL_ZONES,                     // jetrat
+    ALL_ZONES | STAGE_OBSERVER,    // r_0
+    ALL_ZONES,                     // z_diss
+    ALL_ZONES,                     // z_acc
+    ALL_ZONES,                     // z_max
+    ALL_ZONES,                     // t_e
+    STAGE_NONTHERMAL_ZONES,        // f_nth
+    STAGE_NONTHERMAL_ZONES,        // f_pl
+    STAGE_NONTHERMAL_ZONES,        // pspec
+    STAGE_NONTHERMAL_ZONES,        // f_heat
+    STAGE_NONTHERMAL_ZONES,        // f_beta
+    STAGE_NONTHERMAL_ZONES,        // f_sc
+    ALL_ZONES,                     // p_beta
+    ALL_ZONES,                     // sig_acc
+    EXTERNAL,                      // l_disk
+    EXTERNAL,                      // r_in
+    EXTERNAL,                      // r_out
+    EXTERNAL,                      // compar1
+    EXTERNAL,                      // compar2
+    EXTERNAL,                      // compar3
+    EXTERNAL,                      // compsw
+    ALL_ZONES,                     // velsw
+    STAGE_OBSERVER,                // infosw
+    STAGE_OBSERVER,                // EBLsw
+};
+
+std::vector<double> stage_key(const std::vector<double>& param, unsigned stage) {
+    std::vector<double> key;
+    for (size_t k = 0; k < 28; k++) {
+        if (parameter_stages[k] & stage) {
+            key.push_back(param[k]);
+        }
     }
-
-    file.close();
+    return key;
 }
 
 // This function takes the observed arrays of the Cyclosyn and Compton classes
@@ -102,32 +150,64 @@ void plot_write(size_t size, const std::vector<double>& p, const std::vector<dou
 void sum_counterjet(size_t size, const std::vector<double>& input_en,
                     const std::vector<double>& input_lum, std::vector<double>& en,
                     std::vector<double>& lum) {
-    double en_cj_min, en_j_min, en_cj_max, en_j_max, einc;
-    std::vector<double> en_j(size, 0.0);
-    std::vector<double> en_cj(size, 0.0);
-    std::vector<double> lum_j(size, 0.0);
-    std::vector<double> lum_cj(size, 0.0);
+    JetWorkspace ws;
+    sum_counterjet(size, input_en, input_lum, en, lum, ws);
+}
+
+// Same as above, with the scratch arrays and splines taken from a workspace. With ws.log_interp,
+// the jet and counterjet grids of the radiation classes, which are log-uniform, are interpolated
+// with the kernels of loginterp.hpp instead of the Akima splines.
+void sum_counterjet(size_t size, const std::vector<double>& input_en,
+                    const std::vector<double>& input_lum, std::vector<double>& en,
+                    std::vector<double>& lum, JetWorkspace& ws) {
+    double en_cj_min, en_j_min, en_cj_max, en_j_max, einc, log_cj_min;
+    std::vector<double>& en_j = ws.en_j;
+    std::vector<double>& en_cj = ws.en_cj;
+    std::vector<double>& lum_j = ws.lum_j;
+    std::vector<double>& lum_cj = ws.lum_cj;
+    std::vector<double>& log_en = ws.log_en;
+    en_j.resize(size);
+    en_cj.resize(size);
+    lum_j.resize(size);
+    lum_cj.resize(size);
+    log_en.resize(size);
 
     en_j_min = input_en[0];
     en_cj_min = input_en[size];
     en_j_max = input_en[size - 1];
     en_cj_max = input_en[2 * size - 1];
-    einc = (std::log10(en_j_max) - std::log10(en_cj_min)) / static_cast<double>(size - 1);
+    log_cj_min = std::log10(en_cj_min);
+    einc = (std::log10(en_j_max) - log_cj_min) / static_cast<double>(size - 1);
 
     for (size_t i = 0; i < size; i++) {
-        en[i] = std::pow(10., std::log10(en_cj_min) + static_cast<double>(i) * einc);
+        log_en[i] = log_cj_min + static_cast<double>(i) * einc;
+        en[i] = std::pow(10., log_en[i]);
         en_j[i] = input_en[i];
         en_cj[i] = input_en[i + size];
         lum_j[i] = std::max(input_lum[i], 1.e-50);
         lum_cj[i] = std::max(input_lum[i + size], 1.e-50);
     }
 
-    gsl_interp_accel* acc_j = gsl_interp_accel_alloc();
-    gsl_spline* spline_j = gsl_spline_alloc(gsl_interp_akima, size);
+    // the counterjet contributes below en_cj_max, the jet from en_j_min up
+    size_t first_j = std::lower_bound(en.begin(), en.begin() + size, en_j_min) - en.begin();
+    size_t last_cj = std::lower_bound(en.begin(), en.begin() + size, en_cj_max) - en.begin();
+    last_cj = std::max(last_cj, first_j);
+    if (ws.log_interp && ws.interp_cj.set_grids(en_cj.data(), size, log_en.data(), 0, last_cj) &&
+        ws.interp_j.set_grids(en_j.data(), size, log_en.data(), first_j, size)) {
+        std::fill(lum.begin(), lum.begin() + size, 0.);
+        ws.interp_cj.add(lum_cj.data(), lum.data());
+        ws.interp_j.add(lum_j.data(), lum.data());
+        lum[0] = lum_cj[0];
+        lum[size - 1] = lum_j[size - 1];
+        return;
+    }
+
+    gsl_interp_accel* acc_j = ws.akima_acc(0);
+    gsl_spline* spline_j = ws.akima(size, 0);
     gsl_spline_init(spline_j, en_j.data(), lum_j.data(), size);
 
-    gsl_interp_accel* acc_cj = gsl_interp_accel_alloc();
-    gsl_spline* spline_cj = gsl_spline_alloc(gsl_interp_akima, size);
+    gsl_interp_accel* acc_cj = ws.akima_acc(1);
+    gsl_spline* spline_cj = ws.akima(size, 1);
     gsl_spline_init(spline_cj, en_cj.data(), lum_cj.data(), size);
 
     for (size_t i = 0; i < size; i++) {
@@ -148,17 +228,37 @@ void sum_counterjet(size_t size, const std::vector<double>& input_en,
         }
     }
 
-    gsl_spline_free(spline_j), gsl_interp_accel_free(acc_j);
-    gsl_spline_free(spline_cj), gsl_interp_accel_free(acc_cj);
-
     return;
 }
 
 // Calculates the redshifted spectrum as seen by the observer, starting from the
 // emitted spectrum in the frame comoving with the source. Only applicable to
-// (distant) AGN, not to galactic XRBs.
+// (distant) AGN, not to galactic XRBs. With log_interp and a log-uniform grid the redshifted
+// energies are all shifted by the same fraction of a bin, so the spectrum is interpolated with the
+// same Catmull-Rom weights for every bin instead of an Akima spline.
 void output_spectrum(size_t size, std::vector<double>& en, std::vector<double>& lum,
-                     std::vector<double>& spec, double redsh, double dist) {
+                     std::vector<double>& spec, double redsh, double dist, bool log_interp) {
+    double norm = (1. + redsh) / (4. * karcst::pi * std::pow(dist, 2.) * karcst::mjy);
+    double log_first, dlog;
+    if (log_interp && redsh >= 0. && log_uniform(en.data(), size, log_first, dlog)) {
+        double shift = std::log10(1. + redsh) / dlog;
+        size_t offset = static_cast<size_t>(std::floor(shift));
+        double f = shift - std::floor(shift);
+        double w[4];
+        for (size_t k = 0; k < size; k++) {
+            if (en[k] * (1. + redsh) < en[size - 1]) {
+                size_t i = std::min(k + offset, size - 2);
+                const double* y = lum.data() + catmull_rom_stencil(i, f, size, w);
+                double value = w[0] * y[0] + w[1] * y[1] + w[2] * y[2] + w[3] * y[3];
+                value = std::min(std::max(value, std::min(lum[i], lum[i + 1])),
+                                 std::max(lum[i], lum[i + 1]));
+                spec[k] = std::log10(value * norm);
+            } else {
+                spec[k] = -50.;
+            }
+        }
+        return;
+    }
 
     gsl_interp_accel* acc = gsl_interp_accel_alloc();
     gsl_spline* input_spline = gsl_spline_alloc(gsl_interp_akima, size);
@@ -166,9 +266,7 @@ void output_spectrum(size_t size, std::vector<double>& en, std::vector<double>&
 
     for (size_t k = 0; k < size; k++) {
         if (en[k] * (1. + redsh) < en[size - 1]) {
-            spec[k] =
-                std::log10(gsl_spline_eval(input_spline, en[k] * (1. + redsh), acc) * (1. + redsh) /
-                           (4. * karcst::pi * std::pow(dist, 2.) * karcst::mjy));
+            spec[k] = std::log10(gsl_spline_eval(input_spline, en[k] * (1. + redsh), acc) * norm);
         } else {
             spec[k] = -50.;
         }
@@ -184,8 +282,29 @@ void output_spectrum(size_t size, std::vector<double>& en, std::vector<double>&
 // ShSDisk class, which are const
 void sum_zones(size_t size_in, size_t size_out, std::vector<double>& input_en,
                std::vector<double>& input_lum, std::vector<double>& en, std::vector<double>& lum) {
-    gsl_interp_accel* acc = gsl_interp_accel_alloc();
-    gsl_spline* input_spline = gsl_spline_alloc(gsl_interp_akima, size_in);
+    JetWorkspace ws;
+    sum_zones(size_in, size_out, input_en, input_lum, en, lum, ws);
+}
+
+void sum_zones(size_t size_in, size_t size_out, std::vector<double>& input_en,
+               std::vector<double>& input_lum, std::vector<double>& en, std::vector<double>& lum,
+               JetWorkspace& ws) {
+    // with ws.log_interp: the zone spectra come on log-uniform grids (from sum_counterjet) and en
+    // is increasing, so the bins inside the zone grid are found by bisection and summed with the
+    // log grid kernel
+    if (ws.log_interp) {
+        auto en_end = en.begin() + size_out;
+        size_t first = std::upper_bound(en.begin(), en_end, input_en[0]) - en.begin();
+        size_t last = std::lower_bound(en.begin() + first, en_end, input_en[size_in - 1]) - en.begin();
+        if (ws.interp_zones.set_grids(input_en.data(), size_in, ws.log_grid(en, size_out).data(),
+                                      first, last)) {
+            ws.interp_zones.add(input_lum.data(), lum.data());
+            return;
+        }
+    }
+
+    gsl_interp_accel* acc = ws.akima_acc();
+    gsl_spline* input_spline = ws.akima(size_in);
     gsl_spline_init(input_spline, input_en.data(), input_lum.data(), size_in);
 
     for (size_t i = 0; i < size_out; i++) {
@@ -193,14 +312,20 @@ void sum_zones(size_t size_in, size_t size_out, std::vector<double>& input_en,
             lum[i] = lum[i] + gsl_spline_eval(input_spline, en[i], acc);
         }
     }
-    gsl_spline_free(input_spline), gsl_interp_accel_free(acc);
 }
 
 void sum_ext(size_t size_in, size_t size_out, const std::vector<double>& input_en,
              const std::vector<double>& input_lum, std::vector<double>& en,
              std::vector<double>& lum) {
-    gsl_interp_accel* acc = gsl_interp_accel_alloc();
-    gsl_spline* input_spline = gsl_spline_alloc(gsl_interp_akima, size_in);
+    JetWorkspace ws;
+    sum_ext(size_in, size_out, input_en, input_lum, en, lum, ws);
+}
+
+void sum_ext(size_t size_in, size_t size_out, const std::vector<double>& input_en,
+             const std::vector<double>& input_lum, std::vector<double>& en,
+             std::vector<double>& lum, JetWorkspace& ws) {
+    gsl_interp_accel* acc = ws.akima_acc();
+    gsl_spline* input_spline = ws.akima(size_in);
     gsl_spline_init(input_spline, input_en.data(), input_lum.data(), size_in);
 
     for (size_t i = 0; i < size_out; i++) {
@@ -208,7 +333,6 @@ void sum_ext(size_t size_in, size_t size_out, const std::vector<double>& input_e
             lum[i] = lum[i] + gsl_spline_eval(input_spline, en[i], acc);
         }
     }
-    gsl_spline_free(input_spline), gsl_interp_accel_free(acc);
 }
 
 // Simple numerical integral to calculate the luminosity between numin and numax
@@ -251,35 +375,26 @@ double photon_index(size_t size, double numin, double numax, const std::vector<d
     return gamma;
 }
 
-// Prepares files for above printing functions at the start of the run. There
-// are two reasons this exists: 1) specifying the units of the output obviously
-// makes things easier to read and 2) S-lang does not allow to pass ofstream
-// objects to functions, so we need to pass a path and open the file from the
-// path inside the write function. As a result, it's impossible to just truncate
-// and clean the files at the start of each iteration. This is only relevant for
-// the cyclosyn_zones, compton_zones, and numdens files
-void clean_file(std::string path, int check) {
-    std::ofstream file;
-    file.open(path.c_str(), std::ios::trunc);
-
+// Header line (without the newline) of the output files of OutputWriter, which specifies the units
+// of the output; empty if check is not supported
+std::string file_header(int check) {
+    std::ostringstream header;
     if (check == 2) {
-        file << "#nu [Hz]: " << " Flux [mJy]:" << std::endl;
+        header << "#nu [Hz]: " << " Flux [mJy]:";
     } else if (check == 4) {
-        file << "#p [g cm s-1]: " << " g []: " << " n(p) [# cm^-3 p^-1]: "
-             << " n(g) [# cm^-3 g^-1]:" << std::endl;
+        header << "#p [g cm s-1]: " << " g []: " << " n(p) [# cm^-3 p^-1]: "
+               << " n(g) [# cm^-3 g^-1]:";
     } else if (check == 6) {
-        file << "#Z [Rg]: " << " R [Rg]: " << " B(z) [G]: "
-             << " ne(z) [# cm^-3]: "
-             << " gamma(z): " << " Te(z) [kev]:" << std::endl;
+        header << "#Z [Rg]: " << " R [Rg]: " << " B(z) [G]: "
+               << " ne(z) [# cm^-3]: "
+               << " gamma(z): " << " Te(z) [kev]:";
     } else if (check == 7) {
-        file << "#0.3-5keV Disk: " << " 0.3-300keV Compton: "
-             << " 1-10 keV total: "
-             << " 4-6 GHz total: " << " 10-100 keV PL estimate: "
-             << " 10-100 GHz spectral index estimate: " << " Compactness:" << std::endl;
-    } else {
-        std::cout << "File to be cleaned not supported" << std::endl;
+        header << "#0.3-5keV Disk: " << " 0.3-300keV Compton: "
+               << " 1-10 keV total: "
+               << " 4-6 GHz total: " << " 10-100 keV PL estimate: "
+               << " 10-100 GHz spectral index estimate: " << " Compactness:";
     }
-    file.close();
+    return header.str();
 }
 
 // Used for interpolation by slang code
@@ -322,25 +437,36 @@ void jetinterp(std::vector<double>& ear, std::vector<double>& energ, std::vector
 }
 
 
-// Used to write arrays to JetOutput --- instead of plot_write functions: 
-void store_output(int size, const std::vector<double>& en, const std::vector<double>& lum, std::vector<DataPoint>& output_vector, double dist, double redsh) {
+// Used to write arrays to JetOutput: appends the rows of a zone to a per-zone table
+void store_output(int size, const std::vector<double>& en, const std::vector<double>& lum, ZoneTable& output_table, double dist, double redsh) {
 
     for (int k = 0; k < size; ++k) {
         double energy = en[k] / (karcst::herg * (1.0 + redsh));
         double flux = lum[k] * (1.0 + redsh) / (4.0 * karcst::pi * pow(dist, 2.0) * karcst::mjy);
-        output_vector.push_back({energy, flux});
+        output_table.values.push_back(energy);
+        output_table.values.push_back(flux);
+    }
+}
+
+// Same as above, but fills the energy/flux buffers of a whole spectrum at once
+void store_output(int size, const std::vector<double>& en, const std::vector<double>& lum, SpectrumArrays& output_arrays, double dist, double redsh) {
+
+    output_arrays.resize(size);
+    double* energy = output_arrays.energy();
+    double* flux = output_arrays.flux();
+    for (int k = 0; k < size; ++k) {
+        energy[k] = en[k] / (karcst::herg * (1.0 + redsh));
+        flux[k] = lum[k] * (1.0 + redsh) / (4.0 * karcst::pi * pow(dist, 2.0) * karcst::mjy);
     }
 }
 
-// Used to write arrays to JetOutput --- instead of plot_write functions: 
-void store_numdens(int size, const std::vector<double>& p, const std::vector<double>& g, const std::vector<double>& n_p, const std::vector<double>& n_g, std::vector<NumDenPoint>& output_vector) {
+// Same for the particle distributions of a zone
+void store_numdens(int size, const std::vector<double>& p, const std::vector<double>& g, const std::vector<double>& n_p, const std::vector<double>& n_g, ZoneTable& output_table) {
 
     for (int k = 0; k < size; ++k) {
-        NumDenPoint point;
-        point.momentum = p[k];
-        point.gamma = g[k];
-        point.n_p = n_p[k];
-        point.n_g = n_g[k];
-        output_vector.push_back(point);
+        output_table.values.push_back(p[k]);
+        output_table.values.push_back(g[k]);
+        output_table.values.push_back(n_p[k]);
+        output_table.values.push_back(n_g[k]);
     }
 }
\ No newline at end of file
@@ -4,6 +4,14 @@
 
 from .pybhjet import *  
 from .bhjet_plotting import * 
+from .bhjet_parallel import *
+from .bhjet_emulator import *
+from .bhjet_tuning import *
+from .bhjet_warnings import *
+from .bhjet_output import *
+from .bhjet_pool import *
 
 # this leads to 3ml being imported with every pybhjet import
-# from .pybhjet_3ml import *
\ No newline at end of file
+# from .pybhjet_3ml import *
+# the table model tool needs astropy, import it with
+# from pybhjet.bhjet_table import make_table_model
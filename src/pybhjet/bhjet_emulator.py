@@ -0,0 +1,302 @@
+import time
+
+import numpy as np
+
+from .pybhjet import PyBHJet
+from .bhjet_parallel import PARAMETER_NAMES
+
+
+def latin_hypercube(n, ndim, rng):
+    """
+    Return n points of a Latin hypercube sample of the unit cube in ndim dimensions.
+    """
+    points = (np.arange(n)[:, None] + rng.random((n, ndim))) / n
+    for i in range(ndim):
+        points[:, i] = rng.permutation(points[:, i])
+    return points
+
+
+class BHJetEmulator:
+    """
+    Fast surrogate of the BHJet total spectrum over a box of free parameters.
+
+    The log spectra of the training runs are compressed with a principal component analysis,
+    and the component weights are interpolated with a cubic radial basis function (plus a linear
+    polynomial) in the unit cube of the free parameters. The training points are added in rounds,
+    preferably close to where the previous round found the largest errors, and the finished
+    emulator is checked against the full model on independent held-out points.
+
+    Args:
+        param_ranges (dict): Free parameter names and their ranges, (min, max) or
+            (min, max, "log") for parameters sampled and interpolated in log10.
+        param_file (str): ip.dat-style file with the values of the fixed parameters.
+        energies (array): Energies in keV of the emulated spectrum, by default 201 points
+            log spaced between 1e-10 and 1e10 keV.
+    """
+
+    def __init__(self, param_ranges, param_file=None, energies=None):
+        self.names = list(param_ranges)
+        for name in self.names:
+            if name not in PARAMETER_NAMES:
+                raise ValueError(f"Unknown BHJet parameter: {name}")
+        self.log = np.array([len(param_ranges[name]) > 2 and param_ranges[name][2] == "log"
+                             for name in self.names])
+        self.lower = np.array([float(param_ranges[name][0]) for name in self.names])
+        self.upper = np.array([float(param_ranges[name][1]) for name in self.names])
+        if np.any(self.upper <= self.lower) or np.any(self.lower[self.log] <= 0):
+            raise ValueError("Parameter ranges must have min < max, and min > 0 for log parameters")
+
+        self.energies = np.logspace(-10, 10, 201) if energies is None else np.asarray(energies, dtype=float)
+        self.param_file = param_file
+
+        bhjet = PyBHJet()
+        if param_file is not None:
+            bhjet.load_params(param_file)
+        self.fixed = np.array([bhjet.get_parameter(name) for name in PARAMETER_NAMES])
+        self.fixed[PARAMETER_NAMES.index("infosw")] = 0
+
+        self.x_train = np.empty((0, len(self.names)))
+        self.y_train = np.empty((0, len(self.energies)))
+        self.validation = None
+        self.error_scale = np.inf
+        self.run_seconds = 0.
+        self.run_count = 0
+
+    def _to_unit(self, params):
+        params = np.atleast_2d(np.asarray(params, dtype=float))
+        lower = np.where(self.log, np.log10(self.lower), self.lower)
+        upper = np.where(self.log, np.log10(self.upper), self.upper)
+        values = np.where(self.log, np.log10(np.abs(params) + 1e-300), params)
+        return (values - lower) / (upper - lower)
+
+    def _from_unit(self, points):
+        lower = np.where(self.log, np.log10(self.lower), self.lower)
+        upper = np.where(self.log, np.log10(self.upper), self.upper)
+        values = lower + points * (upper - lower)
+        return np.where(self.log, 10**values, values)
+
+    def _run(self, points, n_threads):
+        """
+        Run the full model at points of the unit cube and return the log10 fluxes [mJy].
+        """
+        bhjet = PyBHJet()
+        bhjet.set_energy_grid(self.energies)
+        rows = np.tile(self.fixed, (len(points), 1))
+        rows[:, [PARAMETER_NAMES.index(name) for name in self.names]] = self._from_unit(points)
+
+        start = time.perf_counter()
+        flux = bhjet.run_batch(rows, n_threads)
+        self.run_seconds += time.perf_counter() - start
+        self.run_count += len(points)
+        return np.log10(np.maximum(flux, 1e-100))
+
+    def fit(self, tolerance=1e-8):
+        """
+        Compress the training spectra and solve for the interpolation weights.
+
+        Args:
+            tolerance (float): Fraction of the spectral variance left out of the kept components.
+        """
+        self.mean = self.y_train.mean(axis=0)
+        _, s, vt = np.linalg.svd(self.y_train - self.mean, full_matrices=False)
+        variance = np.cumsum(s**2)
+        ncomp = 1 if variance[-1] == 0 else int(np.searchsorted(variance, (1 - tolerance) * variance[-1])) + 1
+        self.components = vt[:ncomp]
+        weights = (self.y_train - self.mean) @ self.components.T
+
+        n, ndim = self.x_train.shape
+        poly = np.hstack([np.ones((n, 1)), self.x_train])
+        system = np.zeros((n + ndim + 1, n + ndim + 1))
+        system[:n, :n] = self._kernel(self.x_train)
+        system[:n, n:] = poly
+        system[n:, :n] = poly.T
+        rhs = np.vstack([weights, np.zeros((ndim + 1, ncomp))])
+        self.coefficients = np.linalg.lstsq(system, rhs, rcond=None)[0]
+
+    def _kernel(self, points):
+        distance = np.linalg.norm(points[:, None, :] - self.x_train[None, :, :], axis=-1)
+        return distance**3
+
+    def _predict_unit(self, points):
+        n = len(self.x_train)
+        weights = self._kernel(points) @ self.coefficients[:n]
+        weights += np.hstack([np.ones((len(points), 1)), points]) @ self.coefficients[n:]
+        return self.mean + weights @ self.components
+
+    def _errors(self, points, truth):
+        return np.max(np.abs(self._predict_unit(points) - truth), axis=1)
+
+    def build(self, n_initial=None, n_max=None, batch=None, tolerance=0.02, n_validation=None,
+              n_threads=0, seed=0, verbose=True):
+        """
+        Sample the full model adaptively until the emulator reaches the tolerance, then validate it.
+
+        Every round runs a batch of new points, half of them scattered around the points with the
+        largest errors of the previous round and half of them spread over the whole box. The
+        errors of the current emulator at the new points are measured before they join the
+        training set; sampling stops once the largest of them is below the tolerance.
+
+        Args:
+            n_initial (int): Number of points of the first Latin hypercube, by default 10 per
+                free parameter.
+            n_max (int): Maximum number of training runs, by default 100 per free parameter.
+            batch (int): Number of new points per round, by default 5 per free parameter.
+            tolerance (float): Target of the largest error in log10 flux (dex).
+            n_validation (int): Number of held-out points of the validation report, by default
+                5 per free parameter.
+            n_threads (int): Number of native threads of the full runs, 0 for one per core.
+            seed (int): Seed of the random sampling.
+            verbose (bool): Print the error after every round.
+
+        Returns:
+            The validation report (see validate).
+        """
+        ndim = len(self.names)
+        rng = np.random.default_rng(seed)
+        n_initial = 10 * ndim if n_initial is None else n_initial
+        n_max = 100 * ndim if n_max is None else n_max
+        batch = 5 * ndim if batch is None else batch
+
+        if len(self.x_train) == 0:
+            points = latin_hypercube(max(n_initial, ndim + 2), ndim, rng)
+            self.x_train, self.y_train = points, self._run(points, n_threads)
+        self.fit()
+
+        worst = rng.random((1, ndim))
+        while len(self.x_train) < n_max:
+            nlocal = batch // 2
+            spacing = len(self.x_train) ** (-1. / ndim)
+            centres = worst[rng.integers(len(worst), size=nlocal)]
+            local = np.clip(centres + rng.normal(scale=0.5 * spacing, size=(nlocal, ndim)), 0, 1)
+            points = np.vstack([local, latin_hypercube(batch - nlocal, ndim, rng)])[:n_max - len(self.x_train)]
+
+            truth = self._run(points, n_threads)
+            errors = self._errors(points, truth)
+            worst = points[np.argsort(errors)[-max(1, len(points) // 4):]]
+            self.x_train = np.vstack([self.x_train, points])
+            self.y_train = np.vstack([self.y_train, truth])
+            self.fit()
+            if verbose:
+                print(f"{len(self.x_train)} training runs, largest error {errors.max():.3g} dex")
+            if errors.max() < tolerance:
+                break
+
+        return self.validate(5 * ndim if n_validation is None else n_validation, n_threads=n_threads,
+                             seed=seed + 1, tolerance=tolerance)
+
+    def validate(self, n_validation, n_threads=0, seed=1, tolerance=0.02):
+        """
+        Compare the emulator to the full model at held-out Latin hypercube points.
+
+        The ratio of the error to the distance from the nearest training point is also
+        calibrated here, and sets the error estimate returned by predict.
+
+        Returns:
+            Dictionary with the number of training and validation runs, the RMS, 95th percentile
+            and largest error in dex, the fraction of points within the tolerance, and the time
+            of a full run and of an emulator evaluation in seconds.
+        """
+        rng = np.random.default_rng(seed)
+        points = latin_hypercube(n_validation, len(self.names), rng)
+        truth = self._run(points, n_threads)
+        residuals = self._predict_unit(points) - truth
+        errors = np.max(np.abs(residuals), axis=1)
+        self.error_scale = np.percentile(errors / self._nearest(points), 95)
+
+        start = time.perf_counter()
+        self._predict_unit(points[:1])
+        emulator_time = time.perf_counter() - start
+
+        self.validation = {
+            "n_train": len(self.x_train),
+            "n_validation": n_validation,
+            "rms_dex": float(np.sqrt(np.mean(residuals**2))),
+            "p95_dex": float(np.percentile(errors, 95)),
+            "max_dex": float(errors.max()),
+            "tolerance_dex": tolerance,
+            "within_tolerance": float(np.mean(errors < tolerance)),
+            "full_run_s": self.run_seconds / max(self.run_count, 1),
+            "emulator_s": emulator_time,
+        }
+        return self.validation
+
+    def _nearest(self, points):
+        distance = np.linalg.norm(points[:, None, :] - self.x_train[None, :, :], axis=-1)
+        return np.maximum(distance.min(axis=1), 1e-12)
+
+    def predict(self, params, return_error=False):
+        """
+        Emulate the total spectrum.
+
+        Args:
+            params (dict or array): Values of the free parameters, by name or in the order of
+                param_ranges; an (N, nfree) array gives N spectra.
+            return_error (bool): Also return the estimated largest error in dex, from the
+                distance to the nearest training point (inf outside the parameter box).
+
+        Returns:
+            log10 of the total flux [mJy] on self.energies, and optionally the error estimate.
+        """
+        if isinstance(params, dict):
+            params = [params[name] for name in self.names]
+        single = np.ndim(params) == 1
+        points = self._to_unit(params)
+        logflux = self._predict_unit(points)
+        if single:
+            logflux = logflux[0]
+        if not return_error:
+            return logflux
+
+        error = self.error_scale * self._nearest(points)
+        error[np.any((points < -1e-9) | (points > 1 + 1e-9), axis=1)] = np.inf
+        return logflux, (error[0] if single else error)
+
+    def report(self):
+        """
+        Return the validation report as readable text.
+        """
+        if self.validation is None:
+            return "Emulator not validated, run build or validate first."
+        v = self.validation
+        return (f"BHJet emulator of {', '.join(self.names)}\n"
+                f"  training runs:      {v['n_train']}\n"
+                f"  held-out runs:      {v['n_validation']}\n"
+                f"  RMS error:          {v['rms_dex']:.3g} dex\n"
+                f"  95th pct. error:    {v['p95_dex']:.3g} dex\n"
+                f"  largest error:      {v['max_dex']:.3g} dex\n"
+                f"  within {v['tolerance_dex']:g} dex:    {100 * v['within_tolerance']:.0f}%\n"
+                f"  full run:           {v['full_run_s']:.3g} s\n"
+                f"  emulator:           {v['emulator_s']:.3g} s")
+
+    def save(self, filename):
+        """
+        Save the training set and validation report to an .npz file.
+        """
+        validation = {} if self.validation is None else self.validation
+        np.savez(filename, names=np.array(self.names), log=self.log, lower=self.lower,
+                 upper=self.upper, energies=self.energies, fixed=self.fixed, x_train=self.x_train,
+                 y_train=self.y_train, error_scale=self.error_scale,
+                 validation_keys=np.array(list(validation)),
+                 validation_values=np.array(list(validation.values()), dtype=float))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an emulator saved with save; the full model is not run again.
+        """
+        with np.load(filename) as saved:
+            emulator = cls.__new__(cls)
+            emulator.names = [str(name) for name in saved["names"]]
+            for key in ("log", "lower", "upper", "energies", "fixed", "x_train", "y_train"):
+                setattr(emulator, key, saved[key])
+            emulator.error_scale = float(saved["error_scale"])
+            emulator.run_seconds = 0.
+            emulator.run_count = 0
+            emulator.param_file = None
+            keys = [str(key) for key in saved["validation_keys"]]
+            emulator.validation = dict(zip(keys, saved["validation_values"].tolist())) or None
+        for key in ("n_train", "n_validation"):
+            if emulator.validation is not None:
+                emulator.validation[key] = int(emulator.validation[key])
+        emulator.fit()
+        return emulator
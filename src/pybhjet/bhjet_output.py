@@ -0,0 +1,166 @@
+import os
+import re
+import warnings
+
+import numpy as np
+
+OUTPUT_CONTAINER = "bhjet_output.npz"
+OUTPUT_FILES = ("Starting_pars", "Presyn", "Postsyn", "Precom", "Postcom", "Disk", "BB", "Total",
+                "Numdens", "Cyclosyn_zones", "Compton_zones", "Spectral_properties", "Profiles")
+ZONE_TABLES = ("Numdens", "Cyclosyn_zones", "Compton_zones", "Profiles")
+SWEEP_FILES = ("params", "frequencies", "spectra", "spectral_properties", "status")
+
+
+def _loadtxt(path, ndmin):
+    # files of quantities that were not computed only hold their header
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(path, ndmin=ndmin)
+
+
+def _guess_offsets(table):
+    # older output without Zones.dat: a new zone starts wherever the first column (frequency or
+    # momentum, increasing within a zone) does not increase
+    if len(table) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.diff(table[:, 0]) <= 0) + 1
+    return np.concatenate(([0], starts, [len(table)])).astype(np.int64)
+
+
+def load_output(directory="Output"):
+    """
+    Load the output files of a run written to directory, either the bhjet_output.npz container
+    (set_output_files(format="npz")) or the text files (bhwrap.x, set_output_files()).
+
+    Every table is a 2D array with the columns of the corresponding .dat file, except for
+    Starting_pars which holds the 27 parameters. The per-zone tables (Numdens, Cyclosyn_zones,
+    Compton_zones, Profiles) come with "<table>_offsets", the first row of every zone followed by
+    the number of rows, and "zone_bounds" holds z and z+delz of every zone in Rg. For text output
+    without Zones.dat the offsets are found from where the frequency/momentum grid restarts, and
+    there are no zone_bounds.
+
+    Args:
+        directory (str): Output directory of the run.
+
+    Returns:
+        Dictionary of the arrays, keyed by the names of the output files (without .dat).
+    """
+    container = os.path.join(directory, OUTPUT_CONTAINER)
+    if os.path.exists(container):
+        with np.load(container) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    output = {}
+    for name in OUTPUT_FILES:
+        path = os.path.join(directory, name + ".dat")
+        if os.path.exists(path):
+            output[name] = _loadtxt(path, 1 if name == "Starting_pars" else 2)
+    if not output:
+        raise FileNotFoundError(f"No BHJet output files in {directory}")
+
+    zones_path = os.path.join(directory, "Zones.dat")
+    if os.path.exists(zones_path):
+        # the header names the table of each column of first rows
+        with open(zones_path) as file:
+            tables = re.findall(r"first row of (\w+):", file.readline())
+        zones = _loadtxt(zones_path, 2)
+        output["zone_bounds"] = zones[:, :2]
+        for column, name in enumerate(tables, start=2):
+            output[name + "_offsets"] = np.append(zones[:, column], len(output[name])).astype(np.int64)
+    else:
+        for name in (name for name in ZONE_TABLES if name in output):
+            if name == "Profiles":
+                output[name + "_offsets"] = np.arange(len(output[name]) + 1, dtype=np.int64)
+            else:
+                output[name + "_offsets"] = _guess_offsets(output[name])
+    return output
+
+
+def split_zones(output, name):
+    """
+    Split a per-zone table of load_output into the rows of each zone.
+
+    Args:
+        output (dict): Output of load_output.
+        name (str): One of "Numdens", "Cyclosyn_zones", "Compton_zones" or "Profiles".
+
+    Returns:
+        List with a 2D array for every zone.
+    """
+    offsets = output[name + "_offsets"]
+    return np.split(output[name], offsets[1:-1])
+
+
+def zone_arrays(output):
+    """
+    The per-zone output of a run kept in memory (infosw >= 2, no output files) in the layout of
+    load_output, so that split_zones and resample_zones work on it in the same way. The tables are
+    read-only views of the JetOutput, which stay valid when the model is run again.
+
+    Args:
+        output (JetOutput): Output of the run, from get_output().
+
+    Returns:
+        Dictionary with "Numdens", "Cyclosyn_zones" and "Compton_zones", their "<table>_offsets"
+        and "zone_bounds".
+    """
+    arrays = {"zone_bounds": output.zone_bounds}
+    for name, member in (("Numdens", "numdens"), ("Cyclosyn_zones", "cyclosyn_zones"),
+                         ("Compton_zones", "compton_zones")):
+        arrays[name] = getattr(output, member + "_array")
+        arrays[name + "_offsets"] = getattr(output, member + "_offsets")
+    return arrays
+
+
+def resample_zones(output, name, grid, column=1):
+    """
+    Resample a per-zone table onto a common grid, e.g. the spectra of all zones onto the same
+    frequencies, by linear interpolation in log(x)-log(y), where x is the first column of the
+    table. Outside the range of a zone, and next to values that are zero, the result is zero.
+
+    Args:
+        output (dict): Output of load_output or zone_arrays.
+        name (str): One of "Cyclosyn_zones", "Compton_zones" or "Numdens".
+        grid (array): Increasing values of the first column (nu [Hz] for the spectra, p for
+            Numdens) to resample onto.
+        column (int): Column to resample (1 for the flux [mJy] of the spectra, 2 or 3 for n(p)
+            or n(g) of Numdens).
+
+    Returns:
+        (nzones, len(grid)) array.
+    """
+    log_grid = np.log10(np.asarray(grid, dtype=float))
+    zones = split_zones(output, name)
+    resampled = np.zeros((len(zones), len(log_grid)))
+    for j, zone in enumerate(zones):
+        if len(zone) < 2:
+            continue
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_x = np.log10(zone[:, 0])
+            inside = (log_grid >= log_x[0]) & (log_grid <= log_x[-1])
+            values = 10**np.interp(log_grid[inside], log_x, np.log10(zone[:, column]))
+        resampled[j, inside] = np.nan_to_num(values, nan=0.)
+    return resampled
+
+
+def load_sweep(directory, done_only=False):
+    """
+    Open the output of the native parameter sweep (bhsweep) without copying: the arrays are
+    read-only memory maps of the .npy files, so this also works while the sweep is running.
+
+    Args:
+        directory (str): Output directory of the sweep.
+        done_only (bool): Only return the rows that finished (status 1), as copies.
+
+    Returns:
+        Dictionary with "params" (N, 28), "frequencies" (nbins,) in Hz, "spectra" (N, nbins) in
+        mJy, "spectral_properties" (N, 7) with the columns of Spectral_properties.dat, and
+        "status" (N,), 0 for rows not run yet, 1 for finished and 2 for failed rows.
+    """
+    sweep = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+             for name in SWEEP_FILES}
+    if done_only:
+        done = np.asarray(sweep["status"]) == 1
+        for name in ("params", "spectra", "spectral_properties", "status"):
+            sweep[name] = np.asarray(sweep[name])[done]
+    return sweep
@@ -0,0 +1,48 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .pybhjet import PyBHJet
+
+# parameter names in the order of the BHJet parameter file
+PARAMETER_NAMES = ("Mbh", "theta", "dist", "redsh", "jetrat", "r_0", "z_diss", "z_acc", "z_max", "t_e",
+                   "f_nth", "f_pl", "pspec", "f_heat", "f_beta", "f_sc", "p_beta", "sig_acc", "l_disk",
+                   "r_in", "r_out", "compar1", "compar2", "compar3", "compsw", "velsw", "infosw", "EBLsw")
+
+def run_bhjet(params, param_file=None):
+    """
+    Run BHJet once for a dictionary of parameter values and return its output.
+
+    Args:
+        params (dict): Parameter names and values, e.g. {"jetrat": 1e-2, "r_0": 20}.
+        param_file (str): Optional parameter file loaded before applying params.
+
+    Returns:
+        The JetOutput of the run.
+    """
+    bhjet = PyBHJet()
+    if param_file is not None:
+        bhjet.load_params(param_file)
+    bhjet.set_parameters(params)
+    bhjet.run()
+    return bhjet.get_output()
+
+
+def run_parallel(param_dicts, param_file=None, max_workers=None):
+    """
+    Run BHJet for many parameter dictionaries on a pool of threads.
+
+    PyBHJet.run releases the GIL and every run gets its own PyBHJet instance, so the runs
+    execute in parallel on separate cores.
+
+    Args:
+        param_dicts (iterable of dict): Parameter names and values for each run.
+        param_file (str): Optional parameter file holding the values of all other parameters.
+        max_workers (int): Number of threads, by default one per core.
+
+    Returns:
+        List of JetOutput objects, in the order of param_dicts.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda params: run_bhjet(params, param_file), param_dicts))
@@ -25,8 +25,9 @@ def preprocess_component_output(output):
     components = ["disk", "presyn", "postsyn", "precom", "postcom", "bb", "total"]
     for component in components:
         try:
-            energy = np.array([point.energy for point in getattr(output, component)])
-            flux = np.array([point.flux for point in getattr(output, component)])
+            spectrum = getattr(output, component + "_array")  # read-only view, no copy
+            energy = spectrum[:, 0]
+            flux = spectrum[:, 1]
             if len(energy) > 0 and len(flux) > 0:
                 data[component] = {"energy": energy, "flux": flux}
             else:
@@ -39,15 +40,20 @@ def preprocess_numdens_output(output):
     """
     Extract and store data from output for specified components.
     For all emission components out of bhjet, they are saved in structs of energy & flux, with units [hz, mjy]
+    The zones are stored one after another: zone j holds the points offsets[j] to offsets[j+1], and
+    z_rg holds z and z+delz of every zone in Rg.
     """
     data = {}
     components = ["cyclosyn_zones", "compton_zones"]
     for component in components:
         try: #to be unit consistent, need to change the names here 
-            energy = np.array([point.energy for point in getattr(output, component)]) #change this to be frequency_hz
-            flux = np.array([point.flux for point in getattr(output, component)]) #change this to be flux_mjy
+            spectra = getattr(output, component + "_array")  # read-only view, no copy
+            energy = spectra[:, 0] #change this to be frequency_hz
+            flux = spectra[:, 1] #change this to be flux_mjy
             if len(energy) > 0 and len(flux) > 0:
-                data[component] = {"energy": energy, "flux": flux}
+                data[component] = {"energy": energy, "flux": flux,
+                                   "offsets": getattr(output, component + "_offsets"),
+                                   "z_rg": output.zone_bounds}
             else:
                 print(f"No data found for component: {component}")
         except AttributeError:
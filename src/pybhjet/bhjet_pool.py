@@ -0,0 +1,413 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from .pybhjet import PyBHJet
+from .bhjet_parallel import PARAMETER_NAMES
+
+NPAR = len(PARAMETER_NAMES)
+
+
+def _attach(name):
+    # Python >= 3.13 can attach without registering the block with the resource tracker, which
+    # would otherwise warn about (or unlink) blocks that the pool still owns
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+def _configure(bhjet, param_file, energy_grid, resolution):
+    if param_file is not None:
+        bhjet.load_params(param_file)
+    if energy_grid is not None:
+        bhjet.set_energy_grid(list(energy_grid))
+    if isinstance(resolution, str):
+        bhjet.set_resolution(resolution)
+    elif resolution is not None:
+        bhjet.set_resolution(**resolution)
+
+
+def _worker_main(conn, setup, params_name, spectra_name, slots, nbins):
+    """
+    Loop of a worker process: runs the parameters of a slot with its own PyBHJet instance and
+    writes the total flux to the spectrum slot, or to a row of a shared output array.
+    """
+    bhjet = PyBHJet()
+    _configure(bhjet, *setup)
+    blocks = {name: _attach(name) for name in (params_name, spectra_name)}
+    params = np.ndarray((slots, NPAR), dtype=float, buffer=blocks[params_name].buf)
+    spectra = np.ndarray((slots, nbins), dtype=float, buffer=blocks[spectra_name].buf)
+    outputs = {}
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        task_id, slot, out_name, out_shape, out_row = message
+        start = time.perf_counter()
+        error = None
+        try:
+            bhjet.run_parameters(params[slot])
+            if out_name is None:
+                target = spectra[slot]
+            else:
+                if out_name not in outputs:
+                    blocks[out_name] = _attach(out_name)
+                    outputs[out_name] = np.ndarray(out_shape, dtype=float, buffer=blocks[out_name].buf)
+                target = outputs[out_name][out_row]
+            target[:] = bhjet.get_total_flux()
+        except Exception as exception:
+            error = f"{type(exception).__name__}: {exception}"
+        conn.send((task_id, error, time.perf_counter() - start))
+
+    del params, spectra, outputs
+    for block in blocks.values():
+        block.close()
+
+
+class _Task:
+    def __init__(self, task_id, slot, out, row):
+        self.id = task_id
+        self.slot = slot
+        self.out = out
+        self.row = row
+        self.future = Future()
+        self.attempts = 0
+
+
+class _Worker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.tasks = {}
+        self.completed = 0
+        self.errors = 0
+        self.busy = 0.
+        self.restarts = -1
+        self.started = time.perf_counter()
+
+
+class BHJetPool:
+    """
+    Pool of worker processes that each keep a warm PyBHJet instance for many evaluations.
+
+    Parameters and spectra are exchanged through two shared memory ring buffers of slots (one
+    row of 28 parameters and one spectrum per slot), and only small task messages are sent
+    through pipes, so nothing is pickled per run and the workers do not share the GIL. A task
+    holds a slot until its spectrum has been collected; submit blocks while all slots are in use,
+    which limits the work in flight. A worker that dies is started again and its tasks are
+    resubmitted, up to max_retries times per task.
+
+    Spectra are copied out of the ring buffer into the result, unless map is given an output
+    array made by empty(): that array lives in shared memory, and the workers write the spectra
+    straight into its rows.
+
+    Args:
+        processes (int): Number of worker processes, by default one per core.
+        param_file (str): ip.dat-style file with the parameters that rows given as dictionaries
+            do not set.
+        energy_grid (array): Observed energies [keV] of the spectra (set_energy_grid), by default
+            the standard grid.
+        resolution (str or dict): Preset name, or dictionary of the set_resolution arguments.
+        slots (int): Size of the ring buffers, by default four per worker.
+        max_retries (int): Times a task is resubmitted after its worker died.
+        start_method (str): Multiprocessing start method of the workers.
+    """
+
+    def __init__(self, processes=None, param_file=None, energy_grid=None, resolution=None,
+                 slots=None, max_retries=2, start_method="spawn"):
+        self.processes = processes or os.cpu_count() or 1
+        self.slots = slots or 4 * self.processes
+        self.max_retries = max_retries
+        self._setup = (param_file, None if energy_grid is None else list(energy_grid), resolution)
+
+        bhjet = PyBHJet()
+        _configure(bhjet, *self._setup)
+        self.frequencies = np.array(bhjet.get_energy_grid())
+        self.nbins = len(self.frequencies)
+        self.base_params = np.array([bhjet.get_parameter(name) for name in PARAMETER_NAMES])
+
+        self._params_block = SharedMemory(create=True, size=self.slots * NPAR * 8)
+        self._spectra_block = SharedMemory(create=True, size=self.slots * self.nbins * 8)
+        self._params = np.ndarray((self.slots, NPAR), dtype=float, buffer=self._params_block.buf)
+        self._spectra = np.ndarray((self.slots, self.nbins), dtype=float, buffer=self._spectra_block.buf)
+        self._outputs = {}
+
+        self._context = get_context(start_method)
+        self._lock = threading.Condition()
+        self._free_slots = deque(range(self.slots))
+        self._pending = deque()
+        self._next_id = 0
+        self._closed = False
+        self._workers = [_Worker(index) for index in range(self.processes)]
+        for worker in self._workers:
+            self._start(worker)
+
+        self._wakeup_recv, self._wakeup_send = self._context.Pipe(duplex=False)
+        self._collector = threading.Thread(target=self._collect, name="BHJetPool-collector",
+                                           daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self, worker):
+        parent_conn, child_conn = self._context.Pipe()
+        worker.process = self._context.Process(
+            target=_worker_main, daemon=True,
+            args=(child_conn, self._setup, self._params_block.name, self._spectra_block.name,
+                  self.slots, self.nbins))
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.restarts += 1
+
+    def _row(self, params):
+        if isinstance(params, dict):
+            row = self.base_params.copy()
+            for name, value in params.items():
+                row[PARAMETER_NAMES.index(name)] = value
+            return row
+        row = np.asarray(params, dtype=float)
+        if row.shape != (NPAR,):
+            raise ValueError(f"params must be a dictionary or an array of {NPAR} values")
+        return row
+
+    def _dispatch(self):
+        # called with the lock held; tasks go to the least busy worker, and every worker gets at
+        # most two tasks, so that the next one is waiting while it runs; the rest stays pending
+        while self._pending:
+            workers = [worker for worker in self._workers
+                       if len(worker.tasks) < 2 and worker.process.is_alive()]
+            if not workers:
+                return
+            worker = min(workers, key=lambda worker: len(worker.tasks))
+            task = self._pending.popleft()
+            worker.tasks[task.id] = task
+            out_name = out_shape = None
+            if task.out is not None and id(task.out) in self._outputs:
+                block, array = self._outputs[id(task.out)]
+                out_name, out_shape = block.name, array.shape
+            try:
+                worker.conn.send((task.id, task.slot, out_name, out_shape, task.row))
+            except (BrokenPipeError, OSError):
+                pass    # the collector restarts the worker and resubmits its tasks
+
+    def submit(self, params, out=None, row=None, timeout=None):
+        """
+        Queue one run, blocking while all slots of the ring buffer are in use.
+
+        Args:
+            params (dict or array): Parameter names and values (the others are those of
+                param_file), or all 28 parameters in the order of the parameter file.
+            out (array): Optional (N, nbins) array that receives the spectrum in row row; the
+                workers write to it directly if it was made by empty().
+            row (int): Row of out.
+            timeout (float): Longest wait for a free slot in seconds, None to wait for ever.
+
+        Returns:
+            concurrent.futures.Future with the total flux [mJy] on frequencies (the row of out,
+            if given).
+        """
+        values = self._row(params)
+        if out is not None and row is None:
+            raise ValueError("submit needs the row of out to write to")
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The pool is closed")
+            if not self._lock.wait_for(lambda: self._free_slots or self._closed, timeout):
+                raise TimeoutError("No free slot in the BHJetPool ring buffer")
+            if self._closed:
+                raise RuntimeError("The pool is closed")
+            slot = self._free_slots.popleft()
+            self._params[slot] = values
+            task = _Task(self._next_id, slot, out, row)
+            self._next_id += 1
+            self._pending.append(task)
+            self._dispatch()
+        return task.future
+
+    def map(self, param_rows, out=None):
+        """
+        Run every row of parameters and return the spectra in order.
+
+        Args:
+            param_rows (iterable): Dictionaries of parameter values, or an (N, 28) array.
+            out (array): Optional (N, nbins) array for the spectra; if it was made by empty(),
+                the workers write to it directly.
+
+        Returns:
+            The (N, nbins) array of total fluxes [mJy] on frequencies.
+        """
+        if not isinstance(param_rows, (list, tuple, np.ndarray)):
+            param_rows = list(param_rows)
+        if out is None:
+            out = np.empty((len(param_rows), self.nbins))
+        elif out.shape != (len(param_rows), self.nbins):
+            raise ValueError(f"out must have shape ({len(param_rows)}, {self.nbins})")
+        futures = [self.submit(params, out, row) for row, params in enumerate(param_rows)]
+        for future in futures:
+            future.result()
+        return out
+
+    def empty(self, nrows):
+        """
+        Return an (nrows, nbins) array in shared memory, which map and submit fill without copying.
+        The memory is released by release() or close().
+        """
+        block = SharedMemory(create=True, size=max(nrows * self.nbins * 8, 1))
+        array = np.ndarray((nrows, self.nbins), dtype=float, buffer=block.buf)
+        with self._lock:
+            self._outputs[id(array)] = (block, array)
+        return array
+
+    def release(self, array):
+        """
+        Free an array made by empty(); it must not be used afterwards.
+        """
+        with self._lock:
+            block, _ = self._outputs.pop(id(array))
+        self._free_block(block)
+
+    @staticmethod
+    def _free_block(block):
+        # arrays of the caller may still use the mapping, which then stays until they are deleted
+        block.unlink()
+        try:
+            block.close()
+        except BufferError:
+            pass
+
+    def _finish(self, worker, task_id, error, seconds):
+        # called with the lock held
+        task = worker.tasks.pop(task_id)
+        worker.busy += seconds
+        if error is not None:
+            worker.errors += 1
+            task.future.set_exception(RuntimeError(f"BHJet run failed: {error}"))
+        else:
+            worker.completed += 1
+            if task.out is None:
+                result = self._spectra[task.slot].copy()
+            else:
+                if id(task.out) not in self._outputs:
+                    task.out[task.row] = self._spectra[task.slot]
+                result = task.out[task.row]
+            task.future.set_result(result)
+        self._free_slots.append(task.slot)
+        self._lock.notify_all()
+
+    def _restart(self, worker):
+        # called with the lock held, after worker died: its tasks go back to the front of the queue;
+        # the worker runs its tasks in order, so only the first one counts as a failed attempt
+        worker.process.join()
+        worker.conn.close()
+        tasks = sorted(worker.tasks.values(), key=lambda task: task.id)
+        if tasks:
+            tasks[0].attempts += 1
+        for task in reversed(tasks):
+            if task.attempts > self.max_retries:
+                task.future.set_exception(RuntimeError(
+                    f"BHJet worker died {task.attempts} times running this task "
+                    f"(exit code {worker.process.exitcode})"))
+                self._free_slots.append(task.slot)
+            else:
+                self._pending.appendleft(task)
+        worker.tasks = {}
+        self._lock.notify_all()
+        if not self._closed:
+            self._start(worker)
+
+    def _collect(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                conns = {worker.conn: worker for worker in self._workers}
+                sentinels = {worker.process.sentinel: worker for worker in self._workers}
+            ready = wait(list(conns) + list(sentinels) + [self._wakeup_recv])
+            with self._lock:
+                if self._closed:
+                    return
+                dead = set()
+                for item in ready:
+                    if item in conns:
+                        worker = conns[item]
+                        try:
+                            while worker.conn.poll():
+                                self._finish(worker, *worker.conn.recv())
+                        except (EOFError, OSError):
+                            dead.add(worker)
+                    elif item in sentinels:
+                        dead.add(sentinels[item])
+                for worker in dead:
+                    self._restart(worker)
+                self._dispatch()
+
+    def stats(self):
+        """
+        Return a list with the throughput of every worker: runs completed and failed, restarts,
+        runs per second since the pool started, and the fraction of that time spent running.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            return [{
+                "worker": worker.index,
+                "pid": worker.process.pid,
+                "completed": worker.completed,
+                "errors": worker.errors,
+                "restarts": worker.restarts,
+                "runs_per_second": worker.completed / (now - worker.started),
+                "busy_fraction": min(worker.busy / (now - worker.started), 1.),
+                "queued": len(worker.tasks),
+            } for worker in self._workers]
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory, including the arrays made by empty().
+        Tasks that have not finished are cancelled.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+        self._wakeup_send.send(None)
+        self._collector.join()
+
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.conn.close()
+            for task in worker.tasks.values():
+                task.future.cancel()
+        for task in self._pending:
+            task.future.cancel()
+
+        del self._params, self._spectra
+        blocks = [self._params_block, self._spectra_block]
+        blocks += [block for block, _ in self._outputs.values()]
+        self._outputs = {}
+        for block in blocks:
+            self._free_block(block)
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
@@ -0,0 +1,213 @@
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from .pybhjet import PyBHJet
+from .bhjet_parallel import PARAMETER_NAMES
+
+
+def grid_method(values):
+    """
+    Return the XSPEC interpolation method of a grid: 1 (logarithmic) if the values are positive
+    and evenly spaced in log, 0 (linear) otherwise.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) > 2 and np.all(values > 0):
+        steps = np.diff(np.log10(values))
+        if np.allclose(steps, steps[0], rtol=1e-6):
+            return 1
+    return 0
+
+
+def write_table_model(filename, grid_params, energies, spectra, model_name="bhjet", overwrite=True):
+    """
+    Write an OGIP additive table model (XSPEC atable), which can be loaded by XSPEC, ISIS and
+    astromodels' XSPECTableModel.
+
+    Args:
+        filename (str): Name of the FITS file.
+        grid_params (dict): Parameter names and their grid values, in the order of the grid.
+        energies (array): Energy bin edges in keV.
+        spectra (array): (N, len(energies) - 1) photon fluxes per bin in ph/cm^2/s, ordered
+            with the last parameter varying fastest.
+        model_name (str): Name of the model in XSPEC, at most 12 characters.
+        overwrite (bool): Overwrite an existing file.
+    """
+    names = list(grid_params)
+    values = [np.asarray(grid_params[name], dtype=float) for name in names]
+    nvals = max(len(v) for v in values)
+
+    primary = fits.PrimaryHDU()
+    primary.header["MODLNAME"] = (model_name[:12], "Model name")
+    primary.header["MODLUNIT"] = ("photons/cm^2/s", "Model units")
+    primary.header["REDSHIFT"] = (False, "No redshift parameter, BHJet handles redsh")
+    primary.header["ADDMODEL"] = (True, "Additive model")
+    primary.header["HDUCLASS"] = "OGIP"
+    primary.header["HDUCLAS1"] = "XSPEC TABLE MODEL"
+    primary.header["HDUVERS"] = "1.0.0"
+    primary.header["CREATOR"] = "pybhjet"
+
+    # the VALUE column has a fixed width, shorter grids are padded with zeros
+    padded = np.zeros((len(names), nvals))
+    for i, v in enumerate(values):
+        padded[i, :len(v)] = v
+    # XSPEC takes DELTA < 0 as frozen, so use a small fraction of the grid range
+    deltas = [max(abs(v[-1] - v[0]) * 1e-2, 1e-6 * max(abs(v[0]), 1.)) for v in values]
+    parameters = fits.BinTableHDU.from_columns([
+        fits.Column(name="NAME", format="12A", array=names),
+        fits.Column(name="METHOD", format="J", array=[grid_method(v) for v in values]),
+        fits.Column(name="INITIAL", format="E", array=[v[len(v) // 2] for v in values]),
+        fits.Column(name="DELTA", format="E", array=deltas),
+        fits.Column(name="MINIMUM", format="E", array=[v[0] for v in values]),
+        fits.Column(name="BOTTOM", format="E", array=[v[0] for v in values]),
+        fits.Column(name="TOP", format="E", array=[v[-1] for v in values]),
+        fits.Column(name="MAXIMUM", format="E", array=[v[-1] for v in values]),
+        fits.Column(name="NUMBVALS", format="J", array=[len(v) for v in values]),
+        fits.Column(name="VALUE", format=f"{nvals}E", array=padded),
+    ], name="PARAMETERS")
+    parameters.header["HDUCLAS2"] = "PARAMETERS"
+    parameters.header["NINTPARM"] = len(names)
+    parameters.header["NADDPARM"] = 0
+
+    energies = np.asarray(energies, dtype=float)
+    energy_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name="ENERG_LO", format="E", unit="keV", array=energies[:-1]),
+        fits.Column(name="ENERG_HI", format="E", unit="keV", array=energies[1:]),
+    ], name="ENERGIES")
+    energy_hdu.header["HDUCLAS2"] = "ENERGIES"
+
+    paramvals = np.array(list(itertools.product(*values)), dtype=float).reshape(-1, len(names))
+    spectra_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name="PARAMVAL", format=f"{len(names)}E", array=paramvals),
+        fits.Column(name="INTPSPEC", format=f"{len(energies) - 1}E", unit="photons/cm^2/s",
+                    array=np.asarray(spectra, dtype=float)),
+    ], name="SPECTRA")
+    spectra_hdu.header["HDUCLAS2"] = "MODEL SPECTRA"
+
+    for hdu in (parameters, energy_hdu, spectra_hdu):
+        hdu.header["HDUCLASS"] = "OGIP"
+        hdu.header["HDUCLAS1"] = "XSPEC TABLE MODEL"
+        hdu.header["HDUVERS"] = "1.0.0"
+
+    fits.HDUList([primary, parameters, energy_hdu, spectra_hdu]).writeto(filename, overwrite=overwrite)
+
+
+def make_table_model(filename, grid_params, param_file=None, energies=None, model_name="bhjet",
+                     n_threads=0, chunk_size=None, verbose=True):
+    """
+    Run BHJet over the Cartesian grid of grid_params and write the spectra as an XSPEC atable.
+
+    The grid is run in chunks with PyBHJet.run_batch, and after every chunk the finished spectra
+    are saved to filename + ".partial.npz". Calling make_table_model again with the same grid,
+    fixed parameters and energies resumes from that file; it is removed once the table is written.
+
+    Args:
+        filename (str): Name of the FITS file.
+        grid_params (dict): Free parameter names and their grid values, e.g.
+            {"jetrat": np.geomspace(1e-3, 1e-1, 9), "r_0": [5, 10, 20, 40]}. Grids evenly spaced
+            in log are interpolated logarithmically by XSPEC.
+        param_file (str): ip.dat-style file with the values of the fixed parameters.
+        energies (array): Energy bin edges in keV, by default the BHJet range from 1e-10 to 1e10 keV.
+        model_name (str): Name of the model in XSPEC, at most 12 characters.
+        n_threads (int): Number of native threads, 0 for one per core.
+        chunk_size (int): Number of grid points run between checkpoints, by default 4 per thread.
+        verbose (bool): Print the progress and time per grid point after every chunk.
+
+    Returns:
+        Array with the run time per grid point in seconds.
+    """
+    names = list(grid_params)
+    for name in names:
+        if name not in PARAMETER_NAMES:
+            raise ValueError(f"Unknown BHJet parameter: {name}")
+    if energies is None:
+        energies = np.geomspace(1e-10, 1e10, 201)
+    energies = np.asarray(energies, dtype=float)
+    centres = np.sqrt(energies[:-1] * energies[1:])
+    widths = np.diff(energies)
+
+    bhjet = PyBHJet()
+    if param_file is not None:
+        bhjet.load_params(param_file)
+    bhjet.set_parameter("infosw", 0)
+    bhjet.set_energy_grid(centres)
+
+    base = np.array([bhjet.get_parameter(name) for name in PARAMETER_NAMES])
+    columns = [PARAMETER_NAMES.index(name) for name in names]
+    grid = np.array(list(itertools.product(*(grid_params[name] for name in names))), dtype=float)
+    rows = np.tile(base, (len(grid), 1))
+    rows[:, columns] = grid
+
+    checkpoint = filename + ".partial.npz"
+    spectra = np.zeros((len(rows), len(centres)))
+    times = np.full(len(rows), np.nan)
+    done = 0
+    if os.path.exists(checkpoint):
+        with np.load(checkpoint) as saved:
+            if np.array_equal(saved["rows"], rows) and np.array_equal(saved["energies"], energies):
+                done = int(saved["done"])
+                spectra[:done] = saved["spectra"][:done]
+                times[:done] = saved["times"][:done]
+                if verbose:
+                    print(f"Resuming from {checkpoint}: {done}/{len(rows)} grid points done")
+            elif verbose:
+                print(f"Ignoring {checkpoint}, it was made for a different grid")
+
+    if chunk_size is None:
+        chunk_size = 4 * (n_threads or os.cpu_count() or 1)
+
+    while done < len(rows):
+        chunk = rows[done:done + chunk_size]
+        start = time.perf_counter()
+        flux = bhjet.run_batch(chunk, n_threads)
+        elapsed = time.perf_counter() - start
+
+        # mJy to ph/cm^2/s/keV, times the bin widths
+        spectra[done:done + len(chunk)] = flux * 1e-26 / (6.62607015e-27 * centres) * widths
+        times[done:done + len(chunk)] = elapsed / len(chunk)
+        done += len(chunk)
+
+        tmp = checkpoint + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, rows=rows, energies=energies, spectra=spectra, times=times, done=done)
+        os.replace(tmp, checkpoint)
+        if verbose:
+            print(f"{done}/{len(rows)} grid points, {elapsed / len(chunk):.3g} s per point")
+
+    write_table_model(filename, grid_params, energies, spectra, model_name=model_name)
+    os.remove(checkpoint)
+    if verbose:
+        print(f"Wrote {filename}: {len(rows)} grid points, mean {np.nanmean(times):.3g} s per point")
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Make an XSPEC table model (atable) of BHJet.")
+    parser.add_argument("filename", help="output FITS file")
+    parser.add_argument("--param-file", help="ip.dat-style file with the fixed parameters")
+    parser.add_argument("--grid", nargs=5, action="append", required=True,
+                        metavar=("NAME", "MIN", "MAX", "N", "lin|log"),
+                        help="free parameter and its grid, can be repeated")
+    parser.add_argument("--emin", type=float, default=1e-10, help="lowest energy [keV]")
+    parser.add_argument("--emax", type=float, default=1e10, help="highest energy [keV]")
+    parser.add_argument("--nbins", type=int, default=200, help="number of log spaced energy bins")
+    parser.add_argument("--name", default="bhjet", help="model name in XSPEC")
+    parser.add_argument("--threads", type=int, default=0, help="number of threads, 0 for one per core")
+    args = parser.parse_args()
+
+    grid_params = {}
+    for name, vmin, vmax, n, spacing in args.grid:
+        space = np.geomspace if spacing == "log" else np.linspace
+        grid_params[name] = space(float(vmin), float(vmax), int(n))
+
+    make_table_model(args.filename, grid_params, param_file=args.param_file,
+                     energies=np.geomspace(args.emin, args.emax, args.nbins + 1),
+                     model_name=args.name, n_threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import time
+
+import numpy as np
+
+# candidate values of each resolution setting, as fractions of the reference value, and the
+# smallest value tried
+RESOLUTION_STEPS = (0.8, 0.6, 0.45, 0.3, 0.2)
+RESOLUTION_MINIMUM = {"nz": 20, "nel": 20, "syn_res": 2, "com_res": 2}
+
+
+def _timed_run(bhjet):
+    start = time.perf_counter()
+    bhjet.run()
+    return time.perf_counter() - start, np.array(bhjet.get_total_flux())
+
+
+def _deviation(flux, reference, mask):
+    with np.errstate(divide="ignore"):
+        return float(np.max(np.abs(np.log10(flux[mask]) - np.log10(reference[mask]))))
+
+
+def autotune_resolution(bhjet, tolerance=0.05, reference="standard", floor=1e-6, verbose=True):
+    """
+    Find the cheapest resolution that keeps the total spectrum within a tolerance of a reference.
+
+    Starting from the reference settings, each setting (number of zones, particle distribution
+    bins, synchrotron and Compton bins per decade) is lowered in turn for as long as the total
+    spectrum of the current parameters stays within the tolerance. The spectrum is compared where
+    nu*F_nu of the reference is above floor times its peak, so that the exponential cut-offs do
+    not dominate the deviation. The instance is left at the tuned resolution.
+
+    Args:
+        bhjet (PyBHJet): Instance with the parameters (and energy grid) to tune for.
+        tolerance (float): Largest allowed deviation of log10 of the total flux (dex).
+        reference (str or dict): Preset name, or dictionary of the set_resolution arguments, of
+            the reference settings.
+        floor (float): Fraction of the peak nu*F_nu below which the spectrum is not compared.
+        verbose (bool): Print every trial.
+
+    Returns:
+        Dictionary with the tuned settings, the reference settings, the speedup of a run with
+        respect to the reference, and the largest deviation of log10 of the total flux (dex).
+    """
+    if isinstance(reference, str):
+        bhjet.set_resolution(reference)
+    else:
+        bhjet.set_resolution(**reference)
+    reference_settings = bhjet.get_resolution()
+
+    reference_time, reference_flux = _timed_run(bhjet)
+    frequencies = np.array(bhjet.get_energy_grid())
+    nufnu = frequencies * reference_flux
+    mask = nufnu > floor * np.max(nufnu)
+
+    settings = dict(reference_settings)
+    best_time, deviation = reference_time, 0.
+    for name in ("nz", "nel", "syn_res", "com_res"):
+        tried = set()
+        for step in RESOLUTION_STEPS:
+            value = max(int(round(reference_settings[name] * step)), RESOLUTION_MINIMUM[name])
+            if value in tried or value >= settings[name]:
+                continue
+            tried.add(value)
+
+            trial = dict(settings, **{name: value})
+            bhjet.set_resolution(**trial)
+            run_time, flux = _timed_run(bhjet)
+            trial_deviation = _deviation(flux, reference_flux, mask)
+            if verbose:
+                print(f"{trial}: {run_time:.3g} s, deviation {trial_deviation:.3g} dex")
+            if not trial_deviation <= tolerance:
+                break
+            settings, best_time, deviation = trial, run_time, trial_deviation
+
+    bhjet.set_resolution(**settings)
+    result = {
+        "settings": settings,
+        "reference": reference_settings,
+        "speedup": reference_time / best_time,
+        "max_deviation_dex": deviation,
+    }
+    if verbose:
+        print(f"Tuned resolution {settings}: {result['speedup']:.3g} times faster than "
+              f"{reference_settings}, largest deviation {deviation:.3g} dex")
+    return result
@@ -0,0 +1,91 @@
+import logging
+import time
+import warnings
+
+from .pybhjet import set_print_warnings, set_warning_handler
+
+WARNING_MODES = ("print", "warnings", "logging", "silent")
+
+
+class BHJetWarning(UserWarning):
+    """Warning raised by a BHJet run, e.g. an unphysical pair content."""
+
+
+class RateLimitedHandler:
+    """
+    Warning handler that passes at most max_per_interval warnings of each kind per interval
+    seconds on to emit, and counts the rest. The number of warnings left out is added to the
+    message of the next warning of that kind that is passed on.
+
+    Args:
+        emit (callable): Called as emit(warning, message) with the JetWarning and its message.
+        max_per_interval (int): Warnings of each kind passed on per interval, None for no limit.
+        interval (float): Length of the interval in seconds.
+    """
+
+    def __init__(self, emit, max_per_interval=10, interval=60.):
+        self.emit = emit
+        self.max_per_interval = max_per_interval
+        self.interval = interval
+        self._windows = {}
+
+    def __call__(self, warning):
+        if self.max_per_interval is None:
+            self.emit(warning, warning.message)
+            return
+        now = time.monotonic()
+        start, passed, suppressed = self._windows.get(warning.code, (now, 0, 0))
+        message = warning.message
+        if now - start >= self.interval:
+            if suppressed:
+                message += f" ({suppressed} more {warning.name} warnings were suppressed)"
+            start, passed, suppressed = now, 0, 0
+        if passed < self.max_per_interval:
+            self.emit(warning, message)
+            passed += 1
+        else:
+            suppressed += 1
+        self._windows[warning.code] = (start, passed, suppressed)
+
+
+def set_warning_mode(mode="print", max_per_interval=10, interval=60., logger=None):
+    """
+    Choose where the warnings of BHJet runs go, for all PyBHJet instances.
+
+    Every run stores its warnings in JetOutput.warnings (and warning_flags/warning_counts) in
+    any mode. The modes are:
+
+    - "print": the model prints them to stdout as they are raised (the default).
+    - "warnings": they are raised as BHJetWarning with the Python warnings module.
+    - "logging": they are logged at WARNING level, by default to the "pybhjet" logger.
+    - "silent": they are only stored.
+
+    The warnings and logging modes are rate-limited per kind of warning; warnings of run_batch
+    rows are not passed on.
+
+    Args:
+        mode (str): One of "print", "warnings", "logging" or "silent".
+        max_per_interval (int): Warnings of each kind passed on per interval, None for no limit.
+        interval (float): Length of the interval in seconds.
+        logger (logging.Logger): Logger of the logging mode.
+    """
+    if mode not in WARNING_MODES:
+        raise ValueError(f"Unknown warning mode: {mode} (use one of {', '.join(WARNING_MODES)})")
+
+    if mode == "warnings":
+        def emit(warning, message):
+            # emit is called by RateLimitedHandler.__call__, which is called from the native
+            # dispatch of the warnings without a Python frame in between, so stacklevel 3 points
+            # at the line that called run()
+            warnings.warn(message, BHJetWarning, stacklevel=3)
+    elif mode == "logging":
+        logger = logger or logging.getLogger("pybhjet")
+
+        def emit(warning, message):
+            logger.warning("%s", message)
+
+    set_print_warnings(mode == "print")
+    if mode in ("warnings", "logging"):
+        set_warning_handler(RateLimitedHandler(emit, max_per_interval, interval))
+    else:
+        set_warning_handler(None)
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import numpy as np
 import astropy.units as u
 from astromodels.functions.function import (
@@ -8,6 +10,7 @@ from astromodels.functions.function import (
 
 # this needs to be compatible with the location of the library with the model 
 import pybhjet
+from pybhjet import PARAMETER_NAMES
 
 # to define a custom model in 3ml, need to include docstring, units setter, evaluate function: 
 class BHJetModel(Function1D, metaclass=FunctionMeta):
@@ -169,6 +172,88 @@ class BHJetModel(Function1D, metaclass=FunctionMeta):
     def _setup(self):
         self.bhjet = pybhjet.PyBHJet()
 
+        # default BHJet grid in keV, cached spectra always cover it
+        self._native_energies = self.bhjet.get_energy_grid() * 4.135667696e-18  # Hz to keV
+        self._cache = OrderedDict()
+        self._cache_size = 32
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def cache_size(self):
+        """
+        Maximum number of spectra kept in the result cache, 0 disables the cache.
+        """
+        return self._cache_size
+
+    @cache_size.setter
+    def cache_size(self, size):
+        self._cache_size = int(size)
+        while len(self._cache) > max(self._cache_size, 0):
+            self._cache.popitem(last=False)
+
+    def cache_info(self):
+        """
+        Return the hits, misses, current size and maximum size of the result cache.
+        """
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self._cache), "maxsize": self._cache_size}
+
+    def clear_cache(self):
+        """
+        Empty the result cache and reset its counters.
+        """
+        self._cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _run_bhjet(self, params, energies):
+        """
+        Run BHJet for a tuple of parameters (in file order) on energies in keV,
+        and return the photon flux in ph/cm^2/s/keV.
+        """
+        self.bhjet.set_energy_grid(energies)
+        self.bhjet.run_parameters(np.asarray(params, dtype=float))
+        return self._photon_flux(self.bhjet.get_total_flux(), energies)
+
+    @staticmethod
+    def _photon_flux(flux, energies):
+        """
+        Convert a flux in mJy on energies in keV to the photon flux returned by evaluate.
+        """
+        native_flux = flux * 1e-26  # mJy to ergs/cm^2/s/Hz
+
+        # Convert erg/cm^2/s to ph/cm^2/s/keV
+        return native_flux / (energies * 1.60218e-9) # erg to kev: 1.60218e-9
+
+    def gradient(self, x, free=None, step=1e-2, central=True, n_threads=0):
+        """
+        Derivatives of the photon flux returned by evaluate with respect to the free parameters,
+        at the current parameter values. The perturbed models run concurrently in native threads
+        (PyBHJet.jacobian), so this is about as fast as one evaluation on a machine with enough
+        cores. 3ML's own minimizers compute their derivatives themselves, so this is meant for
+        gradient based fitters and samplers, and for Fisher matrix estimates.
+
+        Args:
+            x (array): Energies in keV.
+            free (list): Names of the parameters, by default the free parameters of the model.
+            step (float or list): Relative step, or step in dex for scale parameters (Mbh, jetrat,
+                f_sc, ...), one for all parameters or one per parameter.
+            central (bool): Use central instead of forward differences.
+            n_threads (int): Number of native threads, 0 for one per core.
+
+        Returns:
+            Array of shape (len(free),) + x.shape in ph/cm^2/s/keV per unit of each parameter.
+        """
+        if free is None:
+            free = [name for name in PARAMETER_NAMES if self.parameters[name].free]
+        params = np.array([self.parameters[name].value for name in PARAMETER_NAMES], dtype=float)
+
+        energies, inverse = np.unique(x, return_inverse=True)
+        self.bhjet.set_energy_grid(energies)
+        jacobian = self.bhjet.jacobian(params, free, step=step, central=central, n_threads=n_threads)
+        return self._photon_flux(jacobian, energies)[:, inverse].reshape((len(free),) + np.shape(x))
+
     def _set_units(self, x_unit, y_unit):
     
         # Units for input energy grid (e.g., keV)
@@ -214,56 +299,108 @@ class BHJetModel(Function1D, metaclass=FunctionMeta):
                  ):
         
         """
-        Map the 3ML parameters to Pybhjet, run the model, and return the interpolated output.
+        Map the 3ML parameters to Pybhjet, run the model (or reuse a cached run with the same
+        parameters), and return the photon flux on the 3ML energy grid.
         """
 
-        # when jetmain is run (so bhjet.run()), premap parameters to BHJet
-        self.bhjet.set_parameter("Mbh", Mbh)
-        self.bhjet.set_parameter("theta", theta)
-        self.bhjet.set_parameter("dist", dist)
-        self.bhjet.set_parameter("redsh", redsh)
-        self.bhjet.set_parameter("jetrat", jetrat)
-        self.bhjet.set_parameter("r_0", r_0)
-        self.bhjet.set_parameter("z_acc", z_acc)
-        self.bhjet.set_parameter("z_diss", z_diss)
-        self.bhjet.set_parameter("z_max", z_max)
-        self.bhjet.set_parameter("t_e", t_e)
-        self.bhjet.set_parameter("f_nth", f_nth)
-        self.bhjet.set_parameter("f_pl", f_pl)
-        self.bhjet.set_parameter("pspec", pspec)
-        self.bhjet.set_parameter("f_heat", f_heat)
-        self.bhjet.set_parameter("f_beta", f_beta)
-        self.bhjet.set_parameter("f_sc", f_sc)
-        self.bhjet.set_parameter("p_beta", p_beta)
-        self.bhjet.set_parameter("sig_acc", sig_acc)
-        self.bhjet.set_parameter("l_disk", l_disk)
-        self.bhjet.set_parameter("r_in", r_in)
-        self.bhjet.set_parameter("r_out", r_out)
-        self.bhjet.set_parameter("compar1", compar1)
-        self.bhjet.set_parameter("compar2", compar2)
-        self.bhjet.set_parameter("compar3", compar3)
-        self.bhjet.set_parameter("compsw", compsw)
-        self.bhjet.set_parameter("velsw", velsw)
-        self.bhjet.set_parameter("infosw", infosw)
-        self.bhjet.set_parameter("EBLsw", EBLsw)
-
-        self.bhjet.run()
-
-        # interpolation from BHJet energy grid to 3ml x points : 
-        native_energy = np.array([point.energy for point in self.bhjet.get_output().total])  # Hz
-        native_flux = np.array([point.flux for point in self.bhjet.get_output().total]) * 1e-26  # mJy to ergs/cm^2/s/Hz
-        
-        # Convert energy to keV output 
-        energy_keV = native_energy * (4.135667696e-18)  # Hz to keV (h = 4.135667696e-15 eV/Hz)
+        params = tuple(float(value) for value in (
+            Mbh, theta, dist, redsh, jetrat, r_0, z_diss, z_acc, z_max, t_e, f_nth, f_pl, pspec,
+            f_heat, f_beta, f_sc, p_beta, sig_acc, l_disk, r_in, r_out, compar1, compar2, compar3,
+            compsw, velsw, infosw, EBLsw))
 
-        # Convert erg/cm^2/s to ph/cm^2/s/keV
-        conv_flux_ph = native_flux / (energy_keV * 1.60218e-9) # erg to kev: 1.60218e-9 
+        # BHJet needs the energies (keV) sorted and unique
+        energies, inverse = np.unique(x, return_inverse=True)
+
+        if self._cache_size <= 0:
+            conv_flux_ph = self._run_bhjet(params, energies)
+            return conv_flux_ph[inverse].reshape(np.shape(x))
+
+        # 3ML evaluates the same parameters once per plugin/dataset, with a different x: the
+        # spectrum is cached on the native grid plus the first x, so that only the
+        # interpolation is repeated
+        spectrum = self._cache.get(params)
+        if spectrum is None:
+            self.cache_misses += 1
+            grid = np.union1d(self._native_energies, energies)
+            spectrum = (np.log(grid), np.log(self._run_bhjet(params, grid)))
+            self._cache[params] = spectrum
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self.cache_hits += 1
+            self._cache.move_to_end(params)
 
         # Interpolate onto the 3ML energy grid
         interpolated_flux = np.exp(np.interp(
-            np.log(x), 
-            np.log(energy_keV), 
-            np.log(conv_flux_ph), 
+            np.log(energies), 
+            spectrum[0], 
+            spectrum[1], 
             left=-100, right=-100))
-         
-        return interpolated_flux
\ No newline at end of file
+
+        return interpolated_flux[inverse].reshape(np.shape(x))
+
+
+class BHJetEmulatorModel(BHJetModel):
+    __doc__ = BHJetModel.__doc__.replace(
+        "BHJet: steady state, multi-zone jet model",
+        "Emulator of BHJetModel, falls back to the full BHJet model where it is not accurate enough")
+
+    def _setup(self):
+        super()._setup()
+        self.emulator = None
+        self.max_error = 0.05
+        self.emulated = 0
+        self.fallbacks = 0
+
+    def _set_units(self, x_unit, y_unit):
+        super()._set_units(x_unit, y_unit)
+
+    def set_emulator(self, emulator, max_error=0.05):
+        """
+        Set the emulator (a pybhjet.BHJetEmulator, or the file it was saved to) used by evaluate.
+
+        The full model is run instead whenever the error estimate of the emulator is larger than
+        max_error (dex), or a parameter the emulator was not built for differs from the value it
+        was built with.
+        """
+        if isinstance(emulator, str):
+            emulator = pybhjet.BHJetEmulator.load(emulator)
+        self.emulator = emulator
+        self.max_error = max_error
+        self._free = [PARAMETER_NAMES.index(name) for name in emulator.names]
+        self._fixed = [i for i, name in enumerate(PARAMETER_NAMES)
+                       if i not in self._free and name != "infosw"]
+
+    def evaluate(self, x, Mbh, theta,  dist, redsh, jetrat, r_0, z_acc, z_diss, z_max, t_e, 
+                 f_nth, f_pl, pspec, f_heat, f_beta, f_sc, p_beta, sig_acc, l_disk, r_in, r_out, 
+                 compar1, compar2, compar3, compsw, velsw,infosw, EBLsw
+                 ):
+        
+        """
+        Emulate the photon flux on the 3ML energy grid, or run the full model when the emulator
+        does not cover the parameters to the requested accuracy.
+        """
+        if self.emulator is None:
+            raise RuntimeError("No emulator set, call set_emulator first")
+
+        params = np.array([float(value) for value in (
+            Mbh, theta, dist, redsh, jetrat, r_0, z_diss, z_acc, z_max, t_e, f_nth, f_pl, pspec,
+            f_heat, f_beta, f_sc, p_beta, sig_acc, l_disk, r_in, r_out, compar1, compar2, compar3,
+            compsw, velsw, infosw, EBLsw)])
+
+        if np.allclose(params[self._fixed], self.emulator.fixed[self._fixed], rtol=1e-6, atol=0):
+            logflux, error = self.emulator.predict(params[self._free], return_error=True)
+            if error <= self.max_error:
+                self.emulated += 1
+                energies, inverse = np.unique(x, return_inverse=True)
+                flux = 10**np.interp(
+                    np.log10(energies),
+                    np.log10(self.emulator.energies),
+                    logflux,
+                    left=-100, right=-100)
+                return self._photon_flux(flux, energies)[inverse].reshape(np.shape(x))
+
+        self.fallbacks += 1
+        return super().evaluate(x, Mbh, theta, dist, redsh, jetrat, r_0, z_acc, z_diss, z_max, t_e,
+                                f_nth, f_pl, pspec, f_heat, f_beta, f_sc, p_beta, sig_acc, l_disk,
+                                r_in, r_out, compar1, compar2, compar3, compsw, velsw, infosw, EBLsw)